@@ -20,6 +20,7 @@ from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
 from backend.urls import websocket_urlpatterns
+from backend.registry import rooms
 
 django_asgi_app = get_asgi_application()
 
@@ -27,3 +28,6 @@ application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(AuthMiddlewareStack(URLRouter(websocket_urlpatterns))),
 })
+
+# Save and close the study design map rooms when the worker is stopped
+rooms.install_shutdown_handler()
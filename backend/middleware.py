@@ -0,0 +1,87 @@
+import re
+from functools import wraps
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import add_never_cache_headers
+
+# Seconds the latest sequence number of a request stream is kept
+_SEQUENCE_TIMEOUT = 60
+_SEQUENCE_HEADER = re.compile(r'^([\w-]{1,64}):(\d{1,9})$')
+
+
+def _request_sequence(request: HttpRequest) -> tuple[str, int] | None:
+    match = _SEQUENCE_HEADER.match(request.headers.get('X-Request-Sequence', ''))  # type: ignore
+    return (match[1], int(match[2])) if match else None
+
+
+def _sequence_key(stream: str) -> str:
+    return f'request-sequence:{stream}'
+
+
+def _record_sequence(stream: str, sequence: int) -> None:
+    latest = cache.get(_sequence_key(stream))
+    if latest is None or sequence > latest:
+        cache.set(_sequence_key(stream), sequence, _SEQUENCE_TIMEOUT)
+
+
+def is_superseded(request: HttpRequest) -> bool:
+    """
+    Whether a later request of the same stream has arrived since this one.
+
+    Search-as-you-type forms number their requests with an `X-Request-Sequence:
+    <stream>:<number>` header (see frontend/main.js). A view can skip the work
+    for a request that was superseded while it waited for a worker thread.
+    """
+    sequence = _request_sequence(request)
+    if sequence is None:
+        return False
+    latest = cache.get(_sequence_key(sequence[0]))
+    return latest is not None and latest > sequence[1]
+
+
+def skip_superseded(view):
+    """
+    Answers superseded requests (see is_superseded) of a view with an empty 204
+    No Content, which htmx does not swap, before any other work is done for
+    them. Put it above decorators that query the database, such as conditional
+    GET handling.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if is_superseded(request):
+            response = HttpResponse(status=204)
+            # Not to be reused for the same URL later
+            add_never_cache_headers(response)
+            return response
+        return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+class RequestSequenceMiddleware:
+    """
+    Records the sequence number of a request (see is_superseded) as soon as it
+    arrives.
+
+    Under ASGI the sync middleware and views of all requests run in one thread
+    per worker, so requests typed in quick succession queue up. This middleware
+    is async and must come first, so that it records the number before the
+    request joins the queue, and the requests ahead of it see they were
+    superseded.
+    """
+
+    async_capable = True
+    sync_capable = False
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        markcoroutinefunction(self)
+
+    async def __call__(self, request):
+        sequence = _request_sequence(request)
+        if sequence is not None:
+            # Not in the thread of the queued requests
+            await sync_to_async(_record_sequence, thread_sensitive=False)(*sequence)
+        return await self.get_response(request)
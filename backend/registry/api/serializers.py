@@ -45,6 +45,25 @@ class ResourceStatusSerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
+class SearchEntrySerializer(serializers.ModelSerializer):
+    id = serializers.CharField(source='object_id')
+    url = serializers.CharField(source='get_absolute_url')
+    rank = serializers.FloatField()
+
+    class Meta:
+        model = models.SearchEntry
+        fields = ['id', 'title', 'context', 'url', 'rank']
+
+
+class SuggestionSerializer(serializers.ModelSerializer):
+    id = serializers.CharField(source='object_id')
+    similarity = serializers.FloatField()
+
+    class Meta:
+        model = models.SearchEntry
+        fields = ['id', 'title', 'context', 'similarity']
+
+
 class ResourceKindSerializer(serializers.BaseSerializer):
     def to_representation(self, obj):
         return {
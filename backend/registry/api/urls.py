@@ -12,6 +12,8 @@ router.register(r'resource-kinds', views.ResourceKindViewSet, basename='resource
 router.register(r'resource-statuses', views.ResourceStatusViewSet)
 router.register(r'resources', views.ResourceViewSet)
 router.register(r'resource-files', views.ResourceFileViewSet)
+router.register(r'search', views.SearchViewSet, basename='search')
+router.register(r'suggest', views.SuggestViewSet, basename='suggest')
 
 urlpatterns = [
     path('docs/', views.docs, name='api_docs'),
@@ -1,12 +1,22 @@
 
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.contrib.auth.decorators import login_required
 
 from rest_framework import viewsets, mixins, authentication, permissions
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 
+from backend.utils import QueryTimeout, statement_timeout
+
+from .. import caching
+from .. import forms
 from .. import models
+from .. import search
 from . import serializers
 
 
@@ -24,7 +34,39 @@ class AuthzMixin:
     permission_classes = [permissions.IsAuthenticated]
 
 
+class ConditionalMixin:
+    """
+    Answers conditional GETs of the list and retrieve actions with 304 Not
+    Modified, without serializing anything (see caching.validators).
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())  # type: ignore
+        return self.conditional(queryset, super().list, request, *args, **kwargs)  # type: ignore
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]  # type: ignore
+        queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: lookup})  # type: ignore
+        return self.conditional(queryset, super().retrieve, request, *args, **kwargs)  # type: ignore
+
+    def conditional(self, queryset, action, request, *args, **kwargs):
+        etag, last_modified = caching.validators(
+            request.site.id, [queryset],
+            # The browsable API shows the user
+            [request.user.pk, request.accepted_renderer.format],
+        )
+        etag, last_modified = quote_etag(etag), int(last_modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = action(request, *args, **kwargs)
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
 class ListRetrieveViewSet(
+    ConditionalMixin,
     viewsets.GenericViewSet,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin
@@ -71,6 +113,47 @@ class ResourceKindViewSet(AuthzMixin, viewsets.ViewSet):
         return Response(serializer.data)
 
 
+class SearchTimeout(APIException):
+    status_code = 503
+    default_detail = 'The search took too long. Please use longer or more keywords.'
+    default_code = 'search_timeout'
+
+
+class SearchViewSet(AuthzMixin, viewsets.ViewSet):
+    def list(self, request):
+        try:
+            with statement_timeout(settings.REGISTRY_SEARCH_STATEMENT_TIMEOUT):
+                results = search.search(request.site, request.query_params.get('q'), settings.REGISTRY_SEARCH_HITS_PER_KIND)
+        except QueryTimeout:
+            raise SearchTimeout()
+        return Response([
+            {
+                'kind': kind.value,
+                'label': kind.label,
+                'total': hits[0].total,  # type: ignore
+                'hits': serializers.SearchEntrySerializer(hits, many=True).data,
+            }
+            for kind, hits in results.items()
+        ])
+
+
+class SuggestViewSet(AuthzMixin, viewsets.ViewSet):
+    def list(self, request):
+        kind = request.query_params.get('type')
+        if kind not in search.Kind.values:
+            raise ValidationError({'type': [f'Must be one of: {", ".join(search.Kind.values)}.']})  # type: ignore
+
+        try:
+            with statement_timeout(settings.REGISTRY_SEARCH_STATEMENT_TIMEOUT):
+                suggestions = search.suggest(
+                    request.site, search.Kind(kind), request.query_params.get('q'),
+                    settings.REGISTRY_SUGGEST_LIMIT, settings.REGISTRY_SUGGEST_SIMILARITY,
+                )
+        except QueryTimeout:
+            raise SearchTimeout()
+        return Response(serializers.SuggestionSerializer(suggestions, many=True).data)
+
+
 class ResourceStatusViewSet(AuthzMixin, ListRetrieveViewSet):
     queryset = models.ResourceStatus.objects.none()
     serializer_class = serializers.ResourceStatusSerializer
@@ -79,16 +162,26 @@ class ResourceStatusViewSet(AuthzMixin, ListRetrieveViewSet):
         return models.ResourceStatus.site_objects(self.request)
 
 
-class ResourceViewSet(AuthzMixin, viewsets.ModelViewSet):
+class ResourceViewSet(AuthzMixin, ConditionalMixin, viewsets.ModelViewSet):
     queryset = models.Resource.objects.none()
     serializer_class = serializers.ResourceSerializer
     http_method_names = ['head', 'options', 'get', 'post', 'patch']
 
     def get_queryset(self):
-        return models.Resource.site_objects(self.request).filter(archived=False)
-
-
-class ResourceFileViewSet(AuthzMixin, viewsets.ModelViewSet):
+        queryset = models.Resource.site_objects(self.request).filter(archived=False)
+        if self.action == 'list':
+            if self.request.query_params.get('kind'):
+                queryset = queryset.filter(kind=self.request.query_params['kind'])
+            if self.request.query_params.get('harmonised_json'):
+                try:
+                    containment = forms.HarmonisedJsonFilterField().clean(self.request.query_params['harmonised_json'])
+                except DjangoValidationError as e:
+                    raise ValidationError({'harmonised_json': e.messages})
+                queryset = queryset.filter(harmonised_json__contains=containment)
+        return queryset
+
+
+class ResourceFileViewSet(AuthzMixin, ConditionalMixin, viewsets.ModelViewSet):
     queryset = models.ResourceFile.objects.none()
     serializer_class = serializers.ResourceFileSerializer
     http_method_names = ['head', 'options', 'get', 'post', 'patch']
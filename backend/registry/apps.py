@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class RegistryConfig(AppConfig):
     name = 'backend.registry'
+
+    def ready(self):
+        from . import signals  # noqa
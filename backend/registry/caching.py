@@ -0,0 +1,125 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Func, QuerySet, Subquery
+from django.db.models.functions import Greatest
+from django.contrib.sites.models import Site
+
+
+# -----------------------------------------------------------------------------
+# Generations
+#
+# Cached values are keyed by the current generation of what they were computed
+# from, per site. Writes bump the generation, which makes every value cached
+# under the previous one unreachable; those expire on their own.
+
+def _generation_key(name: str, site_id: int) -> str:
+    return f'registry:generation:{name}:{site_id}'
+
+
+def _started_key(name: str, site_id: int) -> str:
+    return f'registry:generation-started:{name}:{site_id}'
+
+
+def generation(name: str, site_id: int) -> int:
+    """The current generation of `name` on a site."""
+    key = _generation_key(name, site_id)
+    value = cache.get(key)
+    if value is None:
+        # Start from the clock rather than from 0, so that values cached under
+        # an evicted generation can never become current again
+        cache.add(key, time.time_ns(), timeout=None)
+        cache.set(_started_key(name, site_id), time.time(), timeout=None)
+        value = cache.get(key)
+    return value
+
+
+def started(name: str, site_id: int) -> datetime:
+    """When the current generation of `name` on a site started."""
+    key = _started_key(name, site_id)
+    value = cache.get(key)
+    if value is None:
+        # Unknown, so as far as anyone can tell it started just now
+        cache.add(key, time.time(), timeout=None)
+        value = cache.get(key)
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+def bump(name: str, site_ids: Iterable[int]) -> None:
+    """
+    Start a new generation of `name` on the given sites.
+
+    The generation is bumped right away, so that reads later in the same
+    transaction miss, and again once the transaction commits, so that values
+    other requests cached from the data before the commit are dropped too.
+    """
+    site_ids = set(site_ids)
+
+    def _bump():
+        for site_id in site_ids:
+            try:
+                cache.incr(_generation_key(name, site_id))
+            except ValueError:
+                # Not cached (yet or anymore), generation() starts a new one
+                pass
+            cache.set(_started_key(name, site_id), time.time(), timeout=None)
+
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def cached(name: str, site_id: int, key: Any, compute: Callable[[], Any]) -> Any:
+    """
+    The value cached for `key` (anything JSON serializable) in the current
+    generation of `name` on a site, computed and cached if there is none.
+    """
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+    cache_key = f'registry:{name}:{site_id}:{generation(name, site_id)}:{digest}'
+    value = cache.get(cache_key)
+    if value is None:
+        value = compute()
+        cache.set(cache_key, value, settings.REGISTRY_CACHE_TIMEOUT)
+    return value
+
+
+# -----------------------------------------------------------------------------
+# HTTP validators
+#
+# Pages and API responses are validated (ETag, Last-Modified) by the latest
+# `updated` time of the objects they show and the `fragments` generation of
+# the site, which is bumped whenever anything else they show changes: related
+# objects, relations and deletions (see signals.py). Both are known without
+# rendering anything.
+
+def latest_updated(site_id: int, querysets: Iterable[QuerySet]) -> Optional[datetime]:
+    """The latest `updated` time of the objects of the given querysets, in one query."""
+    latest = [
+        Subquery(queryset.order_by().values(latest=Func(F('updated'), function='MAX')))
+        for queryset in querysets
+    ]
+    # GREATEST() ignores NULLs, those of querysets without objects
+    return Site.objects.filter(pk=site_id).values(
+        latest=Greatest(*latest) if len(latest) > 1 else latest[0],
+    ).get()['latest']
+
+
+def validators(site_id: int, querysets: Iterable[QuerySet], variant: Any = None) -> tuple[str, datetime]:
+    """
+    The ETag and the Last-Modified time of a response of a site showing the
+    objects of the given querysets. `variant` (anything JSON serializable) is
+    whatever else the response depends on, such as the user.
+    """
+    updated = latest_updated(site_id, querysets)
+    etag = hashlib.sha256(json.dumps(
+        [generation('fragments', site_id), updated, variant], default=str,
+    ).encode()).hexdigest()
+    last_modified = started('fragments', site_id)
+    if updated is not None:
+        last_modified = max(last_modified, updated)
+    return etag, last_modified
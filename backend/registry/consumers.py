@@ -1,12 +1,16 @@
 from typing import TypedDict, cast
 from asgiref.sync import sync_to_async
 
-from pycrdt import Doc, Map, create_sync_message
+from django.db import transaction
+
+from pycrdt import Doc, Map, YMessageType, create_sync_message
 from pycrdt.websocket.django_channels_consumer import YjsConsumer as BaseYjsConsumer
 
 from backend.utils import get_current_site
 
 from . import models
+from . import rooms
+from . import search
 
 
 # -----------------------------------------------------------------------------
@@ -26,13 +30,6 @@ class WebSocketScope(TypedDict):
     url_route: UrlRoute
 
 
-# -----------------------------------------------------------------------------
-# Shared room state: all consumers in the same process share these docs
-# Key: room_name, Value: (ydoc, connection_count)
-
-_room_docs: dict[str, tuple[Doc, int]] = {}
-
-
 def is_member_of_the_current_site(scope) -> bool:
     if not hasattr(scope.get('user'), 'person'):
         return False
@@ -40,21 +37,45 @@ def is_member_of_the_current_site(scope) -> bool:
     return scope['user'].person.sites.filter(id=get_current_site(scope).id).exists()  # type: ignore
 
 
+def person_group_name(person_id: str) -> str:
+    """Channel layer group of all map connections of a person (see signals.py)."""
+    return f'person-{person_id}'
+
+
+def save_ydoc(study_design, scope, doc, update, node_ids, edge_ids):
+    # The binary update is the source of truth, the relational rows are derived from it
+    with transaction.atomic():  # type: ignore
+        if update:
+            study_design.store_map_update(update)
+        edges_pending = study_design.update_from_ydoc(scope, doc, node_ids, edge_ids)
+        # The nodes are written in bulk, without signals
+        if node_ids is None:
+            search.reindex(search.Kind.NODE, parent_id=study_design.id)
+        elif node_ids:
+            search.reindex(search.Kind.NODE, node_ids)
+    return edges_pending
+
+
 class YjsConsumer(BaseYjsConsumer):
     """
     WebSocket consumer for Y.js document synchronization.
 
-    Persistence strategy: Single shared ydoc per room with save on last disconnect.
-    All consumers in the same room share one ydoc instance, eliminating race
-    conditions. Document is persisted only when the last connection leaves.
-
-    IMPORTANT: This requires running a single Daphne worker to ensure all
-    connections share the same process memory.
+    Persistence strategy: Single shared ydoc per room and process with
+    incremental saves. All consumers of a room in the same process share one
+    replica (see rooms.Room). Replicas in different Daphne workers are kept in
+    sync through the channel layer group of the room, so connections to the same
+    map can land on any worker. The room flushes changed nodes and edges in the
+    background and once more when its last local connection leaves.
     """
 
     def __init__(self):
         super().__init__()
         self.study_design = None
+        self.room = None
+        # Site membership is resolved once at connect and refreshed only when
+        # the person's sites change (see membership_changed)
+        self.is_member = False
+        self.person_group = None
 
     def make_room_name(self) -> str:
         scope = cast(WebSocketScope, self.scope)
@@ -63,39 +84,64 @@ class YjsConsumer(BaseYjsConsumer):
     async def make_ydoc(self) -> Doc:
         ydoc = Doc()
         if self.study_design is not None:
-            doc = await sync_to_async(self.study_design.to_ydoc)()
-            nodes = ydoc.get('nodes', type=Map)
-            edges = ydoc.get('edges', type=Map)
-            with ydoc.transaction():
-                for key, value in doc['nodes'].items():
-                    nodes[key] = value
-                for key, value in doc['edges'].items():
-                    edges[key] = value
+            updates = await sync_to_async(self.study_design.load_map_updates)()
+            if updates:
+                for update in updates:
+                    ydoc.apply_update(update)
+                # The relational rows may have been changed outside of the map since
+                update = await sync_to_async(self.study_design.refresh_ydoc)(ydoc)
+                if update is not None:
+                    await sync_to_async(self.study_design.store_map_update)(update)
+            else:
+                # No binary state stored yet: build the document from the relational rows once
+                doc = await sync_to_async(self.study_design.to_ydoc)()
+                nodes = ydoc.get('nodes', type=Map)
+                edges = ydoc.get('edges', type=Map)
+                with ydoc.transaction():
+                    for key, value in doc['nodes'].items():
+                        nodes[key] = value
+                    for key, value in doc['edges'].items():
+                        edges[key] = value
+                await sync_to_async(self.study_design.store_map_update)(ydoc.get_update())
         return ydoc
 
+    async def persist_ydoc(self, ydoc: Doc, update: bytes, node_ids: set[str] | None = None, edge_ids: set[str] | None = None) -> set[str]:
+        if self.study_design is None:
+            return set()
+        nodes = ydoc.get('nodes', type=Map)
+        edges = ydoc.get('edges', type=Map)
+        doc = {
+            'nodes': dict(nodes.items()) if node_ids is None else {id: nodes[id] for id in node_ids if id in nodes},
+            'edges': dict(edges.items()) if edge_ids is None else {id: edges[id] for id in edge_ids if id in edges},
+        }
+        return await sync_to_async(save_ydoc)(self.study_design, self.scope, doc, update, node_ids, edge_ids)
+
     async def connect(self):
-        if not await sync_to_async(is_member_of_the_current_site)(self.scope):
+        self.is_member = await sync_to_async(is_member_of_the_current_site)(self.scope)
+        if not self.is_member:
             await self.close()
         else:
+            # The person was loaded by the membership check
+            self.person_group = person_group_name(self.scope['user'].person.id)  # type: ignore
+            await self.channel_layer.group_add(self.person_group, self.channel_name)
             try:
                 scope = cast(WebSocketScope, self.scope)
                 self.study_design = await models.StudyDesign.objects.aget(pk=scope['url_route']['kwargs']['study_design_id'])
 
-                # Set up room name before checking shared docs
-                self.room_name = self.make_room_name()
-
-                # Use shared ydoc if room already exists, otherwise create new one
-                if self.room_name in _room_docs:
-                    self.ydoc, count = _room_docs[self.room_name]
-                    _room_docs[self.room_name] = (self.ydoc, count + 1)
-                else:
-                    self.ydoc = await self.make_ydoc()
-                    _room_docs[self.room_name] = (self.ydoc, 1)
-
                 # Replicate base class connect() logic WITHOUT overwriting self.ydoc
-                # Base class does: self.ydoc = await self.make_ydoc() - we skip that
+                # Base class does: self.ydoc = await self.make_ydoc() - we use the room replica instead.
+                # Join the group first so that no update is missed while the room is opening.
+                self.room_name = self.make_room_name()
                 self._websocket_shim = self._make_websocket_shim(self.scope["path"])
                 await self.channel_layer.group_add(self.room_name, self.channel_name)
+
+                try:
+                    self.room = await rooms.join(self.room_name, self.channel_name, self.make_ydoc, self.persist_ydoc)
+                except rooms.ShuttingDown:
+                    # This worker is stopping: the client retries and lands on another one
+                    await self.close(code=rooms.RECONNECT_CODE)
+                    return
+                self.ydoc = self.room.ydoc
                 await self.accept()
 
                 # Send sync step 1 to the new client
@@ -106,32 +152,59 @@ class YjsConsumer(BaseYjsConsumer):
                 await self.close()
 
     async def disconnect(self, code) -> None:
+        if self.person_group is not None:
+            await self.channel_layer.group_discard(self.person_group, self.channel_name)
+
         if self.room_name is not None:
-            if not await sync_to_async(is_member_of_the_current_site)(self.scope):
-                pass  # Don't save for unauthorized users
-            elif self.room_name in _room_docs:
-                ydoc, count = _room_docs[self.room_name]
-
-                if count <= 1:
-                    # Last connection - save to DB and clean up
-                    if self.study_design is not None:
-                        nodes = ydoc.get('nodes', type=Map)
-                        edges = ydoc.get('edges', type=Map)
-                        doc = {
-                            'nodes': dict(nodes.items()),
-                            'edges': dict(edges.items()),
-                        }
-                        await sync_to_async(self.study_design.update_from_ydoc)(self.scope, doc)
-                    del _room_docs[self.room_name]
-                else:
-                    # Other connections remain - just decrement count
-                    _room_docs[self.room_name] = (ydoc, count - 1)
+            # Don't save for unauthorized users
+            await rooms.leave(self.room_name, self.channel_name, self.is_member)
 
+            self.room = None
             self.ydoc = None
             await super().disconnect(code)
 
     async def receive(self, text_data=None, bytes_data=None):
-        if not await sync_to_async(is_member_of_the_current_site)(self.scope):
+        if not self.is_member:
             await self.close()
         else:
-            await super().receive(text_data, bytes_data)
+            if self.room is not None:
+                self.room.touch()
+            if bytes_data and bytes_data[0] == YMessageType.AWARENESS and self.room is not None:
+                # Coalesced and rate limited per room instead of being fanned out right away
+                self.room.queue_awareness(bytes_data)
+            else:
+                await super().receive(text_data, bytes_data)
+
+    async def membership_changed(self, event) -> None:
+        # The person's sites changed: re-check and close the socket if access was revoked
+        self.is_member = await sync_to_async(is_member_of_the_current_site)(self.scope)
+        if not self.is_member:
+            await self.close()
+
+    async def group_send_message(self, message: bytes) -> None:
+        await self.channel_layer.group_send(self.room_name, {
+            'type': 'send_message',
+            'message': message,
+            'origin': rooms.PROCESS_ID,
+        })
+
+    async def send_message(self, message_wrapper) -> None:
+        # Updates from clients on other workers still have to reach the local replica
+        if self.room is not None and message_wrapper.get('origin') != rooms.PROCESS_ID:
+            self.room.apply_remote(message_wrapper['message'])
+            self.room.touch()
+        await super().send_message(message_wrapper)
+
+    async def room_state_request(self, event) -> None:
+        # A worker is opening this room: one local consumer answers with the full state
+        room = rooms.get(self.room_name) if self.room_name is not None else None
+        if event['origin'] != rooms.PROCESS_ID and room is not None and room.responder == self.channel_name:
+            await self.channel_layer.send(event['reply_channel'], {
+                'type': 'room.state',
+                'update': room.ydoc.get_update(),
+            })
+
+    async def room_evicted(self, event) -> None:
+        # The room was closed by the idle or memory sweep or on shutdown, the
+        # client reconnects and reopens it
+        await self.close(code=event.get('code'))
@@ -1,4 +1,7 @@
+import json
+
 from django import forms
+from django.core.exceptions import ValidationError
 from django.forms import ModelForm
 from django.http import HttpRequest
 
@@ -78,6 +81,50 @@ class ResourceForm(ModelForm):
         self.fields["groups"].queryset = models.Group.site_objects(request).all()  # type: ignore
 
 
+class HarmonisedJsonFilterField(forms.CharField):
+    """
+    A filter on Resource.harmonised_json, cleaned to the JSON object the data must contain.
+
+    Accepts a JSON object, or `path=value` terms separated by `;`, where the
+    path names nested keys with dots. For example
+    `MaterialType.Value=Nanomaterial; Protocol.ProtocolId=abc` becomes
+    `{"MaterialType": {"Value": "Nanomaterial"}, "Protocol": {"ProtocolId": "abc"}}`.
+    Values are read as JSON when possible (numbers, true, "quoted"), and as
+    strings otherwise.
+    """
+
+    def to_python(self, value):
+        value = (super().to_python(value) or '').strip()
+        if not value:
+            return None
+        if value.startswith('{'):
+            try:
+                containment = json.loads(value)
+            except ValueError:
+                raise ValidationError('Enter a valid JSON object.')
+            if not isinstance(containment, dict):
+                raise ValidationError('Enter a valid JSON object.')
+            return containment
+
+        containment = {}
+        for term in filter(None, (term.strip() for term in value.split(';'))):
+            path, separator, term_value = term.partition('=')
+            keys = [key.strip() for key in path.split('.')]
+            if not separator or not all(keys):
+                raise ValidationError('Enter path=value terms, e.g. MaterialType.Value=Nanomaterial.')
+            try:
+                term_value = json.loads(term_value)
+            except ValueError:
+                term_value = term_value.strip()
+            node = containment
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+                if not isinstance(node, dict):
+                    raise ValidationError(f'Conflicting terms for {path.strip()}.')
+            node[keys[-1]] = term_value
+        return containment or None
+
+
 class ResourceFiltersForm(forms.Form):
     search = forms.CharField(required=False)
     kind = forms.ChoiceField(
@@ -103,6 +150,7 @@ class ResourceFiltersForm(forms.Form):
         required=False,
         empty_label='All organisations'
     )
+    harmonised_json = HarmonisedJsonFilterField(label='Harmonised data', required=False)
 
     def __init__(self, request, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -112,6 +160,21 @@ class ResourceFiltersForm(forms.Form):
         self.fields['organisation'].queryset = models.Organisation.site_objects(request).all().order_by('short_name')  # type: ignore
         self.fields['organisation'].label_from_instance = lambda o: o.short_name  # type: ignore
 
+    def set_facet_counts(self, counts):
+        """Show the number of resources next to each option, see views.get_resource_facets()."""
+        kind_counts = counts['kind']
+        self.fields['kind'].choices = [  # type: ignore
+            (value, f'{label} ({kind_counts.get(value, 0)})' if value else label)
+            for value, label in self.fields['kind'].choices  # type: ignore
+        ]
+
+        def with_count(label_from_instance, counts):
+            return lambda obj: f'{label_from_instance(obj)} ({counts.get(obj.pk, 0)})'
+
+        for name in ['group', 'status', 'organisation']:
+            field = self.fields[name]
+            field.label_from_instance = with_count(field.label_from_instance, counts[name])  # type: ignore
+
 
 class StudyDesignForm(ModelForm):
 
@@ -0,0 +1,302 @@
+import random
+import re
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_docopt_command import DocOptCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from backend.registry import forms, models, search, views
+from backend.registry.api import views as api_views
+from backend.utils import format_ms, keyset_paginate, percentile
+
+
+# -----------------------------------------------------------------------------
+# Corpus
+#
+# Everything is drawn from one seeded random generator, so the same options
+# give the same names, descriptions, harmonised data and relations (only the
+# ids differ).
+
+COMPOSITIONS = [
+    'Gold', 'Silver', 'Titanium dioxide', 'Zinc oxide', 'Silica', 'Cerium oxide', 'Iron oxide', 'Graphene oxide',
+    'Carbon nanotubes', 'Polystyrene', 'Copper oxide', 'Nickel', 'Alumina', 'Cadmium selenide', 'Hydroxyapatite',
+]
+FORMS = ['nanoparticles', 'nanowires', 'nanorods', 'nanoplates', 'nanofibres', 'powder', 'dispersion', 'thin film', 'quantum dots']
+COATINGS = ['citrate', 'PEG', 'PVP', 'silane', 'uncoated', 'amine', 'carboxyl', 'BSA']
+ENDPOINTS = [
+    'cytotoxicity', 'genotoxicity', 'oxidative stress', 'inflammation', 'dissolution', 'agglomeration', 'zeta potential',
+    'hydrodynamic size', 'surface area', 'protein corona', 'uptake', 'ecotoxicity',
+]
+METHODS = [
+    'DLS', 'TEM', 'SEM', 'BET', 'ICP-MS', 'XRD', 'MTT assay', 'Comet assay', 'LDH assay', 'Alamar Blue', 'flow cytometry', 'ELISA',
+]
+SYSTEMS = ['A549 cells', 'THP-1 macrophages', 'HaCaT keratinocytes', 'Daphnia magna', 'zebrafish embryos', 'rat lung', 'mouse liver', 'Caco-2 cells']
+WORDS = [
+    'sample', 'batch', 'measured', 'after', 'exposure', 'hours', 'concentration', 'medium', 'serum', 'dose', 'response',
+    'replicate', 'control', 'reference', 'characterisation', 'stability', 'storage', 'preparation', 'sonication', 'dilution',
+]
+FIRST_NAMES = ['Anna', 'Ben', 'Chiara', 'David', 'Elena', 'Femi', 'Grace', 'Hiro', 'Ines', 'Jonas', 'Katja', 'Luis', 'Maria', 'Nils', 'Olga', 'Pavel']
+LAST_NAMES = ['Smith', 'Müller', 'Rossi', 'Novak', 'García', 'Jansen', 'Kowalski', 'Dubois', 'Andersson', 'Papadopoulos', 'Silva', 'Horvat']
+
+
+def zipf_choice(rng, values):
+    # Some values are far more common than others, like in real registries
+    return rng.choices(values, weights=[1 / (rank + 1) for rank in range(len(values))])[0]
+
+
+def sentence(rng, *phrases):
+    words = [*phrases, *rng.sample(WORDS, 6)]
+    rng.shuffle(words)
+    return ' '.join(words).capitalize() + '.'
+
+
+def resource_fields(rng, kind, number, protocols, materials):
+    composition = zipf_choice(rng, COMPOSITIONS)
+    form = zipf_choice(rng, FORMS)
+    endpoint = zipf_choice(rng, ENDPOINTS)
+    method = zipf_choice(rng, METHODS)
+    system = rng.choice(SYSTEMS)
+
+    if kind == models.Resource.Kind.MATERIAL:
+        size = rng.choice([5, 10, 15, 20, 30, 50, 80, 100, 200])
+        coating = rng.choice(COATINGS)
+        name = f'{composition} {form} {size} nm, {coating} (NM{number:06d})'
+        description = ' '.join(sentence(rng, composition.lower(), form, coating) for _ in range(rng.randint(1, 4)))
+        harmonised = {'MaterialType': {'Value': form}, 'CoreComposition': composition, 'Size': size, 'Coating': coating}
+    elif kind == models.Resource.Kind.PROTOCOL_SOP:
+        name = f'{endpoint.capitalize()} of {composition.lower()} {form} by {method}'
+        description = ' '.join(sentence(rng, endpoint, method, system) for _ in range(rng.randint(2, 6)))
+        harmonised = {'ProtocolName': name, 'Endpoint': endpoint, 'Method': method}
+    elif kind == models.Resource.Kind.TEST_METHOD:
+        name = f'{method} for {endpoint} in {system}'
+        description = ' '.join(sentence(rng, method, endpoint, system) for _ in range(rng.randint(1, 3)))
+        harmonised = {'Method': method, 'Endpoint': endpoint, 'TestSystem': system}
+    else:
+        protocol = rng.choice(protocols) if protocols else None
+        material = rng.choice(materials) if materials else None
+        name = f'{endpoint.capitalize()} in {system}, {composition.lower()} {form} ({number})'
+        description = ' '.join(sentence(rng, endpoint, system, composition.lower()) for _ in range(rng.randint(1, 3)))
+        harmonised = {
+            'Protocol': {'ProtocolId': protocol.id, 'ProtocolName': protocol.name} if protocol else {},
+            'Material': {'MaterialId': material.id} if material else {},
+            'Endpoint': endpoint,
+        }
+    return {'name': name, 'description': description, 'harmonised_json': harmonised}
+
+
+# -----------------------------------------------------------------------------
+# Command
+
+class Command(DocOptCommand):
+    docs = '''
+Usage:
+    benchmark_search [options]
+
+Generates a reproducible synthetic corpus of resources across several sites,
+runs a fixed set of searches and filters through the resources listing
+(get_resources) and the API on the first site, and reports the number of
+results, p50/p95 latency and the scans of the slowest statement of each query.
+Known-item searches, for the name of one resource, also report where that
+resource ranks.
+
+The corpus is created in a transaction that is rolled back at the end, unless
+--keep is given. A kept corpus is reused by later runs.
+
+Options:
+    --resources=<n>   Number of resources [default: 100000]
+    --sites=<n>       Number of sites to spread them over [default: 3]
+    --seed=<seed>     Seed of the corpus and the queries [default: 1]
+    --runs=<n>        Timed runs of each query [default: 20]
+    --keep            Commit the corpus
+'''
+
+    def handle_docopt(self, arguments):
+        self.rng = random.Random(int(arguments['--seed']))
+        runs = int(arguments['--runs'])
+
+        with transaction.atomic():  # type: ignore
+            sites = list(Site.objects.filter(domain__startswith='benchmark-', domain__endswith='.example.com').order_by('domain'))
+            if sites:
+                self.stdout.write(f'Reusing the corpus of {len(sites)} benchmark sites')
+            else:
+                sites = self.create_corpus(int(arguments['--resources']), int(arguments['--sites']))
+
+            with override_settings(SITE_ID=sites[0].pk):
+                self.benchmark(sites[0], runs)
+
+            if not arguments['--keep']:
+                transaction.set_rollback(True)
+
+    def create_corpus(self, resources_count, sites_count):
+        start = time.perf_counter()
+        rng = self.rng
+        content_type = ContentType.objects.get_for_model(models.Resource)
+        sites = [Site.objects.create(domain=f'benchmark-{i + 1}.example.com', name=f'Benchmark {i + 1}') for i in range(sites_count)]
+
+        users = User.objects.bulk_create([
+            User(username=f'benchmark-{i}@example.com', email=f'benchmark-{i}@example.com', first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES))
+            for i in range(100 * sites_count)
+        ])
+        people = models.Person.objects.bulk_create([models.Person(user=user) for user in users])
+        organisations = models.Organisation.objects.bulk_create([
+            models.Organisation(name=f'Institute of {composition} Research {i + 1}', short_name=f'I{composition[:3].upper()}{i + 1}', country='DE')
+            for i, composition in enumerate(rng.choices(COMPOSITIONS, k=10 * sites_count))
+        ])
+        models.Organisation.people.through.objects.bulk_create([  # type: ignore
+            models.Organisation.people.through(organisation=organisation, person=person)  # type: ignore
+            for person in people
+            for organisation in rng.sample(organisations, rng.randint(1, 2))
+        ])
+
+        number = 0
+        for site_index, site in enumerate(sites):
+            site_people = people[site_index::sites_count]
+            site_organisations = organisations[site_index::sites_count]
+            models.Person.sites.through.objects.bulk_create([models.Person.sites.through(person=person, site=site) for person in site_people])  # type: ignore
+            models.Organisation.sites.through.objects.bulk_create([models.Organisation.sites.through(organisation=organisation, site=site) for organisation in site_organisations])  # type: ignore
+            statuses = models.ResourceStatus.objects.bulk_create([models.ResourceStatus(site=site, name=name, position=i) for i, name in enumerate(['Draft', 'In review', 'Published'])])
+            groups = models.Group.objects.bulk_create([models.Group(site=site, name=f'Case study {i + 1}: {endpoint}') for i, endpoint in enumerate(ENDPOINTS[:8])])
+            role = models.PersonRole.objects.create(site=site, name='Author')
+
+            # Data refers to earlier protocols and materials, so those come first
+            protocols, materials, resources = [], [], []
+            kinds = rng.choices(models.Resource.Kind.values, weights=[4, 1, 2, 3], k=resources_count // sites_count)
+            for kind in sorted(kinds, key=lambda kind: kind == models.Resource.Kind.DATA):
+                number += 1
+                resource = models.Resource(
+                    site=site, kind=kind, status=zipf_choice(rng, statuses),
+                    **resource_fields(rng, kind, number, protocols, materials),
+                )
+                resources.append(resource)
+                if kind == models.Resource.Kind.PROTOCOL_SOP:
+                    protocols.append(resource)
+                elif kind == models.Resource.Kind.MATERIAL:
+                    materials.append(resource)
+            models.Resource.objects.bulk_create(resources, batch_size=2000)
+
+            models.Resource.groups.through.objects.bulk_create([  # type: ignore
+                models.Resource.groups.through(resource=resource, group=group)  # type: ignore
+                for resource in resources
+                for group in rng.sample(groups, rng.choice([0, 0, 1, 1, 2]))
+            ], batch_size=5000)
+            models.Contributor.objects.bulk_create([
+                models.Contributor(content_type=content_type, object_id=resource.id, person=person, role=role)
+                for resource in resources
+                for person in rng.sample(site_people, rng.randint(1, 3))
+            ], batch_size=5000)
+
+            for kind, ids in [(search.Kind.RESOURCE, [resource.id for resource in resources]), (search.Kind.PERSON, [person.id for person in site_people]), (search.Kind.ORGANISATION, [organisation.id for organisation in site_organisations])]:
+                search.reindex(kind, ids)
+
+        with connection.cursor() as cursor:
+            # The planner needs statistics of the new rows to choose the plans it would in production
+            cursor.execute('ANALYZE registry_resource, registry_resource_groups, registry_contributor, registry_organisation_people, registry_searchentry')
+        self.stdout.write(f'Created {number} resources on {sites_count} sites in {time.perf_counter() - start:.1f}s')
+        return sites
+
+    # Queries
+
+    def queries(self, site):
+        """The fixed query set: (label, callable returning the number of results, known item or None)."""
+        rng = random.Random(self.rng.random())
+        request = RequestFactory().get('/')
+        request.site = site  # type: ignore
+        resources = models.Resource.site_objects(request).filter(archived=False)
+        protocol = resources.filter(kind=models.Resource.Kind.PROTOCOL_SOP).order_by('name', 'id').first()
+        group = models.Group.site_objects(request).order_by('name').first()
+        organisation = models.Organisation.site_objects(request).order_by('name').first()
+        known_items = [resources.order_by('name', 'id')[rng.randrange(resources.count())] for _ in range(3)]
+
+        def listing(params):
+            def run():
+                form = forms.ResourceFiltersForm(request, params)
+                form.is_valid()
+                page, _ = keyset_paginate(views.get_resources(request, form.cleaned_data), None, settings.REGISTRY_RESOURCES_PAGE_SIZE)
+                return page
+            return run
+
+        def api(viewset, path, params):
+            view = viewset.as_view({'get': 'list'})
+
+            def run():
+                api_request = APIRequestFactory().get(path, params)
+                api_request.site = site  # type: ignore
+                force_authenticate(api_request, user=self.user)
+                response = view(api_request)
+                response.render()
+                if response.status_code != 200:
+                    raise RuntimeError(f'{path} {params}: {response.status_code} {response.content[:200]!r}')
+                return response.data
+            return run
+
+        queries = [
+            ('listing: all', listing({}), None),
+            ('listing: search "gold"', listing({'search': 'gold'}), None),
+            ('listing: search "ti"', listing({'search': 'ti'}), None),
+            ('listing: search "cytotox assay"', listing({'search': 'cytotox assay'}), None),
+            ('listing: kind + search "nano"', listing({'kind': models.Resource.Kind.MATERIAL, 'search': 'nano'}), None),
+            ('listing: use case', listing({'group': group.pk}), None),
+            ('listing: organisation', listing({'organisation': organisation.pk}), None),
+            ('listing: organisation + search "oxide"', listing({'organisation': organisation.pk, 'search': 'oxide'}), None),
+            ('listing: harmonised material type', listing({'harmonised_json': 'MaterialType.Value=nanowires'}), None),
+            ('listing: harmonised protocol id', listing({'harmonised_json': f'Protocol.ProtocolId={protocol.pk}'}), None),
+            ('listing: facets of search "silver"', lambda: views.get_resource_facets(request, {'search': 'silver'}), None),
+            ('api: resources by protocol id', api(api_views.ResourceViewSet, '/api/resources/', {'kind': 'DATA', 'harmonised_json': f'Protocol.ProtocolId={protocol.pk}'}), None),
+            ('api: resources by size and coating', api(api_views.ResourceViewSet, '/api/resources/', {'harmonised_json': 'Size=5; Coating=BSA; CoreComposition=Hydroxyapatite'}), None),
+            ('api: search "zinc oxide"', api(api_views.SearchViewSet, '/api/search/', {'q': 'zinc oxide'}), None),
+            ('api: suggest organisation "instute"', api(api_views.SuggestViewSet, '/api/suggest/', {'type': 'organisation', 'q': 'instute'}), None),
+            ('api: suggest person "mulller"', api(api_views.SuggestViewSet, '/api/suggest/', {'type': 'person', 'q': 'mulller'}), None),
+        ]
+        for item in known_items:
+            # A few words of the name, as someone who remembers it roughly would type them
+            words = [word for word in re.findall(r'[^\W\d]+', item.name) if len(word) > 2]
+            text = ' '.join(rng.sample(words, min(3, len(words))))
+            queries.append((f'listing: known item "{text}"', listing({'search': text}), item))
+        return queries
+
+    def benchmark(self, site, runs):
+        self.user = models.Person.objects.filter(sites=site).select_related('user').first().user
+        self.stdout.write(f'{"Query":<48} {"Results":>8} {"Rank":>5} {"p50":>9} {"p95":>9}  Scans of the slowest statement')
+
+        for label, run, known_item in self.queries(site):
+            with CaptureQueriesContext(connection) as captured:
+                results = run()
+            timings = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+
+            rank = ''
+            if known_item is not None:
+                rank = next((str(i + 1) for i, resource in enumerate(results) if resource.pk == known_item.pk), '-')
+            count = self.count(results)
+            slowest = max(captured.captured_queries, key=lambda query: float(query['time']))
+            self.stdout.write(f'{label[:48]:<48} {count:>8} {rank:>5} {format_ms(percentile(timings, 50)):>9} {format_ms(percentile(timings, 95)):>9}  {self.scans(slowest["sql"])}')
+
+    def count(self, results):
+        if isinstance(results, dict):
+            # Facet counts, options per filter
+            return sum(len(options) for options in results.values())
+        if results and isinstance(results[0], dict) and 'hits' in results[0]:
+            # Search API, hits per kind
+            return sum(len(group['hits']) for group in results)
+        return len(results)
+
+    def scans(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {sql}')
+            plan = [row[0] for row in cursor.fetchall()]
+        scans = []
+        for line in plan:
+            match = re.search(r'((?:Parallel )?(?:Seq Scan|Index Only Scan|Index Scan|Bitmap Index Scan)) (?:using (\S+) )?on (\S+)', line)
+            if match:
+                scans.append(f'{match[1]} {match[2] or match[3]}')
+        return ', '.join(dict.fromkeys(scans))
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import random
+import resource
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.test import override_settings
+from django_docopt_command import DocOptCommand
+from pycrdt import Doc, Encoder, Map, YMessageType, create_awareness_message, create_sync_message, create_update_message, handle_sync_message
+
+from backend.urls import websocket_urlpatterns
+from backend.registry import models, rooms
+from backend.utils import format_ms, percentile
+
+
+# -----------------------------------------------------------------------------
+# Simulated editor
+
+class Client:
+    """
+    One browser tab editing a study design map: a pycrdt replica speaking the
+    y-websocket protocol, making node and edge edits and moving its cursor.
+    """
+
+    def __init__(self, application, run, study_design_id, user, domain):
+        self.run = run
+        self.study_design_id = study_design_id
+        self.ydoc = Doc()
+        self.nodes = self.ydoc.get('nodes', type=Map)
+        self.edges = self.ydoc.get('edges', type=Map)
+        self.own_nodes = []
+        self.outbox = []
+        self.applying = False
+        self.awareness_clock = 0
+
+        self.communicator = WebsocketCommunicator(application, f'/ws/registry/study-design-maps/{study_design_id}', headers=[(b'host', domain.encode())])
+        self.communicator.scope['user'] = user  # type: ignore
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'Connection to study design {self.study_design_id} was refused')
+        self.ydoc.observe(self.on_update)
+        self.nodes.observe(self.on_nodes)
+        await self.send(create_sync_message(self.ydoc))
+        self.receiver = asyncio.create_task(self.receive_messages())
+
+    async def disconnect(self):
+        self.receiver.cancel()
+        await self.communicator.disconnect(timeout=30)
+
+    async def send(self, message):
+        self.run.sent += 1
+        await self.communicator.send_to(bytes_data=message)
+
+    async def receive_messages(self):
+        while True:
+            message = await self.communicator.receive_from(timeout=3600)
+            self.run.received += 1
+            if message[0] == YMessageType.SYNC:
+                self.applying = True
+                try:
+                    reply = handle_sync_message(message[1:], self.ydoc)  # type: ignore
+                finally:
+                    self.applying = False
+                if reply is not None:
+                    await self.send(reply)
+
+    def on_update(self, event):
+        if not self.applying:
+            self.outbox.append(event.update)
+
+    def on_nodes(self, event):
+        # Sync latency: time from the edit on another client until it is applied here
+        if self.applying:
+            now = time.perf_counter()
+            for change in event.keys.values():
+                value = change.get('newValue')
+                if isinstance(value, dict) and 'sent' in value.get('data', {}):
+                    self.run.latencies.append(now - value['data']['sent'])
+
+    async def flush(self):
+        for update in self.outbox:
+            await self.send(create_update_message(update))
+        self.outbox.clear()
+
+    # Edits
+
+    def node(self, id, name, x, y):
+        return {
+            'id': id,
+            'type': self.run.node_type_id,
+            'position': {'x': x, 'y': y},
+            'data': {'name': name, 'description': '', 'organisation': None, 'resources': [], 'sent': time.perf_counter()},
+        }
+
+    def add_node(self):
+        id = models.uuid()
+        self.nodes[id] = self.node(id, f'Node {len(self.own_nodes) + 1}', random.uniform(0, 2000), random.uniform(0, 1000))
+        self.own_nodes.append(id)
+
+    def move_node(self):
+        id = random.choice(self.own_nodes)
+        node = self.nodes[id]
+        self.nodes[id] = self.node(id, node['data']['name'], node['position']['x'] + random.uniform(-20, 20), node['position']['y'] + random.uniform(-20, 20))
+
+    def add_edge(self):
+        source, target = random.sample(list(self.nodes.keys()), 2)
+        pairs = self.run.edge_pairs.setdefault(self.study_design_id, set())
+        if (source, target) not in pairs:
+            pairs.add((source, target))
+            id = models.uuid()
+            self.edges[id] = {'id': id, 'source': source, 'sourceHandle': 'right', 'target': target, 'targetHandle': 'left'}
+
+    async def edit(self, rate, deadline):
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(random.expovariate(rate))
+            choice = random.random()
+            if not self.own_nodes or choice < 0.25:
+                self.add_node()
+            elif choice < 0.4 and len(self.nodes) > 1:
+                self.add_edge()
+            else:
+                self.move_node()
+            await self.flush()
+
+    async def move_cursor(self, rate, deadline):
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(random.expovariate(rate))
+            self.awareness_clock += 1
+            state = json.dumps({'cursor': {'x': random.uniform(0, 2000), 'y': random.uniform(0, 1000)}})
+            encoder = Encoder()
+            encoder.write_var_uint(1)
+            encoder.write_var_uint(self.ydoc.client_id)
+            encoder.write_var_uint(self.awareness_clock)
+            encoder.write_var_string(state)
+            await self.send(create_awareness_message(encoder.to_bytes()))
+
+
+class Run:
+    """Counters shared by all clients of a load test."""
+
+    def __init__(self, node_type_id):
+        self.node_type_id = node_type_id
+        self.edge_pairs = {}
+        self.latencies = []
+        self.loop_lags = []
+        self.sent = 0
+        self.received = 0
+
+
+async def monitor_loop_lag(run, deadline, interval=0.01):
+    # A sleep that overshoots means the event loop was busy with something else
+    loop = asyncio.get_running_loop()
+    while time.perf_counter() < deadline:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        run.loop_lags.append(max(0.0, loop.time() - start - interval))
+
+
+# -----------------------------------------------------------------------------
+# Command
+
+class Command(DocOptCommand):
+    docs = '''
+Usage:
+    load_test_maps [options]
+
+Opens simulated editors on temporary study design maps and reports sync
+latency, message throughput, event loop lag and memory per room. The
+websocket application runs in this process with the in-memory channel layer,
+so the numbers measure the consumers and the room registry only.
+
+Options:
+    --maps=<m>          Number of study design maps [default: 5]
+    --clients=<n>       Number of clients per map [default: 10]
+    --duration=<s>      Seconds of editing [default: 30]
+    --edit-rate=<hz>    Node and edge edits per second and client [default: 2]
+    --cursor-rate=<hz>  Cursor moves per second and client [default: 20]
+    --domain=<domain>   Domain of the site to use, defaults to the current site
+    --keep              Keep the study designs and the user after the run
+'''
+
+    def handle_docopt(self, arguments):
+        maps = int(arguments['--maps'])
+        clients = int(arguments['--clients'])
+        duration = float(arguments['--duration'])
+        edit_rate = float(arguments['--edit-rate'])
+        cursor_rate = float(arguments['--cursor-rate'])
+
+        site = Site.objects.get(domain=arguments['--domain']) if arguments['--domain'] else Site.objects.get_current()
+        suffix = models.uuid()
+        user = User.objects.create_user(username=f'load-test-{suffix}', email=f'load-test-{suffix}@example.com', first_name='Load', last_name='Test')
+        person = models.Person.objects.create(user=user)
+        person.sites.add(site)
+
+        node_type = models.StudyDesignNodeType.objects.filter(site=site).first()
+        created_node_type = node_type is None
+        if created_node_type:
+            node_type = models.StudyDesignNodeType.objects.create(site=site, name='Load test', color='#000000')
+
+        study_designs = [
+            models.StudyDesign.objects.create(site=site, name=f'Load test {suffix} #{i + 1}')
+            for i in range(maps)
+        ]
+
+        try:
+            # Reload the user the way the auth middleware would, with the person attached
+            user = User.objects.select_related('person').get(pk=user.pk)
+            run = Run(node_type.pk)
+            with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}}):
+                asyncio.run(self.load_test(run, study_designs, clients, user, site.domain, duration, edit_rate, cursor_rate))
+        finally:
+            if not arguments['--keep']:
+                for study_design in study_designs:
+                    study_design.delete()
+                if created_node_type:
+                    node_type.delete()
+                person.delete()
+                user.delete()
+
+    async def load_test(self, run, study_designs, clients, user, domain, duration, edit_rate, cursor_rate):
+        application = URLRouter(websocket_urlpatterns)  # type: ignore
+        all_clients = [
+            Client(application, run, study_design.pk, user, domain)
+            for study_design in study_designs
+            for _ in range(clients)
+        ]
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        for client in all_clients:
+            await client.connect()
+        connect_time = time.perf_counter() - start
+        self.stdout.write(f'Connected {len(all_clients)} clients to {len(study_designs)} maps in {connect_time:.2f}s')
+
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(
+            monitor_loop_lag(run, deadline),
+            *[client.edit(edit_rate, deadline) for client in all_clients],
+            *[client.move_cursor(cursor_rate, deadline) for client in all_clients],
+        )
+        # Let the last updates and awareness windows drain
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - start
+
+        # The room registry only refreshes sizes on sweeps, measure the replicas now
+        sizes = [
+            len(room.ydoc.get_update())
+            for room in (rooms.get(f'study-design-map-{study_design.pk}') for study_design in study_designs)
+            if room is not None
+        ]
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        for client in all_clients:
+            await client.disconnect()
+        disconnect_time = time.perf_counter() - start
+
+        self.report(run, elapsed, sizes, rss_after - rss_before, disconnect_time)
+
+    def report(self, run, elapsed, sizes, rss_growth, disconnect_time):
+
+        self.stdout.write(f'Sync latency:   p50 {format_ms(percentile(run.latencies, 50))}, p95 {format_ms(percentile(run.latencies, 95))}, p99 {format_ms(percentile(run.latencies, 99))}, max {format_ms(max(run.latencies, default=0))} ({len(run.latencies)} samples)')
+        self.stdout.write(f'Messages:       {run.sent / elapsed:.0f}/s sent, {run.received / elapsed:.0f}/s received')
+        self.stdout.write(f'Event loop lag: p50 {format_ms(percentile(run.loop_lags, 50))}, p95 {format_ms(percentile(run.loop_lags, 95))}, max {format_ms(max(run.loop_lags, default=0))}')
+        if sizes:
+            # ru_maxrss is in kilobytes on Linux
+            self.stdout.write(f'Memory:         {sum(sizes) / len(sizes) / 1024:.1f}KB encoded state per room, {rss_growth / len(sizes):.0f}KB peak RSS growth per room')
+        self.stdout.write(f'Final flush:    {disconnect_time:.2f}s to disconnect and persist all rooms')
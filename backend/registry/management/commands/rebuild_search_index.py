@@ -0,0 +1,18 @@
+from django_docopt_command import DocOptCommand
+
+from backend.registry import models, search
+
+
+class Command(DocOptCommand):
+    docs = '''
+Usage:
+    rebuild_search_index
+
+Rebuilds the search entries of all resources, study designs, study design map
+nodes, people and organisations. The entries are normally kept current when
+objects are saved; run this after bulk changes that bypass model signals.
+'''
+
+    def handle_docopt(self, arguments):
+        search.rebuild()
+        self.stdout.write(f'{models.SearchEntry.objects.count()} search entries')
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.14 on 2026-10-18 19:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0003_studydesigncollection_studydesign_collection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudyDesignMapUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('study_design', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='map_updates', to='registry.studydesign')),
+            ],
+        ),
+    ]
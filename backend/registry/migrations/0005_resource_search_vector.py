@@ -0,0 +1,52 @@
+# Generated by Django 5.1.14 on 2026-10-18 19:35
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# Keeps Resource.search_vector current on every insert and on updates of the
+# searched columns, including bulk writes that bypass Model.save()
+CREATE_TRIGGER = '''
+CREATE FUNCTION registry_resource_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector(coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector(coalesce(NEW.description, '')), 'B') ||
+        setweight(to_tsvector(coalesce(NEW.id, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER registry_resource_search_vector
+    BEFORE INSERT OR UPDATE OF id, name, description, search_vector ON registry_resource
+    FOR EACH ROW EXECUTE FUNCTION registry_resource_search_vector();
+
+UPDATE registry_resource SET name = name;
+'''
+
+DROP_TRIGGER = '''
+DROP TRIGGER registry_resource_search_vector ON registry_resource;
+DROP FUNCTION registry_resource_search_vector();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0004_studydesignmapupdate'),
+        ('sites', '0002_alter_domain_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='resource',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='resource_search_vector_idx'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.14 on 2026-10-18 19:41
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0005_resource_search_vector'),
+        ('sites', '0002_alter_domain_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='resource',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['harmonised_json'], name='resource_harmonised_json_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.14 on 2026-10-18 19:42
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Same as for Resource.search_vector (migration 0005). The entries are filled
+# by migration 0008.
+CREATE_TRIGGER = '''
+CREATE FUNCTION registry_searchentry_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector(coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector(coalesce(NEW.keywords, '')), 'B') ||
+        setweight(to_tsvector(coalesce(NEW.body, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER registry_searchentry_search_vector
+    BEFORE INSERT OR UPDATE OF title, keywords, body, search_vector ON registry_searchentry
+    FOR EACH ROW EXECUTE FUNCTION registry_searchentry_search_vector();
+'''
+
+DROP_TRIGGER = '''
+DROP TRIGGER registry_searchentry_search_vector ON registry_searchentry;
+DROP FUNCTION registry_searchentry_search_vector();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0006_resource_harmonised_json_index'),
+        ('sites', '0002_alter_domain_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('resource', 'Resources'), ('study_design', 'Study designs'), ('node', 'Study design map nodes'), ('person', 'People'), ('organisation', 'Organisations')], max_length=20)),
+                ('object_id', models.CharField(max_length=12)),
+                ('parent_id', models.CharField(blank=True, max_length=12, null=True)),
+                ('title', models.CharField(max_length=255)),
+                ('keywords', models.CharField(blank=True, max_length=255)),
+                ('body', models.TextField(blank=True)),
+                ('context', models.CharField(blank=True, max_length=255)),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(editable=False, null=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sites.site')),
+            ],
+            options={
+                'verbose_name_plural': 'Search entries',
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='search_entry_vector_idx'), models.Index(fields=['kind', 'object_id'], name='registry_se_kind_cf89b8_idx'), models.Index(fields=['kind', 'parent_id'], name='registry_se_kind_7e2174_idx')],
+            },
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,73 @@
+from django.db import migrations
+
+
+# The same entries as the builders in search.py, but from the historical
+# models, so that later changes to the models do not change this migration.
+
+def resource_entries(apps):
+    Resource = apps.get_model('registry', 'Resource')
+    for resource in Resource.objects.filter(archived=False).values('id', 'site_id', 'name', 'description'):
+        yield dict(
+            site_id=resource['site_id'], kind='resource', object_id=resource['id'],
+            title=resource['name'], keywords=resource['id'], body=resource['description'] or '',
+        )
+
+
+def study_design_entries(apps):
+    StudyDesign = apps.get_model('registry', 'StudyDesign')
+    for study_design in StudyDesign.objects.filter(archived=False).values('id', 'site_id', 'name', 'description'):
+        yield dict(
+            site_id=study_design['site_id'], kind='study_design', object_id=study_design['id'],
+            title=study_design['name'], keywords=study_design['id'], body=study_design['description'] or '',
+        )
+
+
+def node_entries(apps):
+    StudyDesignNode = apps.get_model('registry', 'StudyDesignNode')
+    nodes = StudyDesignNode.objects.filter(study_design__archived=False)
+    for node in nodes.values('id', 'study_design_id', 'study_design__site_id', 'study_design__name', 'name', 'description'):
+        yield dict(
+            site_id=node['study_design__site_id'], kind='node', object_id=node['id'], parent_id=node['study_design_id'],
+            title=node['name'], body=node['description'] or '', context=node['study_design__name'],
+        )
+
+
+def person_entries(apps):
+    Person = apps.get_model('registry', 'Person')
+    memberships = Person.sites.through.objects.values('site_id', 'person_id', 'person__user__first_name', 'person__user__last_name', 'person__user__username', 'person__orcid')
+    for membership in memberships:
+        name = f"{membership['person__user__first_name']} {membership['person__user__last_name']}".strip()
+        yield dict(
+            site_id=membership['site_id'], kind='person', object_id=membership['person_id'],
+            title=name or membership['person__user__username'], keywords=membership['person__orcid'] or '',
+        )
+
+
+def organisation_entries(apps):
+    Organisation = apps.get_model('registry', 'Organisation')
+    memberships = Organisation.sites.through.objects.values('site_id', 'organisation_id', 'organisation__name', 'organisation__short_name', 'organisation__ror')
+    for membership in memberships:
+        yield dict(
+            site_id=membership['site_id'], kind='organisation', object_id=membership['organisation_id'],
+            title=membership['organisation__name'],
+            keywords=' '.join(filter(None, [membership['organisation__short_name'], membership['organisation__ror']])),
+            context=membership['organisation__short_name'],
+        )
+
+
+def fill_search_entries(apps, schema_editor):
+    SearchEntry = apps.get_model('registry', 'SearchEntry')
+    SearchEntry.objects.all().delete()
+    for entries in (resource_entries, study_design_entries, node_entries, person_entries, organisation_entries):
+        SearchEntry.objects.bulk_create((SearchEntry(**entry) for entry in entries(apps)), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0007_searchentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_search_entries, migrations.RunPython.noop),
+    ]
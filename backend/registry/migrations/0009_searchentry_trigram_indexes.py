@@ -0,0 +1,24 @@
+# Generated by Django 5.1.14 on 2026-10-18 20:05
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0008_fill_search_entries'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='searchentry',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['title'], name='search_entry_title_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='searchentry',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['keywords'], name='search_entry_keywords_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -1,14 +1,20 @@
 import os
 import shortuuid
+from typing import ClassVar
 
 from django.conf import settings
 from django.db import models, transaction
+from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.sites.models import Site
 
 from django_countries.fields import CountryField
+from pycrdt import Doc, Map
 
 from backend.utils import get_current_site
 
@@ -25,6 +31,9 @@ def uuid():
 
 
 class BaseModel(models.Model):
+    # Declared for type checkers, Django adds the default manager to concrete models
+    objects: ClassVar[models.Manager]
+
     id = models.CharField(primary_key=True, max_length=UUID_LENGTH, default=uuid, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -70,6 +79,8 @@ class Project(BaseModel):
 
 
 class SiteMixin(models.Model):
+    objects: ClassVar[models.Manager]
+
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
 
     class Meta:
@@ -81,6 +92,8 @@ class SiteMixin(models.Model):
 
 
 class SitesMixin(models.Model):
+    objects: ClassVar[models.Manager]
+
     sites = models.ManyToManyField(Site, blank=True)
 
     class Meta:
@@ -245,8 +258,17 @@ class Resource(BaseModel, SiteMixin):
     harmonised_json = models.JSONField('Harmonised JSON data', null=True, blank=True,
                                        help_text='JSON file containing the harmonised data')
 
+    # Weighted name (A), description (B) and id (C). Maintained by a database
+    # trigger (see migration 0005), so it is current after bulk writes too.
+    search_vector = SearchVectorField(null=True, editable=False)
+
     class Meta:
         ordering = ['name', 'kind']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='resource_search_vector_idx'),
+            # Serves containment (@>) filters on the harmonised data, see HarmonisedJsonFilterField
+            GinIndex(fields=['harmonised_json'], opclasses=['jsonb_path_ops'], name='resource_harmonised_json_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -318,62 +340,207 @@ class StudyDesign(BaseModel, SiteMixin):
         return self.name
 
     def to_ydoc(self):
+        """
+        Build the ydoc dict of the map from three queries, whatever its size.
+
+        Equivalent to calling StudyDesignNode.to_ydoc and StudyDesignEdge.to_ydoc
+        for every node and edge, but reads FK ids and plain values instead of
+        instances.
+        """
+        node_resources = {}
+        for node_id, resource_id, resource_name in (
+                StudyDesignNode.resources.through.objects  # type: ignore
+                .filter(studydesignnode__study_design=self)
+                .order_by(*[f'resource__{field}' for field in Resource._meta.ordering])  # type: ignore
+                .values_list('studydesignnode_id', 'resource_id', 'resource__name')):
+            node_resources.setdefault(node_id, []).append({'id': resource_id, 'name': resource_name})
+
+        nodes = self.nodes.values('id', 'type_id', 'position_x', 'position_y', 'name', 'description', 'organisation_id')  # type: ignore
+        edges = self.edges.values('id', 'source_id', 'sourceHandle', 'target_id', 'targetHandle')  # type: ignore
+
         return {
-            'nodes': dict([(node.id, node.to_ydoc()) for node in self.nodes.all()]),   # type: ignore
-            'edges': dict([(edge.id, edge.to_ydoc()) for edge in self.edges.all()])    # type: ignore
+            'nodes': dict([(node['id'], {
+                'id': node['id'],
+                'type': node['type_id'],
+                'position': {
+                    'x': node['position_x'],
+                    'y': node['position_y']
+                },
+                'data': {
+                    'name': node['name'],
+                    'description': node['description'],
+                    'organisation': node['organisation_id'],
+                    'resources': node_resources.get(node['id'], []),
+                }
+            }) for node in nodes]),
+            'edges': dict([(edge['id'], {
+                'id': edge['id'],
+                'source': edge['source_id'],
+                'sourceHandle': edge['sourceHandle'],
+                'target': edge['target_id'],
+                'targetHandle': edge['targetHandle']
+            }) for edge in edges])
         }
 
-    def update_from_ydoc(self, scope, ydoc):
+    def load_map_updates(self):
+        """Return the stored binary Y.js updates of the map, empty if none were stored yet."""
+        return [bytes(data) for data in self.map_updates.values_list('data', flat=True)]  # type: ignore
+
+    def store_map_update(self, update):
+        """Append a binary Y.js update to the map's log, compacting the log when it grows too long."""
+        StudyDesignMapUpdate.objects.create(study_design=self, data=update)
+        if self.map_updates.count() > settings.REGISTRY_MAP_UPDATES_COMPACT_AFTER:  # type: ignore
+            self.compact_map_updates()
+
+    def compact_map_updates(self):
+        """Replace the map's update log with a single snapshot of the encoded document."""
+        with transaction.atomic():
+            updates = list(self.map_updates.select_for_update().order_by('id'))  # type: ignore
+            if len(updates) > 1:
+                ydoc = Doc()
+                for update in updates:
+                    ydoc.apply_update(bytes(update.data))
+                StudyDesignMapUpdate.objects.filter(id__in=[update.id for update in updates]).delete()
+                StudyDesignMapUpdate.objects.create(study_design=self, data=ydoc.get_update())
+
+    def refresh_ydoc(self, ydoc):
+        """
+        Bring a ydoc loaded from the update log in line with the relational rows.
+
+        The rows are a projection of the document, but they also change on their
+        own: nodes and edges are edited or deleted in the admin, linked resources
+        are renamed or deleted, organisations are deleted. Those changes are
+        applied to the ydoc in one transaction, so that the room does not write
+        the old values back. Fields the rows do not hold are left alone.
+
+        Returns the binary update, or None if the ydoc was up to date.
+        """
+        doc = self.to_ydoc()
+        nodes = ydoc.get('nodes', type=Map)
+        edges = ydoc.get('edges', type=Map)
+        state = ydoc.get_state()
+        changed = False
+        with ydoc.transaction():
+            for key, rows in ((nodes, doc['nodes']), (edges, doc['edges'])):
+                for id in set(key.keys()) - rows.keys():
+                    del key[id]
+                    changed = True
+            for id, node in doc['nodes'].items():
+                refreshed = _refresh_ydoc_node(nodes.get(id), node)
+                if refreshed is not None:
+                    nodes[id] = refreshed
+                    changed = True
+            for id, edge in doc['edges'].items():
+                current = edges.get(id)
+                if current is None or any(current.get(field) != edge[field] for field in ('source', 'sourceHandle', 'target', 'targetHandle')):
+                    edges[id] = {**(current or {}), **edge}
+                    changed = True
+        return ydoc.get_update(state) if changed else None
+
+    def update_from_ydoc(self, scope, ydoc, node_ids=None, edge_ids=None):
+        """
+        Write the nodes and edges of a ydoc to the database.
+
+        If `node_ids` and `edge_ids` are given, only those nodes and edges are
+        compared and written: ids missing from the ydoc are deleted, the others
+        are created or updated. Otherwise the whole map is diffed.
+
+        The diff is applied set-wise: node types, organisations, resources and
+        the node-resource links are read once, and rows are written with bulk
+        statements, so the number of queries does not depend on the map size.
+
+        Edges to a node that is neither in the ydoc nor in the database are not
+        written (the node may have been added on another worker that has not
+        persisted it yet). Returns their ids.
+        """
         with transaction.atomic():
-            nodes_db = dict([(node.id, node) for node in self.nodes.all()])  # type: ignore
+            nodes = self.nodes.all()  # type: ignore
+            if node_ids is not None:
+                nodes = nodes.filter(id__in=node_ids)
+            nodes_db = dict([(node.id, node) for node in nodes])
             nodes_db_set = set(nodes_db.keys())
             nodes_ydoc = ydoc.get('nodes', {})
             nodes_ydoc_set = set([node_id for node_id in nodes_ydoc.keys()])
 
-            edges_db = dict([(edge.id, edge) for edge in self.edges.all()])  # type: ignore
+            edges = self.edges.all()  # type: ignore
+            if edge_ids is not None:
+                edges = edges.filter(id__in=edge_ids)
+            edges_db = dict([(edge.id, edge) for edge in edges])
             edges_db_set = set(edges_db.keys())
             edges_ydoc = ydoc.get('edges', {})
             edges_ydoc_set = set([edge_id for edge_id in edges_ydoc.keys()])
 
             # Delete edges and nodes that are not in the ydoc
 
-            for edge_id in edges_db_set - edges_ydoc_set:
-                edges_db[edge_id].delete()
-
-            for node_id in nodes_db_set - nodes_ydoc_set:
-                nodes_db[node_id].delete()
-
-            def get_organisation(node_ydoc):
-                if node_ydoc['data'].get('organisation'):
-                    if not Organisation.objects.filter(id=node_ydoc['data']['organisation']).exists():
-                        return None
-                    else:
-                        return Organisation.objects.get(id=node_ydoc['data']['organisation'])
-                else:
-                    return None
+            if edges_db_set - edges_ydoc_set:
+                StudyDesignEdge.objects.filter(id__in=edges_db_set - edges_ydoc_set).delete()
+
+            if nodes_db_set - nodes_ydoc_set:
+                StudyDesignNode.objects.filter(id__in=nodes_db_set - nodes_ydoc_set).delete()
+
+            # Leave out edges whose nodes are missing
+
+            nodes_missing = set([
+                edges_ydoc[edge_id][end] for edge_id in edges_ydoc_set for end in ('source', 'target')
+            ]) - nodes_ydoc_set
+            if nodes_missing:
+                nodes_missing -= set(self.nodes.filter(id__in=nodes_missing).values_list('id', flat=True))  # type: ignore
+            edges_pending = set([
+                edge_id for edge_id in edges_ydoc_set
+                if edges_ydoc[edge_id]['source'] in nodes_missing or edges_ydoc[edge_id]['target'] in nodes_missing
+            ])
+            edges_ydoc_set -= edges_pending
+
+            # Preload everything the nodes of the ydoc refer to
+
+            node_type_ids = set(StudyDesignNodeType.site_objects(scope).values_list('id', flat=True))
+            for node_ydoc in nodes_ydoc.values():
+                if node_ydoc['type'] not in node_type_ids:
+                    raise StudyDesignNodeType.DoesNotExist(f'Study design node type {node_ydoc["type"]} does not exist.')  # type: ignore
+
+            organisation_ids = set(Organisation.objects.filter(
+                id__in=[node_ydoc['data']['organisation'] for node_ydoc in nodes_ydoc.values() if node_ydoc['data'].get('organisation')]
+            ).values_list('id', flat=True))
+
+            def get_organisation_id(node_ydoc):
+                organisation_id = node_ydoc['data'].get('organisation')
+                return organisation_id if organisation_id in organisation_ids else None
+
+            resource_ids = set(Resource.objects.filter(
+                id__in=[resource['id'] for node_ydoc in nodes_ydoc.values() for resource in node_ydoc['data']['resources']]
+            ).values_list('id', flat=True))
+
+            NodeResource = StudyDesignNode.resources.through  # type: ignore
+            node_resources_db = dict([((link.studydesignnode_id, link.resource_id), link.id) for link in NodeResource.objects.filter(
+                studydesignnode_id__in=nodes_ydoc_set & nodes_db_set
+            ).only('id', 'studydesignnode_id', 'resource_id')])
+            node_resources_ydoc = set([
+                (node_id, resource['id'])
+                for node_id, node_ydoc in nodes_ydoc.items()
+                for resource in node_ydoc['data']['resources']
+                if resource['id'] in resource_ids
+            ])
 
             # Create nodes and edges that are not in the db
 
-            for node_id in nodes_ydoc_set - nodes_db_set:
-                node_ydoc = nodes_ydoc[node_id]
-
-                node = StudyDesignNode.objects.create(
+            StudyDesignNode.objects.bulk_create([
+                StudyDesignNode(
                     id=node_id,
                     study_design=self,
 
-                    type=StudyDesignNodeType.site_objects(scope).get(id=node_ydoc['type']),
-                    position_x=node_ydoc['position']['x'],
-                    position_y=node_ydoc['position']['y'],
+                    type_id=nodes_ydoc[node_id]['type'],
+                    position_x=nodes_ydoc[node_id]['position']['x'],
+                    position_y=nodes_ydoc[node_id]['position']['y'],
 
-                    name=node_ydoc['data']['name'],
-                    description=node_ydoc['data'].get('description'),
-                    organisation=get_organisation(node_ydoc),
+                    name=nodes_ydoc[node_id]['data']['name'],
+                    description=nodes_ydoc[node_id]['data'].get('description'),
+                    organisation_id=get_organisation_id(nodes_ydoc[node_id]),
                 )
+                for node_id in nodes_ydoc_set - nodes_db_set
+            ])
 
-                node.resources.set(Resource.objects.filter(id__in=[resource['id'] for resource in node_ydoc['data']['resources']]))
-
-            for edge_id in edges_ydoc_set - edges_db_set:
-                StudyDesignEdge.objects.create(
+            StudyDesignEdge.objects.bulk_create([
+                StudyDesignEdge(
                     id=edge_id,
                     study_design=self,
                     source_id=edges_ydoc[edge_id]['source'],
@@ -381,31 +548,40 @@ class StudyDesign(BaseModel, SiteMixin):
                     target_id=edges_ydoc[edge_id]['target'],
                     targetHandle=edges_ydoc[edge_id]['targetHandle']
                 )
+                for edge_id in edges_ydoc_set - edges_db_set
+            ])
 
             # Update nodes and edges that are both in ydoc and in db
+            # (bulk_update bypasses auto_now, so `updated` is set explicitly)
+
+            now = timezone.now()
 
+            nodes_changed = []
             for node_id in nodes_ydoc_set & nodes_db_set:
                 node_db = nodes_db[node_id]
                 node_ydoc = nodes_ydoc[node_id]
 
-                if (node_db.type.id != node_ydoc['type'] or
+                if (node_db.type_id != node_ydoc['type'] or
                         node_db.position_x != node_ydoc['position']['x'] or
                         node_db.position_y != node_ydoc['position']['y'] or
                         node_db.name != node_ydoc['data']['name'] or
                         node_db.description != node_ydoc['data'].get('description') or
-                        node_db.organisation != get_organisation(node_ydoc)):
+                        node_db.organisation_id != get_organisation_id(node_ydoc)):
 
-                    node_db.type = StudyDesignNodeType.site_objects(scope).get(id=node_ydoc['type'])
+                    node_db.type_id = node_ydoc['type']
                     node_db.position_x = node_ydoc['position']['x']
                     node_db.position_y = node_ydoc['position']['y']
                     node_db.name = node_ydoc['data']['name']
                     node_db.description = node_ydoc['data'].get('description')
-                    node_db.organisation = get_organisation(node_ydoc)
-                    node_db.save()
+                    node_db.organisation_id = get_organisation_id(node_ydoc)
+                    node_db.updated = now
+                    nodes_changed.append(node_db)
 
-                if set(node_db.resources.all().values_list('id', flat=True)) != set([resource['id'] for resource in node_ydoc['data']['resources']]):
-                    node_db.resources.set(Resource.objects.filter(id__in=[resource['id'] for resource in node_ydoc['data']['resources']]))
+            StudyDesignNode.objects.bulk_update(nodes_changed, [
+                'type', 'position_x', 'position_y', 'name', 'description', 'organisation', 'updated'
+            ])
 
+            edges_changed = []
             for edge_id in edges_ydoc_set & edges_db_set:
                 edge_db = edges_db[edge_id]
 
@@ -418,7 +594,71 @@ class StudyDesign(BaseModel, SiteMixin):
                     edge_db.sourceHandle = edges_ydoc[edge_id]['sourceHandle']
                     edge_db.target_id = edges_ydoc[edge_id]['target']
                     edge_db.targetHandle = edges_ydoc[edge_id]['targetHandle']
-                    edge_db.save()
+                    edge_db.updated = now
+                    edges_changed.append(edge_db)
+
+            StudyDesignEdge.objects.bulk_update(edges_changed, [
+                'source', 'sourceHandle', 'target', 'targetHandle', 'updated'
+            ])
+
+            # Sync the node-resource links
+
+            if node_resources_db.keys() - node_resources_ydoc:
+                NodeResource.objects.filter(id__in=[node_resources_db[key] for key in node_resources_db.keys() - node_resources_ydoc]).delete()
+
+            NodeResource.objects.bulk_create([
+                NodeResource(studydesignnode_id=node_id, resource_id=resource_id)
+                for (node_id, resource_id) in node_resources_ydoc - node_resources_db.keys()
+            ])
+
+        return edges_pending
+
+
+def _refresh_ydoc_node(current, node):
+    """The ydoc value of a node updated from its row, None if it is up to date (see StudyDesign.refresh_ydoc)."""
+    if current is None:
+        return node
+    data = current.get('data', {})
+    position = current.get('position', {})
+    # The rows hold whole positions, the ydoc can hold fractions
+    moved = any(abs(position.get(axis, 0) - node['position'][axis]) >= 1 for axis in ('x', 'y'))
+
+    resources = {resource['id']: resource['name'] for resource in node['data']['resources']}
+    current_resources = {resource.get('id'): resource.get('name') for resource in data.get('resources', [])}
+    if current_resources != resources:
+        # Keep the order of the ydoc, with renamed, deleted and added resources
+        kept = [{**resource, 'name': resources[resource['id']]} for resource in data.get('resources', []) if resource.get('id') in resources]
+        added = [resource for resource in node['data']['resources'] if resource['id'] not in current_resources]
+        data = {**data, 'resources': kept + added}
+
+    fields = ('name', 'description', 'organisation')
+    if (not moved and current_resources == resources and current.get('type') == node['type'] and
+            all(data.get(field) == node['data'][field] for field in fields)):
+        return None
+    return {
+        **current,
+        'type': node['type'],
+        'position': node['position'] if moved else position,
+        'data': {**data, **{field: node['data'][field] for field in fields}},
+    }
+
+
+class StudyDesignMapUpdate(models.Model):
+    """
+    Binary Y.js update of a study design map.
+
+    The rows of a study design form an append-only log that, applied in any
+    order, yields the current document. The log is periodically compacted into
+    a single snapshot row.
+    """
+    objects: ClassVar[models.Manager]
+
+    study_design = models.ForeignKey(StudyDesign, on_delete=models.CASCADE, related_name='map_updates')
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.study_design} - {self.created}'
 
 
 class StudyDesignNodeType(BaseModel, SiteMixin):
@@ -506,3 +746,65 @@ class StudyDesignEdge(BaseModel):
             'target': self.target.id,
             'targetHandle': self.targetHandle
         }
+
+
+# -----------------------------------------------------------------------------
+# Search
+
+class SearchEntry(models.Model):
+    """
+    One searchable object on one site: a resource, study design, study design
+    node, person or organisation. Maintained by search.reindex() (see signals.py)
+    and searched by search.search() in a single query over all kinds, and by
+    search.suggest() for typeahead pickers.
+    """
+    objects: ClassVar[models.Manager]
+
+    class Kind(models.TextChoices):
+        RESOURCE = 'resource', 'Resources'
+        STUDY_DESIGN = 'study_design', 'Study designs'
+        NODE = 'node', 'Study design map nodes'
+        PERSON = 'person', 'People'
+        ORGANISATION = 'organisation', 'Organisations'
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='+')
+    kind = models.CharField(max_length=20, choices=Kind.choices)
+    object_id = models.CharField(max_length=UUID_LENGTH)
+    # The study design of a node
+    parent_id = models.CharField(max_length=UUID_LENGTH, null=True, blank=True)
+
+    title = models.CharField(max_length=255)
+    keywords = models.CharField(max_length=255, blank=True)
+    body = models.TextField(blank=True)
+    # Shown with the hit but not searched, e.g. the study design of a node
+    context = models.CharField(max_length=255, blank=True)
+
+    # Weighted title (A), keywords (B) and body (C). Maintained by a database
+    # trigger (see migration 0007).
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'Search entries'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='search_entry_vector_idx'),
+            # Fuzzy typeahead matching, see search.suggest()
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='search_entry_title_trgm_idx'),
+            GinIndex(fields=['keywords'], opclasses=['gin_trgm_ops'], name='search_entry_keywords_trgm_idx'),
+            models.Index(fields=['kind', 'object_id']),
+            models.Index(fields=['kind', 'parent_id']),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        if self.kind == self.Kind.RESOURCE:
+            return reverse('registry:resource', args=[self.object_id])
+        elif self.kind == self.Kind.STUDY_DESIGN:
+            return reverse('registry:study_design', args=[self.object_id])
+        elif self.kind == self.Kind.NODE:
+            return reverse('registry:study_design_map', args=[self.parent_id])
+        elif self.kind == self.Kind.PERSON:
+            return reverse('registry:person', args=[self.object_id])
+        else:
+            return reverse('registry:organisation', args=[self.object_id])
@@ -0,0 +1,576 @@
+import asyncio
+import logging
+import signal
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from django.conf import settings
+from django.core.cache import cache
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from pycrdt import Decoder, Doc, Map, MapEvent, TransactionEvent, YMessageType, YSyncMessageType, handle_sync_message, merge_updates
+
+logger = logging.getLogger(__name__)
+
+# Persists a document: its binary update since the last save (empty if only
+# retried edges are left), and the given node and edge ids (all of them if
+# None). Returns the ids of the edges that could not be written yet because
+# one of their nodes is not persisted.
+Persist = Callable[[Doc, bytes, set[str] | None, set[str] | None], Awaitable[set[str]]]
+
+
+# -----------------------------------------------------------------------------
+# Identifies this worker process in channel layer messages. Updates that
+# originate in this process are already applied to the local replica, so they
+# are skipped when they come back through the group.
+
+PROCESS_ID = uuid.uuid4().hex
+
+# Close code sent to clients whose room was closed by the server (eviction or
+# shutdown). The client reconnects and reopens the room, possibly on another
+# worker. Daphne only accepts application close codes from 3000 to 4999, this
+# mirrors 1012 (Service Restart).
+RECONNECT_CODE = 4012
+
+
+class ShuttingDown(Exception):
+    """Raised by join() once the process no longer accepts connections to rooms."""
+
+
+# -----------------------------------------------------------------------------
+# Rooms
+
+@dataclass
+class Room:
+    """
+    Process-local replica of a collaborative study design map.
+
+    Every worker that has at least one connection to a map holds one replica.
+    Replicas converge because every sync update is fanned out through the
+    channel layer group of the room and applied by every worker (applying the
+    same Yjs update twice is a no-op).
+
+    Changes are persisted incrementally: observers on the `nodes` and `edges`
+    maps collect the ids changed since the last flush, and a background task
+    flushes them once the room has been idle for REGISTRY_ROOM_FLUSH_IDLE
+    seconds, or at the latest REGISTRY_ROOM_FLUSH_MAX_DELAY seconds after the
+    first unflushed change. Each flush also stores the binary updates collected
+    since the last one.
+
+    Only changes made by local clients are persisted. Updates relayed from
+    other workers (`apply_remote`) are persisted by the worker they come from,
+    so every change is written once whatever the number of replicas. An edge
+    drawn here to a node added on another worker can thus be flushed before
+    that node is; it stays dirty until the node is written. Such edges and
+    failed flushes are retried, with the delay doubling from
+    REGISTRY_ROOM_FLUSH_IDLE up to REGISTRY_ROOM_FLUSH_MAX_DELAY seconds.
+
+    For accounting, the room records when it last saw a message and the size
+    of its encoded document (refreshed by each sweep, see `sweep`).
+
+    Awareness messages (cursors, online users) from local clients are not sent
+    to the group one by one. They are coalesced per awareness client for
+    REGISTRY_ROOM_AWARENESS_WINDOW seconds, so only the latest state of each
+    client is forwarded, and at most REGISTRY_ROOM_AWARENESS_RATE of them per
+    second leave the replicas of the room on all workers together (see
+    `_take_awareness_budget`); the rest wait, and keep being coalesced, for
+    the next window.
+    """
+
+    name: str
+    ydoc: Doc
+    persist: Persist
+    # Channel names of the local consumers, in the order they joined
+    connections: dict[str, None] = field(default_factory=dict)
+    dirty_nodes: set[str] = field(default_factory=set)
+    dirty_edges: set[str] = field(default_factory=set)
+    last_activity: float = field(default_factory=time.monotonic)
+    size: int = 0
+
+    def __post_init__(self):
+        nodes = self.ydoc.get('nodes', type=Map)
+        edges = self.ydoc.get('edges', type=Map)
+        self._subscriptions = [
+            (nodes, nodes.observe(self._mark_nodes_dirty)),
+            (edges, edges.observe(self._mark_edges_dirty)),
+            (self.ydoc, self.ydoc.observe(self._collect_update)),
+        ]
+        # Set while an update from another worker is applied
+        self._remote = False
+        # Binary updates of the local changes since the last flush
+        self._updates: list[bytes] = []
+        self._changed = asyncio.Event()
+        self._first_change = 0.0
+        self._last_change = 0.0
+        # Delay of the next retry, 0 while flushes succeed
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        self._flush_lock = asyncio.Lock()
+        self._persister = asyncio.create_task(self._run_persister())
+        # Latest pending awareness message per awareness client(s)
+        self._awareness: dict[tuple[int, ...] | bytes, bytes] = {}
+        self._awareness_sender: asyncio.Task | None = None
+
+    @property
+    def responder(self) -> str | None:
+        """The local consumer that answers state requests from other workers."""
+        return next(iter(self.connections), None)
+
+    def touch(self) -> None:
+        self.last_activity = time.monotonic()
+
+    def apply_remote(self, message: bytes) -> None:
+        """Apply a sync update relayed from another worker, which persists it."""
+        self._remote = True
+        try:
+            apply_remote_message(self.ydoc, message)
+        finally:
+            self._remote = False
+
+    def _collect_update(self, event: TransactionEvent) -> None:
+        if not self._remote:
+            self._updates.append(event.update)
+
+    def _mark_nodes_dirty(self, event: MapEvent) -> None:
+        self._mark_dirty(self.dirty_nodes, event.keys)
+
+    def _mark_edges_dirty(self, event: MapEvent) -> None:
+        self._mark_dirty(self.dirty_edges, event.keys)
+
+    def _mark_dirty(self, ids: set[str], keys) -> None:
+        if self._remote:
+            return
+        now = asyncio.get_running_loop().time()
+        if not self._changed.is_set():
+            self._first_change = now
+        self._last_change = now
+        ids.update(keys)
+        self._changed.set()
+
+    async def _run_persister(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+            while True:
+                deadline = max(min(self._last_change + settings.REGISTRY_ROOM_FLUSH_IDLE,
+                                   self._first_change + settings.REGISTRY_ROOM_FLUSH_MAX_DELAY),
+                               self._retry_at)
+                if loop.time() >= deadline:
+                    break
+                await asyncio.sleep(deadline - loop.time())
+            self._changed.clear()
+            # Shielded so that closing the room never interrupts a write half way
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        """Persist the local changes to nodes and edges since the last flush."""
+        async with self._flush_lock:
+            if not self.dirty_nodes and not self.dirty_edges and not self._updates:
+                return
+            node_ids, edge_ids = set(self.dirty_nodes), set(self.dirty_edges)
+            updates = self._updates
+            self.dirty_nodes.clear()
+            self.dirty_edges.clear()
+            self._updates = []
+            try:
+                pending = await self.persist(self.ydoc, merge_updates(*updates) if updates else b'', node_ids, edge_ids)
+            except Exception:
+                # Keep the changes so that the retry writes them
+                logger.exception('Persisting room %s failed', self.name)
+                self.dirty_nodes.update(node_ids)
+                self.dirty_edges.update(edge_ids)
+                self._updates[:0] = updates
+                self._retry()
+                return
+            if pending:
+                self.dirty_edges.update(pending)
+                self._retry()
+            else:
+                self._retry_delay = 0.0
+
+    def _retry(self) -> None:
+        now = asyncio.get_running_loop().time()
+        self._retry_delay = min(2 * self._retry_delay or settings.REGISTRY_ROOM_FLUSH_IDLE, settings.REGISTRY_ROOM_FLUSH_MAX_DELAY)
+        self._retry_at = now + self._retry_delay
+        if not self._changed.is_set():
+            self._first_change = self._last_change = now
+        self._changed.set()
+
+    def queue_awareness(self, message: bytes) -> None:
+        """Queue an awareness message from a local client, replacing its pending one."""
+        self._awareness[awareness_client_ids(message) or message] = message
+        if self._awareness_sender is None or self._awareness_sender.done():
+            self._awareness_sender = asyncio.create_task(self._send_awareness())
+
+    async def _send_awareness(self) -> None:
+        channel_layer = get_channel_layer()
+        while self._awareness:
+            await asyncio.sleep(settings.REGISTRY_ROOM_AWARENESS_WINDOW)
+            for _ in range(await _take_awareness_budget(self.name, len(self._awareness))):
+                message = self._awareness.pop(next(iter(self._awareness)))
+                await channel_layer.group_send(self.name, {  # type: ignore
+                    'type': 'send_message',
+                    'message': message,
+                    'origin': PROCESS_ID,
+                })
+
+    async def close(self, save: bool = True) -> None:
+        """Stop the background tasks and flush what is left."""
+        if self._awareness_sender is not None:
+            self._awareness_sender.cancel()
+        self._persister.cancel()
+        try:
+            await self._persister
+        except asyncio.CancelledError:
+            pass
+        if save:
+            await self.flush()
+        for root, subscription in self._subscriptions:
+            root.unobserve(subscription)
+
+
+# -----------------------------------------------------------------------------
+# Shared room state: all consumers in the same process share these replicas
+# Key: room_name, Value: Room
+
+_rooms: dict[str, Room] = {}
+_room_locks: dict[str, asyncio.Lock] = {}
+
+
+def _lock(name: str) -> asyncio.Lock:
+    return _room_locks.setdefault(name, asyncio.Lock())
+
+
+def get(name: str) -> Room | None:
+    return _rooms.get(name)
+
+
+def stats() -> list[dict]:
+    """Connection count, encoded size, idle time and unsaved changes of the rooms of this process."""
+    now = time.monotonic()
+    return [{
+        'room': room.name,
+        'connections': len(room.connections),
+        'size': room.size,
+        'idle': now - room.last_activity,
+        'dirty': len(room.dirty_nodes) + len(room.dirty_edges),
+    } for room in _rooms.values()]
+
+
+async def join(name: str, channel_name: str, make_ydoc: Callable[[], Awaitable[Doc]], persist: Persist) -> Room:
+    """
+    Register a local connection to a room, opening the room if needed.
+
+    A cold room is initialised from a live replica on another worker when one
+    exists, and from the database (`make_ydoc`) otherwise. The caller must
+    already be in the room's channel layer group so that no update sent while
+    the room is opening is missed. `persist` is used by the room to write its
+    changes.
+    """
+    if _shutting_down:
+        raise ShuttingDown(name)
+    async with _lock(name):
+        if _shutting_down:
+            raise ShuttingDown(name)
+        room = _rooms.get(name)
+        if room is None:
+            update = await request_peer_state(name)
+            if update is not None:
+                ydoc = Doc()
+                ydoc.apply_update(update)
+            else:
+                ydoc = await make_ydoc()
+            room = _rooms[name] = Room(name=name, ydoc=ydoc, persist=persist)
+            room.size = len(ydoc.get_update())
+            await _hold(name)
+        room.connections[channel_name] = None
+        room.touch()
+        _ensure_sweeper()
+        return room
+
+
+async def leave(name: str, channel_name: str, save: bool = True) -> None:
+    """
+    Unregister a local connection and close the room after the last one.
+
+    The replica stays registered while the remaining changes are flushed so
+    that a connection arriving in the meantime waits for the save instead of
+    reading stale rows.
+    """
+    async with _lock(name):
+        room = _rooms.get(name)
+        if room is None:
+            return
+        room.connections.pop(channel_name, None)
+        if room.connections:
+            return
+        await room.close(save)
+        del _rooms[name]
+        _room_locks.pop(name, None)
+        await _release(name)
+
+
+async def evict(name: str) -> None:
+    """
+    Persist and close a room whatever its connection count.
+
+    Local connections that are still registered are told to close
+    (`room.evicted`); their clients reconnect and reopen the room. Connections
+    whose disconnect was missed are simply dropped.
+    """
+    async with _lock(name):
+        room = _rooms.get(name)
+        if room is None:
+            return
+        await room.close()
+        del _rooms[name]
+        _room_locks.pop(name, None)
+        await _release(name)
+
+    channel_layer = get_channel_layer()
+    for channel_name in room.connections:
+        await channel_layer.send(channel_name, {'type': 'room.evicted', 'code': RECONNECT_CODE})  # type: ignore
+
+
+# -----------------------------------------------------------------------------
+# Idle and memory eviction
+#
+# Every REGISTRY_ROOM_SWEEP_INTERVAL seconds the rooms of this process are
+# measured. Rooms without activity for REGISTRY_ROOM_IDLE_TTL seconds are
+# evicted, and if the encoded size of all rooms exceeds
+# REGISTRY_ROOM_MEMORY_LIMIT bytes, the least recently active rooms are evicted
+# until it does not.
+
+_sweeper: asyncio.Task | None = None
+
+
+def _ensure_sweeper() -> None:
+    global _sweeper
+    if _sweeper is None or _sweeper.done() or _sweeper.get_loop() is not asyncio.get_running_loop():
+        _sweeper = asyncio.create_task(_run_sweeper())
+
+
+async def _run_sweeper() -> None:
+    while True:
+        await asyncio.sleep(settings.REGISTRY_ROOM_SWEEP_INTERVAL)
+        try:
+            await sweep()
+        except Exception:
+            logger.exception('Sweeping rooms failed')
+
+
+async def sweep() -> None:
+    for room in list(_rooms.values()):
+        room.size = len(room.ydoc.get_update())
+        await _refresh(room.name)
+
+    now = time.monotonic()
+    for room in [room for room in _rooms.values() if now - room.last_activity > settings.REGISTRY_ROOM_IDLE_TTL]:
+        logger.info('Evicting idle room %s', room.name)
+        await evict(room.name)
+
+    rooms = sorted(_rooms.values(), key=lambda room: room.last_activity)
+    total = sum(room.size for room in rooms)
+    while rooms and total > settings.REGISTRY_ROOM_MEMORY_LIMIT:
+        room = rooms.pop(0)
+        logger.warning('Evicting room %s (%d bytes) over the memory limit', room.name, room.size)
+        total -= room.size
+        await evict(room.name)
+
+    logger.debug('%d rooms, %d connections, %d bytes', len(_rooms), sum(len(room.connections) for room in _rooms.values()), total)
+
+
+# -----------------------------------------------------------------------------
+# Graceful shutdown
+#
+# When a worker is stopped (e.g. on deploy), it stops accepting connections to
+# rooms and evicts all of them: at most REGISTRY_ROOM_SHUTDOWN_CONCURRENCY rooms
+# are flushed at the same time, so that the saves do not all hit the database
+# at once, and their clients are told to reconnect.
+
+_shutting_down = False
+
+
+async def shutdown() -> None:
+    """Refuse new joins, then persist and close every room of this process."""
+    global _shutting_down
+    _shutting_down = True
+    if _sweeper is not None:
+        _sweeper.cancel()
+
+    semaphore = asyncio.Semaphore(settings.REGISTRY_ROOM_SHUTDOWN_CONCURRENCY)
+
+    async def close(name):
+        async with semaphore:
+            try:
+                await evict(name)
+            except Exception:
+                logger.exception('Closing room %s on shutdown failed', name)
+
+    names = list(_rooms)
+    logger.info('Closing %d rooms on shutdown', len(names))
+    await asyncio.gather(*(close(name) for name in names))
+
+
+def install_shutdown_handler() -> None:
+    """
+    Close the rooms before Daphne stops when the process receives SIGTERM or SIGINT.
+
+    Daphne cancels all application instances as soon as its reactor begins to
+    stop, so the rooms are closed first and the reactor is stopped afterwards.
+    Outside of Daphne (tests, management commands) this does nothing.
+    """
+    if 'twisted.internet.reactor' not in sys.modules:
+        return
+    from twisted.internet import reactor
+    from twisted.internet.error import ReactorNotRunning
+
+    def stop_reactor(*args):
+        try:
+            reactor.stop()  # type: ignore
+        except ReactorNotRunning:
+            pass
+
+    def install():
+        loop = asyncio.get_event_loop()
+
+        def stop(signum, frame):
+            if _shutting_down:
+                # Second signal: stop right away
+                loop.call_soon_threadsafe(stop_reactor)
+            else:
+                loop.call_soon_threadsafe(lambda: asyncio.ensure_future(shutdown()).add_done_callback(stop_reactor))
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    # Replaces the handlers the reactor installs when it starts running
+    reactor.callWhenRunning(install)
+
+
+# -----------------------------------------------------------------------------
+# Holders
+#
+# The cache, shared by all workers in production, counts the workers that hold
+# a replica of each room. A worker opening a cold room only asks for the state
+# of a live replica when the count says another worker holds one, instead of
+# waiting REGISTRY_ROOM_STATE_TIMEOUT seconds for an answer that never comes.
+# The count expires unless the sweep of a holder refreshes it, so that workers
+# which died without releasing their rooms are eventually forgotten; until
+# then, a cold open just waits for the timeout.
+
+def _holders_key(name: str) -> str:
+    return f'registry:room-holders:{name}'
+
+
+def _holders_timeout() -> int:
+    return 3 * settings.REGISTRY_ROOM_SWEEP_INTERVAL
+
+
+async def holders(name: str) -> int:
+    """The number of workers that hold a replica of a room."""
+    return await cache.aget(_holders_key(name)) or 0
+
+
+async def _hold(name: str) -> None:
+    key = _holders_key(name)
+    await cache.aadd(key, 0, timeout=_holders_timeout())
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        # Expired in between
+        await cache.aset(key, 1, timeout=_holders_timeout())
+
+
+async def _release(name: str) -> None:
+    try:
+        await cache.adecr(_holders_key(name))
+    except ValueError:
+        pass
+
+
+async def _refresh(name: str) -> None:
+    key = _holders_key(name)
+    if not await cache.atouch(key, _holders_timeout()):
+        # Expired although this worker still holds the room
+        await _hold(name)
+
+
+# -----------------------------------------------------------------------------
+# Awareness budget
+#
+# The awareness messages a room may forward per window are counted in the
+# cache, shared by all workers in production, so the rate limit holds for the
+# room as a whole however many workers hold a replica. Windows are aligned to
+# the clock, so all workers count against the same one.
+
+async def _take_awareness_budget(name: str, wanted: int) -> int:
+    """Take up to `wanted` of the messages a room may forward in the current window, returns how many."""
+    window = settings.REGISTRY_ROOM_AWARENESS_WINDOW
+    budget = max(1, int(settings.REGISTRY_ROOM_AWARENESS_RATE * window))
+    key = f'registry:room-awareness:{name}:{int(time.time() // window)}'
+    # Whole seconds, and long enough to outlive the window
+    timeout = int(window) + 2
+    await cache.aadd(key, 0, timeout=timeout)
+    try:
+        taken = await cache.aincr(key, wanted)
+    except ValueError:
+        # Expired in between
+        await cache.aset(key, wanted, timeout=timeout)
+        taken = wanted
+    return max(0, min(wanted, budget - (taken - wanted)))
+
+
+# -----------------------------------------------------------------------------
+# Cross-process synchronisation
+
+def apply_remote_message(ydoc: Doc, message: bytes) -> None:
+    """Apply a sync update relayed from another worker to the local replica."""
+    if (len(message) > 1 and message[0] == YMessageType.SYNC and
+            message[1] in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE)):
+        handle_sync_message(message[1:], ydoc)
+
+
+def awareness_client_ids(message: bytes) -> tuple[int, ...]:
+    """Return the awareness client ids an awareness message carries states for (empty if malformed)."""
+    try:
+        decoder = Decoder(Decoder(message[1:]).read_message() or b'')
+        client_ids = []
+        for _ in range(decoder.read_var_uint()):
+            client_ids.append(decoder.read_var_uint())
+            decoder.read_var_uint()  # clock
+            decoder.read_var_string()  # state
+        return tuple(client_ids)
+    except (IndexError, RuntimeError, UnicodeDecodeError):
+        return ()
+
+
+async def request_peer_state(name: str) -> bytes | None:
+    """
+    Ask the other workers for the encoded state of a live room.
+
+    Returns the first reply, or None if no worker answers within
+    REGISTRY_ROOM_STATE_TIMEOUT seconds. No request is made when no other
+    worker holds the room, or with the in-memory channel layer, which has no
+    other workers.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or isinstance(channel_layer, InMemoryChannelLayer):
+        return None
+    if not await holders(name):
+        return None
+
+    reply_channel = await channel_layer.new_channel()
+    await channel_layer.group_send(name, {
+        'type': 'room.state_request',
+        'origin': PROCESS_ID,
+        'reply_channel': reply_channel,
+    })
+    try:
+        message = await asyncio.wait_for(channel_layer.receive(reply_channel), timeout=settings.REGISTRY_ROOM_STATE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    return message['update']
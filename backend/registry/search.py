@@ -0,0 +1,185 @@
+import functools
+from typing import Iterable
+
+from django.db import connection, transaction
+from django.db.models import Count, F, FloatField, Q, Window
+from django.db.models.functions import Cast, Greatest, RowNumber
+from django.contrib.postgres.search import CombinedSearchQuery, SearchQuery, SearchRank, TrigramWordSimilarity
+
+from . import models
+
+Kind = models.SearchEntry.Kind
+
+
+# -----------------------------------------------------------------------------
+# Queries
+
+def tokenize(text: str | None) -> list[str]:
+    """The tokens of user input that are searched, see parse_query()."""
+    REMOVE_CHARS = "()|&:*!<>'\\"
+    MIN_QUERY_LENGTH = 2
+    query_string = (text or '').strip().translate({ord(i): " " for i in REMOVE_CHARS}).strip()
+    return [token.strip() for token in query_string.split() if len(token.strip()) >= MIN_QUERY_LENGTH]
+
+
+def parse_query(text: str | None) -> SearchQuery | CombinedSearchQuery | None:
+    """
+    Turn user input into a prefix query: every token of at least two characters
+    must match the beginning of a word. Returns None if nothing is left to search.
+    """
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    return functools.reduce(lambda a, b: a & b, [SearchQuery(f'{token}:*', search_type='raw') for token in tokens])
+
+
+def search(site, text: str | None, limit: int = 5) -> dict[Kind, list[models.SearchEntry]]:
+    """
+    Search all kinds of entries of a site in one query.
+
+    Returns the best `limit` hits of each kind that matched, ranked, in the
+    order of Kind. Each hit has its `rank` and the `total` number of hits of its
+    kind.
+    """
+    query = parse_query(text)
+    if query is None:
+        return {}
+
+    rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+    hits = models.SearchEntry.objects.filter(site=site, search_vector=query).annotate(
+        rank=rank,
+        position=Window(RowNumber(), partition_by=[F('kind')], order_by=[rank.desc(), F('title').asc(), F('id').asc()]),
+        total=Window(Count('id'), partition_by=[F('kind')]),
+    ).filter(position__lte=limit).order_by('kind', 'position')
+
+    results = {kind: [] for kind in Kind}
+    for hit in hits:
+        results[Kind(hit.kind)].append(hit)
+    return {kind: kind_hits for kind, kind_hits in results.items() if kind_hits}
+
+
+def suggest(site, kind: Kind, text: str | None, limit: int, similarity: float) -> list[models.SearchEntry]:
+    """
+    Typeahead: the entries of a kind whose title or keywords (e.g. the short
+    name of an organisation) contain words similar to `text`, best first.
+
+    Matching is by trigram word similarity, so it tolerates typos and partly
+    typed words. The `%>` operator is served by the trigram indexes on title and
+    keywords and compares against the pg_trgm.word_similarity_threshold, which
+    is set to `similarity` for the query only.
+    """
+    MIN_QUERY_LENGTH = 2
+    text = (text or '').strip()
+    if len(text) < MIN_QUERY_LENGTH:
+        return []
+
+    with transaction.atomic():  # type: ignore
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(similarity)])
+        return list(models.SearchEntry.objects.filter(
+            Q(title__trigram_word_similar=text) | Q(keywords__trigram_word_similar=text),
+            site=site, kind=kind,
+        ).annotate(
+            similarity=Greatest(TrigramWordSimilarity(text, 'title'), TrigramWordSimilarity(text, 'keywords')),
+        ).order_by('-similarity', 'title', 'id')[:limit])
+
+
+# -----------------------------------------------------------------------------
+# Indexing
+#
+# The entries of an object are rebuilt from the database rather than from the
+# saved instance, so the builders below see committed relations (sites,
+# archived flags) and can run for any number of objects at once.
+
+def _resource_entries(ids=None, parent_id=None) -> Iterable[models.SearchEntry]:
+    resources = models.Resource.objects.filter(archived=False)
+    if ids is not None:
+        resources = resources.filter(pk__in=ids)
+    for resource in resources.values('id', 'site_id', 'name', 'description'):
+        yield models.SearchEntry(
+            site_id=resource['site_id'], kind=Kind.RESOURCE, object_id=resource['id'],
+            title=resource['name'], keywords=resource['id'], body=resource['description'] or '',
+        )
+
+
+def _study_design_entries(ids=None, parent_id=None) -> Iterable[models.SearchEntry]:
+    study_designs = models.StudyDesign.objects.filter(archived=False)
+    if ids is not None:
+        study_designs = study_designs.filter(pk__in=ids)
+    for study_design in study_designs.values('id', 'site_id', 'name', 'description'):
+        yield models.SearchEntry(
+            site_id=study_design['site_id'], kind=Kind.STUDY_DESIGN, object_id=study_design['id'],
+            title=study_design['name'], keywords=study_design['id'], body=study_design['description'] or '',
+        )
+
+
+def _node_entries(ids=None, parent_id=None) -> Iterable[models.SearchEntry]:
+    nodes = models.StudyDesignNode.objects.filter(study_design__archived=False)
+    if ids is not None:
+        nodes = nodes.filter(pk__in=ids)
+    if parent_id is not None:
+        nodes = nodes.filter(study_design_id=parent_id)
+    for node in nodes.values('id', 'study_design_id', 'study_design__site_id', 'study_design__name', 'name', 'description'):
+        yield models.SearchEntry(
+            site_id=node['study_design__site_id'], kind=Kind.NODE, object_id=node['id'], parent_id=node['study_design_id'],
+            title=node['name'], body=node['description'] or '', context=node['study_design__name'],
+        )
+
+
+def _person_entries(ids=None, parent_id=None) -> Iterable[models.SearchEntry]:
+    memberships = models.Person.sites.through.objects.all()  # type: ignore
+    if ids is not None:
+        memberships = memberships.filter(person_id__in=ids)
+    for membership in memberships.values('site_id', 'person_id', 'person__user__first_name', 'person__user__last_name', 'person__user__username', 'person__orcid'):
+        name = f"{membership['person__user__first_name']} {membership['person__user__last_name']}".strip()
+        yield models.SearchEntry(
+            site_id=membership['site_id'], kind=Kind.PERSON, object_id=membership['person_id'],
+            title=name or membership['person__user__username'], keywords=membership['person__orcid'] or '',
+        )
+
+
+def _organisation_entries(ids=None, parent_id=None) -> Iterable[models.SearchEntry]:
+    memberships = models.Organisation.sites.through.objects.all()  # type: ignore
+    if ids is not None:
+        memberships = memberships.filter(organisation_id__in=ids)
+    for membership in memberships.values('site_id', 'organisation_id', 'organisation__name', 'organisation__short_name', 'organisation__ror'):
+        yield models.SearchEntry(
+            site_id=membership['site_id'], kind=Kind.ORGANISATION, object_id=membership['organisation_id'],
+            title=membership['organisation__name'],
+            keywords=' '.join(filter(None, [membership['organisation__short_name'], membership['organisation__ror']])),
+            context=membership['organisation__short_name'],
+        )
+
+
+_BUILDERS = {
+    Kind.RESOURCE: _resource_entries,
+    Kind.STUDY_DESIGN: _study_design_entries,
+    Kind.NODE: _node_entries,
+    Kind.PERSON: _person_entries,
+    Kind.ORGANISATION: _organisation_entries,
+}
+
+
+def reindex(kind: Kind, ids: Iterable[str] | None = None, parent_id: str | None = None) -> None:
+    """
+    Rebuild the search entries of the given objects of a kind.
+
+    All objects of the kind are reindexed if neither `ids` nor `parent_id` (the
+    study design of nodes) is given. Objects that were deleted or archived lose
+    their entries.
+    """
+    ids = list(ids) if ids is not None else None
+    with transaction.atomic():  # type: ignore
+        entries = models.SearchEntry.objects.filter(kind=kind)
+        if ids is not None:
+            entries = entries.filter(object_id__in=ids)
+        if parent_id is not None:
+            entries = entries.filter(parent_id=parent_id)
+        entries.delete()
+        models.SearchEntry.objects.bulk_create(_BUILDERS[kind](ids, parent_id), batch_size=1000)
+
+
+def rebuild() -> None:
+    """Rebuild the entries of all objects."""
+    for kind in Kind:
+        reindex(kind)
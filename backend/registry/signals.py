@@ -0,0 +1,276 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from django.db import transaction
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import caching
+from . import models
+from . import search
+from .consumers import person_group_name
+
+
+# -----------------------------------------------------------------------------
+# Site membership
+#
+# Map connections cache the site membership of their person. When the sites of
+# a person change, their connections are told to re-check it.
+#
+# One receiver per membership relation (Person.sites, Organisation.sites) also
+# keeps the search entries, the index page counters and the cached fragments
+# of the members and sites concerned current, so they are only worked out once.
+
+def notify_membership_changed(person_ids):
+    """Make the open map connections of the given people re-check their site membership."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    for person_id in person_ids:
+        async_to_sync(channel_layer.group_send)(person_group_name(person_id), {'type': 'membership.changed'})
+
+
+def _site_memberships_changed(kind, model, related_name, instance, action, reverse, pk_set):
+    """
+    Reindex, bump the counters and fragments of a change to the sites of
+    `model` objects. Returns the ids of the members whose sites change, after
+    an add or a remove and before a clear.
+    """
+    if action == 'pre_clear':
+        # The cleared memberships are unknown after the clear
+        if reverse:
+            member_ids = list(getattr(instance, related_name).values_list('id', flat=True))
+            site_ids = [instance.id]
+        else:
+            member_ids = [instance.id]
+            site_ids = list(instance.sites.values_list('id', flat=True))
+        instance._cleared_member_ids = member_ids
+    elif action == 'post_clear':
+        search.reindex(kind, instance.__dict__.pop('_cleared_member_ids', []))
+        return []
+    elif action in ('post_add', 'post_remove'):
+        member_ids, site_ids = (list(pk_set), [instance.id]) if reverse else ([instance.id], list(pk_set))
+        search.reindex(kind, member_ids)
+    else:
+        return []
+    caching.bump('counters', site_ids)
+    # The fragments show the sites of the members
+    caching.bump('fragments', _site_ids(model, member_ids) | set(site_ids))
+    return member_ids
+
+
+@receiver(m2m_changed, sender=models.Person.sites.through)  # type: ignore
+def person_sites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    person_ids = _site_memberships_changed(search.Kind.PERSON, models.Person, 'person_set', instance, action, reverse, pk_set)
+    if person_ids:
+        transaction.on_commit(lambda: notify_membership_changed(person_ids))
+
+
+@receiver(m2m_changed, sender=models.Organisation.sites.through)  # type: ignore
+def organisation_sites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _site_memberships_changed(search.Kind.ORGANISATION, models.Organisation, 'organisation_set', instance, action, reverse, pk_set)
+
+
+@receiver(post_delete, sender=models.Person)
+def person_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: notify_membership_changed([instance.id]))
+
+
+# -----------------------------------------------------------------------------
+# Search
+#
+# Keeps the search entries of an object current when it is saved (for its site
+# memberships, see above). Writes that bypass signals (QuerySet.update(),
+# bulk_create()) must call search.reindex() themselves, see
+# consumers.save_ydoc. `manage.py rebuild_search_index` rebuilds everything.
+
+@receiver(post_save, sender=models.Resource)
+@receiver(post_delete, sender=models.Resource)
+def resource_changed(sender, instance, **kwargs):
+    search.reindex(search.Kind.RESOURCE, [instance.id])
+
+
+@receiver(post_save, sender=models.StudyDesign)
+def study_design_saved(sender, instance, **kwargs):
+    search.reindex(search.Kind.STUDY_DESIGN, [instance.id])
+    # The nodes show the name of their study design and follow its archived flag
+    search.reindex(search.Kind.NODE, parent_id=instance.id)
+
+
+@receiver(post_delete, sender=models.StudyDesign)
+def study_design_deleted(sender, instance, **kwargs):
+    search.reindex(search.Kind.STUDY_DESIGN, [instance.id])
+    search.reindex(search.Kind.NODE, parent_id=instance.id)
+
+
+@receiver(post_save, sender=models.StudyDesignNode)
+@receiver(post_delete, sender=models.StudyDesignNode)
+def study_design_node_changed(sender, instance, **kwargs):
+    search.reindex(search.Kind.NODE, [instance.id])
+
+
+@receiver(post_save, sender=models.Person)
+@receiver(post_delete, sender=models.Person)
+def person_changed(sender, instance, **kwargs):
+    search.reindex(search.Kind.PERSON, [instance.id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields == {'last_login'}:
+        # Every sign in saves the user, the names do not change
+        return
+    # Names live on the user
+    person_ids = list(models.Person.objects.filter(user=instance).values_list('id', flat=True))
+    if person_ids:
+        search.reindex(search.Kind.PERSON, person_ids)
+
+
+@receiver(post_save, sender=models.Organisation)
+@receiver(post_delete, sender=models.Organisation)
+def organisation_changed(sender, instance, **kwargs):
+    search.reindex(search.Kind.ORGANISATION, [instance.id])
+
+
+# -----------------------------------------------------------------------------
+# Caches
+#
+# Start a new generation of the cached resource listings (see
+# views.get_resources_page) and the index page counters (views.get_site_counters)
+# of a site when anything they are computed from changes.
+
+@receiver(post_save, sender=models.Resource)
+@receiver(post_delete, sender=models.Resource)
+def resource_changed_cache(sender, instance, **kwargs):
+    caching.bump('resources', [instance.site_id])
+    caching.bump('counters', [instance.site_id])
+
+
+@receiver(post_save, sender=models.StudyDesign)
+@receiver(post_delete, sender=models.StudyDesign)
+def study_design_changed_cache(sender, instance, **kwargs):
+    caching.bump('counters', [instance.site_id])
+
+
+@receiver(post_save, sender=models.Contributor)
+@receiver(post_delete, sender=models.Contributor)
+def contributor_changed(sender, instance, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(models.Resource).id:
+        caching.bump('resources', models.Resource.objects.filter(pk=instance.object_id).values_list('site_id', flat=True))
+
+
+@receiver(m2m_changed, sender=models.Resource.groups.through)  # type: ignore
+def resource_groups_changed(sender, instance, action, **kwargs):
+    # Resources and groups belong to one site, either one is the instance
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        caching.bump('resources', [instance.site_id])
+
+
+@receiver(m2m_changed, sender=models.Organisation.people.through)  # type: ignore
+def organisation_people_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # The organisation filter goes through the people of the organisation
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        organisation_ids = [instance.id]
+    elif action == 'pre_clear':
+        organisation_ids = list(instance.organisations.values_list('id', flat=True))
+    else:
+        organisation_ids = list(pk_set)
+    caching.bump('resources', models.Organisation.sites.through.objects.filter(organisation_id__in=organisation_ids).values_list('site_id', flat=True))  # type: ignore
+
+
+@receiver(pre_delete, sender=models.Person)
+@receiver(pre_delete, sender=models.Organisation)
+def site_member_deleted_cache(sender, instance, **kwargs):
+    # Deleting removes the site memberships without m2m_changed
+    caching.bump('counters', instance.sites.values_list('id', flat=True))
+
+
+# -----------------------------------------------------------------------------
+# Fragments
+#
+# Cached template fragments are keyed by the `updated` time of the object they
+# show and the `fragments` generation of the site (see the `cache` blocks in
+# the templates). Saving the object itself changes the key; anything else a
+# fragment shows (a related object, a relation) starts a new generation of
+# the sites concerned. So do deletions, for the HTTP validators of the pages
+# (see caching.validators).
+
+def _site_ids(model, pks):
+    """The sites the objects of `model` with the given primary keys belong to."""
+    if model is Site:
+        return set(pks)
+    if issubclass(model, models.SiteMixin):
+        return set(model.objects.filter(pk__in=pks).values_list('site_id', flat=True))
+    if issubclass(model, models.SitesMixin):
+        through = model.sites.through.objects.filter(**{f'{model._meta.model_name}_id__in': pks})  # type: ignore
+        return set(through.values_list('site_id', flat=True))
+    if model is User:
+        return _site_ids(models.Person, models.Person.objects.filter(user__in=pks).values('pk'))
+    return set()
+
+
+def _instance_site_ids(instance):
+    if isinstance(instance, models.SiteMixin):
+        return {instance.site_id}  # type: ignore
+    if isinstance(instance, models.ResourceFile):
+        return _site_ids(models.Resource, [instance.resource_id])  # type: ignore
+    if isinstance(instance, models.Contributor):
+        return _site_ids(ContentType.objects.get_for_id(instance.content_type_id).model_class(), [instance.object_id])  # type: ignore
+    return _site_ids(type(instance), [instance.pk])
+
+
+# Deletions are handled before the fact, while the site memberships still exist
+@receiver(pre_delete, sender=models.Resource)
+@receiver(pre_delete, sender=models.StudyDesign)
+@receiver(post_save, sender=models.StudyDesignCollection)
+@receiver(pre_delete, sender=models.StudyDesignCollection)
+@receiver(post_save, sender=models.Group)
+@receiver(pre_delete, sender=models.Group)
+@receiver(post_save, sender=models.ResourceStatus)
+@receiver(pre_delete, sender=models.ResourceStatus)
+@receiver(post_save, sender=models.License)
+@receiver(pre_delete, sender=models.License)
+@receiver(post_save, sender=models.PersonRole)
+@receiver(pre_delete, sender=models.PersonRole)
+@receiver(post_save, sender=models.ResourceFile)
+@receiver(pre_delete, sender=models.ResourceFile)
+@receiver(post_save, sender=models.Contributor)
+@receiver(pre_delete, sender=models.Contributor)
+@receiver(post_save, sender=models.Organisation)
+@receiver(pre_delete, sender=models.Organisation)
+@receiver(post_save, sender=models.Person)
+@receiver(pre_delete, sender=models.Person)
+@receiver(post_save, sender=User)
+@receiver(pre_delete, sender=User)
+def related_object_changed_fragments(sender, instance, update_fields=None, **kwargs):
+    if update_fields == {'last_login'}:
+        # Every sign in saves the user, nothing shown changes
+        return
+    caching.bump('fragments', _instance_site_ids(instance))  # type: ignore
+
+
+@receiver(m2m_changed, sender=models.Resource.groups.through)  # type: ignore
+@receiver(m2m_changed, sender=models.StudyDesign.groups.through)  # type: ignore
+@receiver(m2m_changed, sender=models.Group.people.through)  # type: ignore
+@receiver(m2m_changed, sender=models.Organisation.people.through)  # type: ignore
+def relation_changed_fragments(sender, instance, action, model, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is None for a clear, but the cleared objects are still related
+        pk_set = list(getattr(instance, _accessor(instance, sender)).values_list('pk', flat=True))
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        caching.bump('fragments', _instance_site_ids(instance) | _site_ids(model, pk_set))  # type: ignore
+
+
+def _accessor(instance, through):
+    """The name of the many-to-many manager of `instance` that goes through `through`."""
+    for field in instance._meta.get_fields():
+        if field.many_to_many and field.concrete and field.remote_field.through is through:
+            return field.name
+        if field.many_to_many and not field.concrete and field.through is through:
+            return field.get_accessor_name()
+    raise LookupError(f'{type(instance).__name__} has no relation through {through.__name__}')
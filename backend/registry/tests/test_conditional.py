@@ -0,0 +1,73 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry.models import Group, Person, Resource, ResourceStatus
+
+
+class ConditionalGetTests(TestCase):
+    """Tests for the ETag and Last-Modified validators of the pages and the API."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.status = ResourceStatus.objects.create(site=self.site, name='Draft')
+        self.resource = Resource.objects.create(site=self.site, name='Gold nanoparticles', kind=Resource.Kind.MATERIAL, status=self.status)
+        self.user = User.objects.create_user(username='member@example.com')
+        Person.objects.create(user=self.user).sites.add(self.site)
+        self.client.force_login(self.user)
+
+    def get(self, url, response=None):
+        """GET the url, conditionally on the ETag of an earlier response."""
+        headers = {'If-None-Match': response['ETag']} if response else {}
+        return self.client.get(url, headers=headers)
+
+    def test_unchanged_page_is_not_rendered(self):
+        url = reverse('registry:resource', args=[self.resource.id])
+        response = self.get(url)
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with self.assertTemplateNotUsed('registry/resource.html'):
+            self.assertEqual(self.get(url, response).status_code, 304)
+
+    def test_changes_are_seen(self):
+        url = reverse('registry:resource', args=[self.resource.id])
+        response = self.get(url)
+
+        self.resource.save()
+        response = self.get(url, response)
+        self.assertEqual(response.status_code, 200)
+
+        # Relations do not change the updated time of either side
+        self.resource.groups.add(Group.objects.create(site=self.site, name='Inhalation'))
+        response = self.get(url, response)
+        self.assertContains(response, 'Inhalation')
+
+    def test_deletions_are_seen(self):
+        # Older than the other resource, deleting it leaves the latest updated time as it is
+        old = Resource.objects.create(site=self.site, name='Old', kind=Resource.Kind.DATA, status=self.status)
+        Resource.objects.filter(pk=old.pk).update(updated=self.resource.updated.replace(year=2000))
+
+        response = self.get(reverse('registry:resources'))
+        old.delete()
+        self.assertNotContains(self.get(reverse('registry:resources'), response), 'Old')
+
+    def test_validators_are_per_user_and_representation(self):
+        url = reverse('registry:resources')
+        response = self.get(url)
+        self.assertNotEqual(self.client.get(url, headers={'HX-Request': 'true'})['ETag'], response['ETag'])
+
+        other = User.objects.create_user(username='other@example.com')
+        Person.objects.create(user=other).sites.add(self.site)
+        self.client.force_login(other)
+        self.assertEqual(self.get(url, response).status_code, 200)
+
+    def test_api(self):
+        for url in [reverse('resource-list'), reverse('resource-detail', args=[self.resource.id]), reverse('resourcestatus-list')]:
+            response = self.get(url)
+            self.assertEqual(self.get(url, response).status_code, 304)
+
+            self.status.name = 'Final'
+            self.status.save()
+            self.assertEqual(self.get(url, response).status_code, 200)
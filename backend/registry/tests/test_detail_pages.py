@@ -0,0 +1,106 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry.models import (
+    Contributor,
+    Group,
+    License,
+    Organisation,
+    Person,
+    PersonRole,
+    Resource,
+    ResourceFile,
+    ResourceStatus,
+    StudyDesign,
+)
+
+
+class DetailPageQueriesTests(TestCase):
+    """
+    Tests that the detail pages run the same number of queries however many
+    people, contributors, groups, ... they list.
+    """
+
+    # Queries of every request of a signed in member: the session, the user
+    # (twice, for the audit log and the site membership check), the audit log
+    # entry, the person and its site membership
+    REQUEST_QUERIES = 7
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='other.example.com', name='Other')
+        self.role = PersonRole.objects.create(site=self.site, name='Author')
+        self.license = License.objects.create(name='CC BY 4.0')
+        self.license.sites.add(self.site)
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE')
+        self.organisation.sites.add(self.site)
+        self.group = Group.objects.create(site=self.site, name='Inhalation')
+        self.resource = Resource.objects.create(
+            site=self.site, name='Gold nanoparticles', kind=Resource.Kind.MATERIAL,
+            status=ResourceStatus.objects.create(site=self.site, name='Draft'), license=self.license,
+        )
+        self.person = self.add_member(0)
+        self.client.force_login(self.person.user)
+
+    def add_member(self, n):
+        """A person on the site who is in the organisation and group, and contributes to the resource."""
+        person = Person.objects.create(user=User.objects.create_user(username=f'member{n}@example.com', email=f'member{n}@example.com', first_name=f'Member {n}'))
+        person.sites.add(self.site)
+        self.organisation.people.add(person)
+        self.group.people.add(person)
+        Contributor.objects.create(content_object=self.resource, person=person, role=self.role)
+
+        organisation = Organisation.objects.create(name=f'Organisation {n}', short_name=f'O{n}', country='DE')
+        organisation.sites.add(self.site)
+        organisation.people.add(person)
+        group = Group.objects.create(site=self.site, name=f'Group {n}')
+        group.people.add(person)
+        group.resources.add(self.resource)
+        StudyDesign.objects.create(site=self.site, name=f'Study {n}').groups.add(self.group)
+        resource = Resource.objects.create(site=self.site, name=f'Resource {n}', kind=Resource.Kind.DATA, status=self.resource.status)
+        resource.groups.add(self.group)
+        Contributor.objects.create(content_object=resource, person=self.person if n else person, role=self.role)
+        ResourceFile.objects.create(resource=self.resource, file=f'resources/files/{self.resource.id}/data-{n}.csv')
+        return person
+
+    def assertQueriesStayTheSame(self, url, queries):
+        # Warms up what every page loads once per process (the current site)
+        self.client.get(url)
+        with self.assertNumQueries(self.REQUEST_QUERIES + queries):
+            self.client.get(url)
+        for n in range(1, 6):
+            self.add_member(n)
+        with self.assertNumQueries(self.REQUEST_QUERIES + queries):
+            response = self.client.get(url)
+        return response
+
+    def test_resource_page(self):
+        response = self.assertQueriesStayTheSame(reverse('registry:resource', args=[self.resource.id]), 5)
+        self.assertContains(response, 'Member 5')
+        self.assertContains(response, 'data-5.csv')
+
+    def test_person_page(self):
+        # Contributing in a second role does not list the resource twice
+        Contributor.objects.create(content_object=self.resource, person=self.person, role=PersonRole.objects.create(site=self.site, name='Reviewer'))
+
+        response = self.assertQueriesStayTheSame(reverse('registry:person', args=[self.person.id]), 5)
+        self.assertContains(response, 'Organisation 0')
+        self.assertEqual(len(response.context['resources']), 7)
+
+    def test_organisation_page(self):
+        response = self.assertQueriesStayTheSame(reverse('registry:organisation', args=[self.organisation.id]), 3)
+        self.assertContains(response, 'Member 5')
+
+    def test_group_page(self):
+        response = self.assertQueriesStayTheSame(reverse('registry:group', args=[self.group.id]), 5)
+        self.assertContains(response, 'Study 5')
+        self.assertContains(response, 'Resource 5')
+
+    def test_other_sites_are_not_listed(self):
+        member = self.add_member(1)
+        member.sites.set([self.other_site])
+
+        response = self.client.get(reverse('registry:organisation', args=[self.organisation.id]))
+        self.assertEqual(response.context['people'], [self.person])
@@ -0,0 +1,73 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry import caching
+from backend.registry.models import Group, Organisation, Person, Resource, ResourceStatus
+
+
+class FragmentCacheTests(TestCase):
+    """Tests for the cached template fragments of the listings and the resource page."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.person = Person.objects.create(user=User.objects.create_user(username='member@example.com', first_name='Goldie', last_name='Hawn'))
+        self.person.sites.add(self.site)
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE')
+        self.organisation.sites.add(self.site)
+        self.organisation.people.add(self.person)
+        self.resource = Resource.objects.create(
+            site=self.site, name='Gold nanoparticles', kind=Resource.Kind.MATERIAL,
+            status=ResourceStatus.objects.create(site=self.site, name='Draft'),
+        )
+        self.client.force_login(self.person.user)
+
+    def test_rows_are_served_from_the_cache(self):
+        self.assertContains(self.client.get(reverse('registry:people')), 'IOG')
+
+        # Bypasses the signals, so the cached row is still current
+        Organisation.objects.filter(pk=self.organisation.pk).update(short_name='GOLD')
+        self.assertContains(self.client.get(reverse('registry:people')), 'IOG')
+
+        self.organisation.refresh_from_db()
+        self.organisation.save()
+        self.assertContains(self.client.get(reverse('registry:people')), 'GOLD')
+
+    def test_rows_follow_their_object(self):
+        self.assertContains(self.client.get(reverse('registry:resources')), 'Gold nanoparticles')
+
+        self.resource.name = 'Silver nanoparticles'
+        self.resource.save()
+        self.assertContains(self.client.get(reverse('registry:resources')), 'Silver nanoparticles')
+
+    def test_relations_start_a_new_generation(self):
+        url = reverse('registry:resource', args=[self.resource.id])
+        self.assertNotContains(self.client.get(url), 'Inhalation')
+
+        self.resource.groups.add(Group.objects.create(site=self.site, name='Inhalation'))
+        self.assertContains(self.client.get(url), 'Inhalation')
+
+        self.person.user.first_name = 'Silvie'
+        self.person.user.save()
+        self.assertContains(self.client.get(reverse('registry:people')), 'Silvie Hawn')
+
+    def test_clearing_a_relation_reaches_the_sites_of_the_cleared_objects(self):
+        other_site = Site.objects.create(domain='other.example.com', name='Other')
+        self.person.sites.add(other_site)
+        group = Group.objects.create(site=self.site, name='Inhalation')
+        group.people.add(self.person)
+
+        generation = caching.generation('fragments', other_site.id)
+        group.people.clear()
+        self.assertNotEqual(caching.generation('fragments', other_site.id), generation)
+
+        generation = caching.generation('fragments', other_site.id)
+        self.organisation.people.add(self.person)
+        self.person.organisations.clear()
+        self.assertNotEqual(caching.generation('fragments', other_site.id), generation)
+
+    def test_sign_in_keeps_the_generation(self):
+        generation = caching.generation('fragments', self.site.id)
+        self.client.force_login(self.person.user)
+        self.assertEqual(caching.generation('fragments', self.site.id), generation)
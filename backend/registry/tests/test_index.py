@@ -0,0 +1,50 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry import views
+from backend.registry.models import Organisation, Person, Resource, ResourceStatus, StudyDesign
+
+
+class SiteCountersTests(TestCase):
+    """Tests for the cached counters of the index page."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='other.example.com', name='Other')
+        self.status = ResourceStatus.objects.create(site=self.site, name='Draft')
+        self.person = Person.objects.create(user=User.objects.create_user(username='member@example.com'))
+        self.person.sites.add(self.site)
+        self.resource = Resource.objects.create(site=self.site, name='Gold nanoparticles', kind=Resource.Kind.MATERIAL, status=self.status)
+        StudyDesign.objects.create(site=self.site, name='Inhalation study')
+        StudyDesign.objects.create(site=self.site, name='Old study', archived=True)
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE')
+        self.organisation.sites.add(self.site, self.other_site)
+
+    def test_counters_are_computed_once(self):
+        with self.assertNumQueries(1):
+            counters = views.get_site_counters(self.site)
+        self.assertEqual(counters, {'resources': 1, 'study_designs': 1, 'organisations': 1, 'people': 1})
+
+        with self.assertNumQueries(0):
+            views.get_site_counters(self.site)
+
+    def test_counters_follow_changes(self):
+        views.get_site_counters(self.site)
+
+        self.resource.archived = True
+        self.resource.save()
+        self.organisation.sites.clear()
+        Person.objects.create(user=User.objects.create_user(username='other@example.com')).sites.add(self.site)
+
+        self.assertEqual(views.get_site_counters(self.site), {'resources': 0, 'study_designs': 1, 'organisations': 0, 'people': 2})
+
+        self.person.delete()
+        self.assertEqual(views.get_site_counters(self.site)['people'], 1)
+
+    def test_index_page(self):
+        self.client.force_login(self.person.user)
+
+        response = self.client.get(reverse('registry:index'))
+        self.assertEqual(response.context['counters']['resources'], 1)
@@ -0,0 +1,71 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry import views
+from backend.registry.models import Group, Organisation, Person
+
+
+@override_settings(REGISTRY_LISTING_PAGE_SIZE=2)
+class ListingTests(TestCase):
+    """Tests for the paginated people, organisations and use cases listings."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE')
+        self.organisation.sites.add(self.site)
+        self.group = Group.objects.create(site=self.site, name='Inhalation')
+        for first_name, last_name in [('anna', 'Smith'), ('Bob', 'Jones'), ('Cecil', 'Brown'), ('', ''), ('Chloe', 'Green')]:
+            person = Person.objects.create(user=User.objects.create_user(username=f'{first_name or "dora"}@example.com', first_name=first_name, last_name=last_name))
+            person.sites.add(self.site)
+            self.organisation.people.add(person)
+            self.group.people.add(person)
+        self.client.force_login(User.objects.get(username='anna@example.com'))
+
+    def names(self, response):
+        return [str(item) for item in response.context['items']]
+
+    def test_pages_are_loaded_on_scroll(self):
+        response = self.client.get(reverse('registry:people'))
+        self.assertEqual(self.names(response), ['anna Smith', 'Bob Jones'])
+        self.assertContains(response, 'IOG')
+
+        names = self.names(response)
+        while response.context['next_page_url']:
+            response = self.client.get(response.context['next_page_url'], headers={'HX-Request': 'true'})
+            self.assertTemplateUsed(response, 'registry/partials/resource_listing_rows.html')
+            self.assertTemplateNotUsed(response, 'registry/people.html')
+            names += self.names(response)
+        self.assertEqual(names, ['anna Smith', 'Bob Jones', 'Cecil Brown', 'Chloe Green', 'dora@example.com'])
+
+    def test_page_queries_do_not_grow_with_the_rows(self):
+        # Warms up what every page loads once per process (the current site)
+        self.client.get(reverse('registry:people'))
+
+        # Those of the request (see DetailPageQueriesTests), the validators,
+        # the page, the organisations and use cases of its people, the index
+        with self.assertNumQueries(12):
+            self.client.get(reverse('registry:people'), {'letter': 'C'})
+        organisation = Organisation.objects.create(name='Institute of Silver', short_name='IOS', country='DE')
+        organisation.sites.add(self.site)
+        organisation.people.add(*Person.objects.all())
+        with self.assertNumQueries(12):
+            self.assertContains(self.client.get(reverse('registry:people'), {'letter': 'C'}), 'IOS')
+
+    def test_jump_index(self):
+        response = self.client.get(reverse('registry:people'), {'letter': 'c'})
+        self.assertEqual(response.context['index'], [
+            {'letter': 'A', 'count': 1},
+            {'letter': 'B', 'count': 1},
+            {'letter': 'C', 'count': 2},
+            {'letter': 'D', 'count': 1},
+        ])
+        self.assertEqual(self.names(response), ['Cecil Brown', 'Chloe Green'])
+
+        with self.assertNumQueries(1):
+            views.get_listing_index(Group.objects.annotate(sort_key=views.Lower('name')))
+
+    def test_organisations_and_groups(self):
+        self.assertEqual(self.names(self.client.get(reverse('registry:organisations'))), ['Institute of Gold'])
+        self.assertEqual(self.names(self.client.get(reverse('registry:groups'))), ['Inhalation'])
@@ -0,0 +1,41 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+
+from backend.registry.consumers import person_group_name
+from backend.registry.models import Person, Project
+
+
+class MembershipChangedSignalTests(TestCase):
+    """Open map connections are notified when the sites of their person change."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.project = Project.objects.create(site=self.site, slug='test-membership')
+        self.person = Person.objects.create(user=User.objects.create_user(username='alice@example.com'))
+        self.person.sites.add(self.site)
+
+        self.channel_layer = get_channel_layer()
+        self.channel_name = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(person_group_name(self.person.id), self.channel_name)
+
+    def tearDown(self):
+        async_to_sync(self.channel_layer.flush)()
+
+    def receive(self):
+        return async_to_sync(self.channel_layer.receive)(self.channel_name)
+
+    def test_removing_site_notifies_connections(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.person.sites.remove(self.site)
+
+        self.assertEqual(self.receive(), {'type': 'membership.changed'})
+
+    def test_removing_person_from_site_side_notifies_connections(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.site.person_set.clear()
+
+        self.assertEqual(self.receive(), {'type': 'membership.changed'})
@@ -0,0 +1,279 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry import views
+from backend.utils import QueryTimeout, statement_timeout
+from backend.registry.forms import HarmonisedJsonFilterField
+from backend.registry.models import Contributor, Group, Organisation, Person, PersonRole, Resource, ResourceStatus
+
+
+class ResourceSetup(TestCase):
+    """Shared setUp for tests listing and searching the resources of a site."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.request = RequestFactory().get('/registry/resources/')
+        self.status = ResourceStatus.objects.create(site=self.site, name='Draft')
+        user = User.objects.create_user(username='member@example.com', email='member@example.com')
+        Person.objects.create(user=user).sites.add(self.site)
+        self.client.force_login(user)
+
+    def create_resource(self, name, description=None, **kwargs):
+        kwargs.setdefault('kind', Resource.Kind.MATERIAL)
+        return Resource.objects.create(site=self.site, name=name, description=description, status=self.status, **kwargs)
+
+    def search(self, search, **filters):
+        return list(views.get_resources(self.request, {'search': search, **filters}))
+
+
+class ResourceSearchTests(ResourceSetup):
+    """Tests for the full-text search of resources through the stored search vector."""
+
+    def test_matches_prefixes_of_name_description_and_id(self):
+        nanoparticle = self.create_resource('Gold nanoparticles')
+        protocol = self.create_resource('Protocol', 'Dispersion of titanium dioxide')
+
+        self.assertEqual(self.search('nanopart'), [nanoparticle])
+        self.assertEqual(self.search('titan dioxide'), [protocol])
+        self.assertEqual(self.search(protocol.id), [protocol])
+        self.assertEqual(self.search('silver'), [])
+
+    def test_results_are_ranked_by_relevance(self):
+        in_description = self.create_resource('Protocol', 'Dispersion of gold nanoparticles')
+        in_name = self.create_resource('Gold nanoparticles')
+
+        self.assertEqual(self.search('gold'), [in_name, in_description])
+
+    def test_vector_follows_bulk_updates(self):
+        resource = self.create_resource('Gold nanoparticles')
+        Resource.objects.filter(pk=resource.pk).update(name='Silver nanowires')
+
+        self.assertEqual(self.search('gold'), [])
+        self.assertEqual(self.search('silver'), [resource])
+
+    def test_name_is_weighted_above_description(self):
+        resource = self.create_resource('Gold', 'Dust')
+        resource.refresh_from_db()
+
+        self.assertIn("'gold':1A", resource.search_vector)
+        self.assertIn("'dust':2B", resource.search_vector)
+
+
+@override_settings(REGISTRY_RESOURCES_PAGE_SIZE=2)
+class ResourcesListingTests(ResourceSetup):
+    """Tests for the keyset-paginated resources listing."""
+
+    def get_all_pages(self, url):
+        names = []
+        response = self.client.get(url)
+        while True:
+            names += [resource.name for resource in response.context['resources']]
+            if not response.context['next_page_url']:
+                return names
+            response = self.client.get(response.context['next_page_url'], headers={'HX-Request': 'true'})
+            self.assertTemplateUsed(response, 'registry/partials/resource_rows.html')
+
+    def test_pages_cover_all_resources_once(self):
+        for name in ['Epsilon', 'Alpha', 'Delta', 'Beta', 'Gamma']:
+            self.create_resource(name)
+        # Same name: the order is decided by the kind, then the id
+        self.create_resource('Beta', kind=Resource.Kind.DATA)
+
+        self.assertEqual(self.get_all_pages(reverse('registry:resources')), ['Alpha', 'Beta', 'Beta', 'Delta', 'Epsilon', 'Gamma'])
+
+    def test_ranked_search_pages(self):
+        for i in range(3):
+            self.create_resource(f'Protocol {i}', 'Gold nanoparticles')
+            self.create_resource(f'Gold {i}')
+
+        names = self.get_all_pages(reverse('registry:resources') + '?search=gold')
+        self.assertEqual(names, ['Gold 0', 'Gold 1', 'Gold 2', 'Protocol 0', 'Protocol 1', 'Protocol 2'])
+
+    @override_settings(REGISTRY_RESOURCES_PAGE_SIZE=10)
+    def test_page_query_count_does_not_depend_on_its_rows(self):
+        role = PersonRole.objects.create(site=self.site, name='Author')
+        organisations = [
+            Organisation.objects.create(name=f'Institute {i}', short_name=f'I{i}', country='DE')
+            for i in range(2)
+        ]
+
+        def add_resources(count):
+            for i in range(count):
+                person = Person.objects.create(user=User.objects.create_user(username=f'author-{Person.objects.count()}@example.com'))
+                person.organisations.set(organisations[:i % 2 + 1])
+                Contributor.objects.create(content_object=self.create_resource(f'Resource {i}'), person=person, role=role)
+
+        def get_page():
+            # Not from the cached page or rows
+            cache.clear()
+            resources = views.get_resources_page(self.request, None, None)[0]
+            return [[organisation.short_name for organisation in resource.contributor_organisations] for resource in resources]
+
+        add_resources(2)
+        with self.assertNumQueries(9):
+            self.assertEqual(get_page(), [['I0'], ['I0', 'I1']])
+
+        add_resources(4)
+        with self.assertNumQueries(9):
+            self.assertEqual(len(get_page()), 6)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('registry:resources') + '?after=forged', headers={'HX-Request': 'true'})
+        self.assertEqual(response.status_code, 400)
+
+
+class HarmonisedJsonFilterTests(ResourceSetup):
+    """Tests for filtering resources by the containment of their harmonised data."""
+
+    def setUp(self):
+        super().setUp()
+        self.nanomaterial = self.create_resource('Nanomaterial', harmonised_json={'MaterialType': {'Value': 'Nanomaterial'}})
+        self.polymer = self.create_resource('Polymer', harmonised_json={'MaterialType': {'Value': 'Polymer'}})
+        self.data = self.create_resource('Measurements', kind=Resource.Kind.DATA, harmonised_json={'Protocol': {'ProtocolId': self.polymer.id, 'ProtocolName': 'Dispersion'}})
+
+    def test_field_parses_path_terms_and_objects(self):
+        field = HarmonisedJsonFilterField(required=False)
+
+        self.assertEqual(field.clean('MaterialType.Value=Nanomaterial; Size=5'), {'MaterialType': {'Value': 'Nanomaterial'}, 'Size': 5})
+        self.assertEqual(field.clean('{"Protocol": {"ProtocolId": "abc"}}'), {'Protocol': {'ProtocolId': 'abc'}})
+        self.assertIsNone(field.clean(''))
+        for invalid in ['MaterialType', '{"a": ', '[1]', 'a=1; a.b=2']:
+            with self.assertRaises(ValidationError):
+                field.clean(invalid)
+
+    def test_listing_filters_by_path(self):
+        self.assertEqual(list(views.get_resources(self.request, {'harmonised_json': {'MaterialType': {'Value': 'Polymer'}}})), [self.polymer])
+
+    def test_api_filters_by_kind_and_path(self):
+        response = self.client.get(reverse('resource-list'), {'kind': 'DATA', 'harmonised_json': f'Protocol.ProtocolId={self.polymer.id}'})
+        self.assertEqual([resource['id'] for resource in response.json()], [self.data.id])
+
+        response = self.client.get(reverse('resource-list'), {'harmonised_json': '{"MaterialType": '})
+        self.assertEqual(response.status_code, 400)
+
+
+class ResourceFacetTests(ResourceSetup):
+    """Tests for the organisation filter and the counts shown next to the options of the resource filters."""
+
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(site=self.site, name='Inhalation')
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE')
+        self.organisation.sites.add(self.site)
+        person = Person.objects.create(user=User.objects.create_user(username='goldie@example.com'))
+        self.organisation.people.add(person)
+
+        self.material = self.create_resource('Gold nanoparticles')
+        self.material.groups.add(self.group)
+        self.data = self.create_resource('Gold measurements', kind=Resource.Kind.DATA)
+        self.create_resource('Silver nanowires')
+        for resource in [self.material, self.data]:
+            # Two roles of the same person must not count the resource twice
+            for role_name in ['Author', 'Curator']:
+                Contributor.objects.create(content_object=resource, person=person, role=PersonRole.objects.get_or_create(site=self.site, name=role_name)[0])
+
+    def test_organisation_filter_lists_resources_once(self):
+        self.assertEqual(self.search(None, organisation=self.organisation), [self.data, self.material])
+        self.assertEqual(self.search('nanoparticles', organisation=self.organisation), [self.material])
+
+    def test_counts_exclude_their_own_filter(self):
+        with self.assertNumQueries(1):
+            counts = views.get_resource_facets(self.request, {'kind': Resource.Kind.MATERIAL, 'search': 'gold'})
+
+        self.assertEqual(counts['kind'], {Resource.Kind.MATERIAL: 1, Resource.Kind.DATA: 1})
+        self.assertEqual(counts['status'], {self.status.id: 1})
+        self.assertEqual(counts['group'], {self.group.id: 1})
+        self.assertEqual(counts['organisation'], {self.organisation.id: 1})
+
+    def test_counts_are_shown_with_the_results(self):
+        response = self.client.get(reverse('registry:resources'), {'group': self.group.id}, headers={'HX-Request': 'true'})
+
+        self.assertContains(response, 'hx-swap-oob="true"')
+        self.assertContains(response, 'Material (1)')
+        self.assertContains(response, 'IOG (1)')
+        self.assertContains(response, 'Inhalation (1)')
+
+
+class ResourcesCacheTests(ResourceSetup):
+    """Tests for the cached pages of the resources listing."""
+
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(site=self.site, name='Inhalation')
+        self.nanoparticles = self.create_resource('Gold nanoparticles')
+        self.nanowires = self.create_resource('Gold nanowires')
+
+    def get_page(self, **filters):
+        resources, _, facets = views.get_resources_page(self.request, filters, None)
+        return resources, facets
+
+    def test_repeated_search_loads_only_the_page(self):
+        resources, facets = self.get_page(search='gold nano')
+
+        # Tokens in another order and case select the same resources. The page
+        # and its groups and contributors (no contributors, so no people).
+        with self.assertNumQueries(3):
+            self.assertEqual(self.get_page(search='Nano  gold'), (resources, facets))
+        self.assertEqual(resources, [self.nanoparticles, self.nanowires])
+
+    def test_writes_start_a_new_generation(self):
+        self.get_page(search='gold')
+        self.get_page(group=self.group)
+
+        self.nanowires.name = 'Silver nanowires'
+        self.nanowires.save()
+        self.assertEqual(self.get_page(search='gold')[0], [self.nanoparticles])
+
+        self.nanoparticles.groups.add(self.group)
+        resources, facets = self.get_page(group=self.group)
+        self.assertEqual(resources, [self.nanoparticles])
+        self.assertEqual(facets['group'], {self.group.id: 1})
+
+
+class SearchAsYouTypeTests(ResourceSetup):
+    """Tests for skipping superseded listing requests and for the statement timeout of searches."""
+
+    def get(self, sequence, **params):
+        return self.client.get(reverse('registry:resources'), params, headers={'HX-Request': 'true', 'X-Request-Sequence': sequence})
+
+    def test_superseded_requests_are_skipped(self):
+        self.assertEqual(self.get('stream-a:2', search='gold').status_code, 200)
+
+        response = self.get('stream-a:1', search='gol')
+        self.assertEqual(response.status_code, 204)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.get('stream-b:1', search='gol').status_code, 200)
+        self.assertEqual(self.get('stream-a:3', search='gold n').status_code, 200)
+
+    def test_superseded_requests_skip_the_conditional_get(self):
+        self.create_resource('Gold nanoparticles')
+        etag = self.get('stream-c:2', search='gold')['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('registry:resources'), {'search': 'gol'}, headers={
+                'HX-Request': 'true', 'X-Request-Sequence': 'stream-c:1', 'If-None-Match': etag,
+            })
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse([query for query in queries if 'registry_resource' in query['sql']])
+
+    def test_slow_statements_are_cancelled(self):
+        with self.assertRaises(QueryTimeout):
+            with statement_timeout(0.05):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_sleep(1)')
+
+        # The timeout ended with its transaction
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_sleep(0.1)')
+
+    def test_listing_reports_timeouts(self):
+        with mock.patch.object(views, 'get_resources_page', side_effect=QueryTimeout):
+            response = self.client.get(reverse('registry:resources'), {'search': 'gold'}, headers={'HX-Request': 'true'})
+        self.assertContains(response, 'The search took too long')
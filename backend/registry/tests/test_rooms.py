@@ -0,0 +1,253 @@
+import asyncio
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from channels.layers import get_channel_layer
+from pycrdt import Doc, Encoder, Map, create_awareness_message, create_update_message
+
+from backend.registry import rooms
+
+
+class RoomsTests(SimpleTestCase):
+    """Tests for the process-local room registry shared by YjsConsumer instances."""
+
+    def setUp(self):
+        self.make_ydoc_calls = 0
+        self.persisted = []
+
+    def tearDown(self):
+        rooms._rooms.clear()
+        rooms._room_locks.clear()
+        rooms._shutting_down = False
+        cache.clear()
+
+    async def make_ydoc(self):
+        self.make_ydoc_calls += 1
+        return Doc()
+
+    async def persist(self, ydoc, update, node_ids, edge_ids):
+        self.persisted.append((node_ids, edge_ids))
+        return set()
+
+    # Joining
+
+    async def test_connections_share_one_replica(self):
+        first = await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+        second = await rooms.join('room', 'channel-2', self.make_ydoc, self.persist)
+
+        self.assertIs(first, second)
+        self.assertEqual(self.make_ydoc_calls, 1)
+        self.assertEqual(first.responder, 'channel-1')
+
+    async def test_holders_are_counted_while_the_room_is_open(self):
+        await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+        await rooms.join('room', 'channel-2', self.make_ydoc, self.persist)
+        self.assertEqual(await rooms.holders('room'), 1)
+
+        await rooms.leave('room', 'channel-1')
+        self.assertEqual(await rooms.holders('room'), 1)
+        await rooms.leave('room', 'channel-2')
+        self.assertEqual(await rooms.holders('room'), 0)
+
+    # Leaving
+
+    async def test_last_leave_flushes_and_closes_room(self):
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+        await rooms.join('room', 'channel-2', self.make_ydoc, self.persist)
+        room.ydoc.get('nodes', type=Map)['node'] = {'name': 'Node'}
+
+        await rooms.leave('room', 'channel-1')
+        self.assertEqual(self.persisted, [])
+        self.assertEqual(room.responder, 'channel-2')
+
+        await rooms.leave('room', 'channel-2')
+        self.assertEqual(self.persisted, [({'node'}, set())])
+        self.assertIsNone(rooms.get('room'))
+
+    # Incremental persistence
+
+    @override_settings(REGISTRY_ROOM_FLUSH_IDLE=0.01)
+    async def test_flush_only_touches_changed_ids(self):
+        async def make_ydoc():
+            ydoc = Doc()
+            nodes = ydoc.get('nodes', type=Map)
+            nodes['a'] = {'name': 'A'}
+            nodes['b'] = {'name': 'B'}
+            return ydoc
+
+        room = await rooms.join('room', 'channel-1', make_ydoc, self.persist)
+        nodes = room.ydoc.get('nodes', type=Map)
+        nodes['a'] = {'name': 'A2'}
+        del nodes['b']
+        room.ydoc.get('edges', type=Map)['edge'] = {'source': 'a', 'target': 'c'}
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.persisted, [({'a', 'b'}, {'edge'})])
+
+        await rooms.leave('room', 'channel-1')
+        self.assertEqual(len(self.persisted), 1)
+
+    async def test_only_local_changes_are_persisted(self):
+        updates = []
+
+        async def persist(ydoc, update, node_ids, edge_ids):
+            self.persisted.append((node_ids, edge_ids))
+            updates.append(update)
+
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, persist)
+        remote = Doc()
+        remote.get('nodes', type=Map)['remote'] = {'name': 'Remote'}
+        room.apply_remote(create_update_message(remote.get_update()))
+        room.ydoc.get('nodes', type=Map)['local'] = {'name': 'Local'}
+
+        await rooms.leave('room', 'channel-1')
+        self.assertEqual(self.persisted, [({'local'}, set())])
+        stored = Doc()
+        stored.apply_update(updates[0])
+        self.assertEqual(list(stored.get('nodes', type=Map).keys()), ['local'])
+
+    async def test_remote_changes_alone_are_not_persisted(self):
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+        remote = Doc()
+        remote.get('nodes', type=Map)['remote'] = {'name': 'Remote'}
+        room.apply_remote(create_update_message(remote.get_update()))
+
+        await rooms.leave('room', 'channel-1')
+        self.assertEqual(self.persisted, [])
+
+    @override_settings(REGISTRY_ROOM_FLUSH_IDLE=0.01, REGISTRY_ROOM_FLUSH_MAX_DELAY=0.05)
+    async def test_edges_to_unpersisted_nodes_are_retried(self):
+        async def persist(ydoc, update, node_ids, edge_ids):
+            self.persisted.append((node_ids, edge_ids))
+            # The node of the edge is written by another worker in the meantime
+            return {'edge'} if len(self.persisted) == 1 else set()
+
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, persist)
+        room.ydoc.get('edges', type=Map)['edge'] = {'source': 'a', 'target': 'remote'}
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.persisted, [(set(), {'edge'}), (set(), {'edge'})])
+        self.assertEqual(room.dirty_edges, set())
+
+    @override_settings(REGISTRY_ROOM_FLUSH_IDLE=0.01, REGISTRY_ROOM_FLUSH_MAX_DELAY=0.05)
+    async def test_failed_flushes_are_retried(self):
+        async def persist(ydoc, update, node_ids, edge_ids):
+            self.persisted.append((node_ids, edge_ids))
+            if len(self.persisted) < 3:
+                raise RuntimeError('Database unavailable')
+            return set()
+
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, persist)
+        room.ydoc.get('nodes', type=Map)['node'] = {'name': 'Node'}
+
+        with self.assertLogs('backend.registry.rooms', 'ERROR'):
+            await asyncio.sleep(0.3)
+        self.assertEqual(self.persisted, [({'node'}, set())] * 3)
+        self.assertEqual(room.dirty_nodes, set())
+
+    # Eviction
+
+    @override_settings(REGISTRY_ROOM_IDLE_TTL=60)
+    async def test_idle_room_is_evicted_and_persisted(self):
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+        room.ydoc.get('nodes', type=Map)['node'] = {'name': 'Node'}
+        room.last_activity -= 120
+
+        with self.assertLogs('backend.registry.rooms', 'INFO'):
+            await rooms.sweep()
+
+        self.assertIsNone(rooms.get('room'))
+        self.assertEqual(self.persisted, [({'node'}, set())])
+
+    async def test_least_recently_active_rooms_are_evicted_over_memory_limit(self):
+        async def make_ydoc():
+            ydoc = Doc()
+            ydoc.get('nodes', type=Map)['node'] = {'name': 'Node'}
+            return ydoc
+
+        older = await rooms.join('older', 'channel-1', make_ydoc, self.persist)
+        newer = await rooms.join('newer', 'channel-2', make_ydoc, self.persist)
+        older.last_activity -= 10
+        with override_settings(REGISTRY_ROOM_MEMORY_LIMIT=newer.size), self.assertLogs('backend.registry.rooms', 'WARNING'):
+            await rooms.sweep()
+
+        self.assertIsNone(rooms.get('older'))
+        self.assertIs(rooms.get('newer'), newer)
+        self.assertEqual([stats['room'] for stats in rooms.stats()], ['newer'])
+
+    # Shutdown
+
+    @override_settings(REGISTRY_ROOM_SHUTDOWN_CONCURRENCY=1)
+    async def test_shutdown_persists_rooms_and_refuses_joins(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        for name in ('first', 'second'):
+            room = await rooms.join(name, channel_name, self.make_ydoc, self.persist)
+            room.ydoc.get('nodes', type=Map)[name] = {'name': name}
+
+        with self.assertLogs('backend.registry.rooms', 'INFO'):
+            await rooms.shutdown()
+
+        self.assertEqual(rooms.stats(), [])
+        self.assertCountEqual(self.persisted, [({'first'}, set()), ({'second'}, set())])
+        for _ in range(2):
+            self.assertEqual(await channel_layer.receive(channel_name), {'type': 'room.evicted', 'code': rooms.RECONNECT_CODE})
+        with self.assertRaises(rooms.ShuttingDown):
+            await rooms.join('first', 'channel-2', self.make_ydoc, self.persist)
+
+    # Awareness
+
+    def awareness_message(self, client_id, clock, state):
+        encoder = Encoder()
+        encoder.write_var_uint(1)
+        encoder.write_var_uint(client_id)
+        encoder.write_var_uint(clock)
+        encoder.write_var_string(state)
+        return create_awareness_message(encoder.to_bytes())
+
+    def test_awareness_client_ids(self):
+        self.assertEqual(rooms.awareness_client_ids(self.awareness_message(7, 1, '{}')), (7,))
+        self.assertEqual(rooms.awareness_client_ids(b'\x01\x05'), ())
+
+    @override_settings(REGISTRY_ROOM_AWARENESS_WINDOW=0.05, REGISTRY_ROOM_AWARENESS_RATE=20)
+    async def test_awareness_is_coalesced_per_client_and_rate_limited(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add('room', channel_name)
+        room = await rooms.join('room', 'channel-1', self.make_ydoc, self.persist)
+
+        for clock in range(5):
+            room.queue_awareness(self.awareness_message(1, clock, f'{{"x":{clock}}}'))
+        room.queue_awareness(self.awareness_message(2, 0, '{}'))
+
+        # One message per 50ms window, the latest state of each client
+        first = await channel_layer.receive(channel_name)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), timeout=0.02)
+        second = await channel_layer.receive(channel_name)
+
+        self.assertEqual(first['message'], self.awareness_message(1, 4, '{"x":4}'))
+        self.assertEqual(second['message'], self.awareness_message(2, 0, '{}'))
+        await channel_layer.flush()
+
+    @override_settings(REGISTRY_ROOM_AWARENESS_WINDOW=60, REGISTRY_ROOM_AWARENESS_RATE=0.05)
+    async def test_awareness_budget_is_shared_by_all_workers(self):
+        # Three messages per window, whichever worker sends them
+        self.assertEqual(await rooms._take_awareness_budget('room', 2), 2)
+        self.assertEqual(await rooms._take_awareness_budget('room', 2), 1)
+        self.assertEqual(await rooms._take_awareness_budget('room', 1), 0)
+        self.assertEqual(await rooms._take_awareness_budget('other', 1), 1)
+
+    # Cross-process updates
+
+    def test_remote_update_is_applied_once(self):
+        source = Doc()
+        source.get('nodes', type=Map)['node'] = {'name': 'Node'}
+        message = create_update_message(source.get_update())
+
+        replica = Doc()
+        rooms.apply_remote_message(replica, message)
+        rooms.apply_remote_message(replica, message)
+
+        self.assertEqual(dict(replica.get('nodes', type=Map).items()), {'node': {'name': 'Node'}})
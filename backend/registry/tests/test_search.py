@@ -0,0 +1,133 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.urls import reverse
+
+from backend.registry import search
+from backend.registry.models import (
+    Organisation,
+    Person,
+    Resource,
+    ResourceStatus,
+    SearchEntry,
+    StudyDesign,
+    StudyDesignNode,
+    StudyDesignNodeType,
+)
+
+
+class SearchTests(TestCase):
+    """Tests for the search entries of all kinds and the grouped search over them."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='other.example.com', name='Other')
+        status = ResourceStatus.objects.create(site=self.site, name='Draft')
+
+        self.resource = Resource.objects.create(site=self.site, name='Gold nanoparticles', kind=Resource.Kind.MATERIAL, status=status)
+        self.study_design = StudyDesign.objects.create(site=self.site, name='Gold toxicity study')
+        self.node = StudyDesignNode.objects.create(
+            study_design=self.study_design, type=StudyDesignNodeType.objects.create(site=self.site, name='Exposure', color='#000000'),
+            position_x=0, position_y=0, name='Gold exposure', description='Inhalation',
+        )
+        self.person = Person.objects.create(user=User.objects.create_user(username='goldie@example.com', first_name='Goldie', last_name='Hawn'), orcid='0000-0001-2345-6789')
+        self.person.sites.add(self.site)
+        self.organisation = Organisation.objects.create(name='Institute of Gold', short_name='IOG', country='DE', ror='05gq02987')
+        self.organisation.sites.add(self.site)
+
+    def test_hits_are_grouped_by_kind_in_one_query(self):
+        with self.assertNumQueries(1):
+            results = search.search(self.site, 'gold')
+
+        self.assertEqual(list(results), list(search.Kind))
+        self.assertEqual(results[search.Kind.NODE][0].get_absolute_url(), f'/study-designs/{self.study_design.id}/map/')
+        self.assertEqual(results[search.Kind.NODE][0].context, 'Gold toxicity study')
+
+    def test_hits_are_limited_and_ranked_per_kind(self):
+        status = ResourceStatus.objects.get(site=self.site)
+        Resource.objects.create(site=self.site, name='Protocol', description='Gold dispersion', kind=Resource.Kind.PROTOCOL_SOP, status=status)
+        Resource.objects.create(site=self.site, name='Gold standard', kind=Resource.Kind.DATA, status=status)
+
+        hits = search.search(self.site, 'gold', limit=2)[search.Kind.RESOURCE]
+        self.assertEqual([hit.title for hit in hits], ['Gold nanoparticles', 'Gold standard'])
+        self.assertEqual(hits[0].total, 3)
+
+    def test_keywords_are_searched(self):
+        self.assertEqual([hit.title for hit in search.search(self.site, 'IOG')[search.Kind.ORGANISATION]], ['Institute of Gold'])
+        self.assertEqual([hit.title for hit in search.search(self.site, '0000-0001')[search.Kind.PERSON]], ['Goldie Hawn'])
+
+    def test_entries_follow_changes(self):
+        self.resource.archived = True
+        self.resource.save()
+        self.person.user.first_name = 'Silvie'
+        self.person.user.save()
+        self.organisation.sites.remove(self.site)
+        self.organisation.sites.add(self.other_site)
+
+        results = search.search(self.site, 'gold')
+        self.assertNotIn(search.Kind.RESOURCE, results)
+        self.assertNotIn(search.Kind.ORGANISATION, results)
+        self.assertEqual([hit.title for hit in search.search(self.site, 'silvie')[search.Kind.PERSON]], ['Silvie Hawn'])
+        self.assertEqual(list(search.search(self.other_site, 'gold')), [search.Kind.ORGANISATION])
+
+    def test_sign_in_does_not_reindex(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.person.user.save(update_fields=['last_login'])
+        self.assertFalse([query for query in queries if 'registry_searchentry' in query['sql']])
+
+    def test_study_design_changes_reach_its_nodes(self):
+        self.study_design.name = 'Silver study'
+        self.study_design.save()
+        self.assertEqual(search.search(self.site, 'exposure')[search.Kind.NODE][0].context, 'Silver study')
+
+        self.study_design.delete()
+        self.assertFalse(SearchEntry.objects.filter(kind__in=[search.Kind.STUDY_DESIGN, search.Kind.NODE]).exists())
+
+    def test_rebuild(self):
+        SearchEntry.objects.all().delete()
+        search.rebuild()
+
+        self.assertEqual(SearchEntry.objects.count(), 5)
+
+    def test_page_and_api(self):
+        self.client.force_login(self.person.user)
+
+        response = self.client.get(reverse('registry:search'), {'q': 'gold'}, headers={'HX-Request': 'true'})
+        self.assertTemplateUsed(response, 'registry/partials/search_results.html')
+        self.assertContains(response, 'Institute of Gold')
+
+        response = self.client.get(reverse('search-list'), {'q': 'gold'})
+        self.assertEqual([group['kind'] for group in response.json()], list(search.Kind))
+        self.assertEqual(response.json()[0]['hits'][0]['url'], f'/resources/{self.resource.id}/')
+
+    def test_superseded_page_requests_are_skipped(self):
+        self.client.force_login(self.person.user)
+        headers = lambda sequence: {'HX-Request': 'true', 'X-Request-Sequence': sequence}
+
+        self.assertEqual(self.client.get(reverse('registry:search'), {'q': 'gold'}, headers=headers('search:2')).status_code, 200)
+        response = self.client.get(reverse('registry:search'), {'q': 'gol'}, headers=headers('search:1'))
+        self.assertEqual(response.status_code, 204)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_suggestions_tolerate_typos(self):
+        Person.objects.create(user=User.objects.create_user(username='smith@example.com', first_name='Anna', last_name='Smith')).sites.add(self.site)
+        Organisation.objects.create(name='Swiss Federal Laboratories for Materials Science', short_name='EMPA', country='CH', ror='02x681a42').sites.add(self.site)
+
+        suggest = lambda kind, text: [entry.title for entry in search.suggest(self.site, kind, text, 10, 0.3)]
+        self.assertEqual(suggest(search.Kind.PERSON, 'smiht'), ['Anna Smith'])
+        self.assertEqual(suggest(search.Kind.PERSON, 'gol'), ['Goldie Hawn'])
+        self.assertEqual(suggest(search.Kind.ORGANISATION, 'empa'), ['Swiss Federal Laboratories for Materials Science'])
+        self.assertEqual(suggest(search.Kind.ORGANISATION, 'Institut of Gold'), ['Institute of Gold'])
+        self.assertEqual(suggest(search.Kind.ORGANISATION, 'x'), [])
+        self.assertEqual(search.suggest(self.other_site, search.Kind.PERSON, 'goldie', 10, 0.3), [])
+
+    def test_suggest_api(self):
+        self.client.force_login(self.person.user)
+
+        response = self.client.get(reverse('suggest-list'), {'type': 'organisation', 'q': 'IOG'})
+        self.assertEqual([suggestion['id'] for suggestion in response.json()], [self.organisation.id])
+
+        response = self.client.get(reverse('suggest-list'), {'type': 'group', 'q': 'gold'})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,251 @@
+from django.test import TestCase, override_settings
+from django.contrib.sites.models import Site
+
+from pycrdt import Doc, Map
+
+from backend.registry.models import (
+    Organisation,
+    Project,
+    Resource,
+    ResourceStatus,
+    StudyDesign,
+    StudyDesignEdge,
+    StudyDesignMapUpdate,
+    StudyDesignNode,
+    StudyDesignNodeType,
+)
+
+
+class StudyDesignMapSetup(TestCase):
+    """Shared setUp for tests working with the nodes and edges of a study design map."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.project = Project.objects.create(site=self.site, slug='test-maps')
+        self.study_design = StudyDesign.objects.create(site=self.site, name='Map')
+        self.node_type = StudyDesignNodeType.objects.filter(site=self.site).first()
+        self.organisation = Organisation.objects.create(name='Test Organisation', short_name='TO', country='DE')
+        self.status = ResourceStatus.objects.create(site=self.site, name='Draft')
+        self.resources = [
+            Resource.objects.create(site=self.site, name=f'Resource {i}', kind=Resource.Kind.MATERIAL, status=self.status)
+            for i in range(2)
+        ]
+
+    def add_nodes(self, count):
+        nodes = []
+        for i in range(count):
+            node = StudyDesignNode.objects.create(
+                study_design=self.study_design,
+                type=self.node_type,
+                position_x=i,
+                position_y=-i,
+                name=f'Node {i}',
+                organisation=self.organisation if i % 2 else None,
+            )
+            node.resources.set(self.resources[:i % 3])
+            if nodes:
+                StudyDesignEdge.objects.create(
+                    study_design=self.study_design,
+                    source=nodes[-1],
+                    sourceHandle='right',
+                    target=node,
+                    targetHandle='left',
+                )
+            nodes.append(node)
+        return nodes
+
+
+class StudyDesignToYdocTests(StudyDesignMapSetup):
+    """Tests for building the ydoc dict of a map from the relational rows."""
+
+    def test_matches_per_row_serialisation(self):
+        self.add_nodes(4)
+
+        self.assertEqual(self.study_design.to_ydoc(), {
+            'nodes': dict([(node.id, node.to_ydoc()) for node in self.study_design.nodes.all()]),
+            'edges': dict([(edge.id, edge.to_ydoc()) for edge in self.study_design.edges.all()]),
+        })
+
+    def test_query_count_does_not_depend_on_map_size(self):
+        self.add_nodes(1)
+        with self.assertNumQueries(3):
+            self.study_design.to_ydoc()
+
+        self.add_nodes(20)
+        with self.assertNumQueries(3):
+            self.study_design.to_ydoc()
+
+
+class StudyDesignMapUpdatesTests(TestCase):
+    """Tests for the binary Y.js update log of study design maps."""
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.project = Project.objects.create(site=self.site, slug='test-maps')
+        self.study_design = StudyDesign.objects.create(site=self.site, name='Map')
+
+    def load(self):
+        ydoc = Doc()
+        for update in self.study_design.load_map_updates():
+            ydoc.apply_update(update)
+        return dict(ydoc.get('nodes', type=Map).items())
+
+    def test_no_updates_stored(self):
+        self.assertEqual(self.study_design.load_map_updates(), [])
+
+    @override_settings(REGISTRY_MAP_UPDATES_COMPACT_AFTER=2)
+    def test_log_is_compacted_into_one_snapshot(self):
+        ydoc = Doc()
+        nodes = ydoc.get('nodes', type=Map)
+        state = ydoc.get_state()
+        for name in ['A', 'B', 'C']:
+            nodes[name] = {'name': name}
+            self.study_design.store_map_update(ydoc.get_update(state))
+            state = ydoc.get_state()
+
+        self.assertEqual(StudyDesignMapUpdate.objects.filter(study_design=self.study_design).count(), 1)
+        self.assertEqual(self.load(), {'A': {'name': 'A'}, 'B': {'name': 'B'}, 'C': {'name': 'C'}})
+
+
+class StudyDesignUpdateFromYdocTests(StudyDesignMapSetup):
+    """Tests for writing a ydoc dict back to the relational rows."""
+
+    def scope(self):
+        return {'headers': [(b'host', self.site.domain.encode())]}
+
+    def new_node(self, node_id, name, resources):
+        return {
+            'id': node_id,
+            'type': self.node_type.id,
+            'position': {'x': 10, 'y': 20},
+            'data': {
+                'name': name,
+                'description': None,
+                'organisation': self.organisation.id,
+                'resources': [{'id': resource.id, 'name': resource.name} for resource in resources],
+            }
+        }
+
+    def test_applies_creates_updates_and_deletes(self):
+        first, second, third = self.add_nodes(3)
+        ydoc = self.study_design.to_ydoc()
+
+        del ydoc['nodes'][third.id]
+        ydoc['edges'] = dict([(edge_id, edge) for edge_id, edge in ydoc['edges'].items() if edge['target'] != third.id])
+        ydoc['nodes'][first.id]['data']['name'] = 'Renamed'
+        ydoc['nodes'][first.id]['data']['resources'] = [{'id': self.resources[1].id, 'name': self.resources[1].name}]
+        ydoc['nodes']['newnode'] = self.new_node('newnode', 'New', self.resources)
+        ydoc['edges']['newedge'] = {'id': 'newedge', 'source': second.id, 'sourceHandle': 'right', 'target': 'newnode', 'targetHandle': 'left'}
+
+        self.study_design.update_from_ydoc(self.scope(), ydoc)
+
+        self.assertEqual(self.study_design.to_ydoc(), ydoc)
+
+    def test_unknown_organisation_is_cleared(self):
+        ydoc = {'nodes': {'newnode': self.new_node('newnode', 'New', [])}, 'edges': {}}
+        ydoc['nodes']['newnode']['data']['organisation'] = 'unknown'
+
+        self.study_design.update_from_ydoc(self.scope(), ydoc)
+
+        self.assertIsNone(StudyDesignNode.objects.get(id='newnode').organisation)
+
+    def test_only_given_ids_are_written(self):
+        first, second = self.add_nodes(2)
+        ydoc = self.study_design.to_ydoc()
+        ydoc['nodes'][first.id]['data']['name'] = 'Renamed'
+
+        # The second node is not in the ydoc, but it was not changed either
+        self.study_design.update_from_ydoc(self.scope(), {'nodes': {first.id: ydoc['nodes'][first.id]}, 'edges': {}}, {first.id}, set())
+
+        self.assertEqual(self.study_design.to_ydoc(), ydoc)
+
+    def test_edges_to_missing_nodes_are_left_out(self):
+        first, second = self.add_nodes(2)
+        edge = {'id': 'newedge', 'source': second.id, 'sourceHandle': 'right', 'target': 'remote', 'targetHandle': 'left'}
+
+        pending = self.study_design.update_from_ydoc(self.scope(), {'nodes': {}, 'edges': {'newedge': edge}}, set(), {'newedge'})
+
+        self.assertEqual(pending, {'newedge'})
+        self.assertFalse(StudyDesignEdge.objects.filter(id='newedge').exists())
+
+        edge['target'] = first.id
+        self.assertEqual(self.study_design.update_from_ydoc(self.scope(), {'nodes': {}, 'edges': {'newedge': edge}}, set(), {'newedge'}), set())
+        self.assertTrue(StudyDesignEdge.objects.filter(id='newedge').exists())
+
+    def test_query_count_does_not_depend_on_map_size(self):
+        def rename_all():
+            ydoc = self.study_design.to_ydoc()
+            for node in ydoc['nodes'].values():
+                node['data']['name'] += ' (renamed)'
+                node['data']['resources'] = node['data']['resources'][1:]
+            return ydoc
+
+        self.add_nodes(3)
+        ydoc = rename_all()
+        with self.assertNumQueries(12):
+            self.study_design.update_from_ydoc(self.scope(), ydoc)
+
+        self.add_nodes(30)
+        ydoc = rename_all()
+        with self.assertNumQueries(12):
+            self.study_design.update_from_ydoc(self.scope(), ydoc)
+
+
+class StudyDesignRefreshYdocTests(StudyDesignMapSetup):
+    """Tests for applying changes made to the relational rows outside of the map to a stored ydoc."""
+
+    def ydoc(self):
+        ydoc = Doc()
+        nodes = ydoc.get('nodes', type=Map)
+        edges = ydoc.get('edges', type=Map)
+        doc = self.study_design.to_ydoc()
+        with ydoc.transaction():
+            for key, value in doc['nodes'].items():
+                nodes[key] = {**value, 'selected': True}
+            for key, value in doc['edges'].items():
+                edges[key] = value
+        return ydoc
+
+    def test_up_to_date_ydoc_is_left_alone(self):
+        self.add_nodes(3)
+        self.assertIsNone(self.study_design.refresh_ydoc(self.ydoc()))
+
+    def test_row_changes_are_applied(self):
+        first, second, third = self.add_nodes(3)
+        ydoc = self.ydoc()
+        stored = ydoc.get_update()
+        StudyDesignNode.objects.filter(id=first.id).update(name='Renamed in the admin')
+        self.resources[0].name = 'Renamed resource'
+        self.resources[0].save()
+        self.resources[1].delete()
+        second.organisation = None
+        second.save()
+        third.delete()
+
+        update = self.study_design.refresh_ydoc(ydoc)
+
+        self.assertIsNotNone(update)
+        nodes = dict(ydoc.get('nodes', type=Map).items())
+        self.assertEqual(set(nodes), {first.id, second.id})
+        self.assertEqual(len(ydoc.get('edges', type=Map)), 1)
+        self.assertEqual(nodes[first.id]['data']['name'], 'Renamed in the admin')
+        self.assertEqual(nodes[second.id]['data']['resources'], [{'id': self.resources[0].id, 'name': 'Renamed resource'}])
+        self.assertIsNone(nodes[second.id]['data']['organisation'])
+        # Fields the rows do not hold are kept
+        self.assertTrue(nodes[first.id]['selected'])
+
+        # Stored after the log, the update brings the document up to date
+        replica = Doc()
+        replica.apply_update(stored)
+        replica.apply_update(update)
+        self.assertEqual(dict(replica.get('nodes', type=Map).items()), nodes)
+
+        self.assertIsNone(self.study_design.refresh_ydoc(ydoc))
+
+    def test_fractional_positions_are_kept(self):
+        node, = self.add_nodes(1)
+        ydoc = self.ydoc()
+        nodes = ydoc.get('nodes', type=Map)
+        nodes[node.id] = {**nodes[node.id], 'position': {'x': node.position_x + 0.4, 'y': node.position_y}}
+
+        self.assertIsNone(self.study_design.refresh_ydoc(ydoc))
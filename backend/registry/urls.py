@@ -4,6 +4,7 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('search/', views.search_page, name='search'),
     path('people/', views.people, name='people'),
     path('people/<slug:person_id>/', views.person, name='person'),
     path('organisations/', views.organisations, name='organisations'),
@@ -1,79 +1,265 @@
-import functools
-
+from django.conf import settings
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Count, Exists, F, FloatField, Func, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat, Left, Lower, NullIf, Trim, Upper
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
+from django.utils.cache import add_never_cache_headers
 from django.contrib import messages
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.postgres.search import SearchQuery
+from django.contrib.sites.models import Site
+from django.contrib.postgres.search import SearchRank
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.decorators.vary import vary_on_headers
 
-from backend.utils import get_current_site
+from backend.middleware import skip_superseded
+from backend.utils import QueryTimeout, get_current_site, keyset_paginate, statement_timeout
 
+from . import caching
 from . import models
 from . import forms
-
-
+from . import search
+
+
+def conditional(dependencies):
+    """
+    Answers conditional GETs of a view with 304 Not Modified, before the view
+    runs. `dependencies(request, *args, **kwargs)` returns the querysets of
+    the objects the page shows, see caching.validators(). Browsers are told to
+    revalidate the page on every visit rather than guess its freshness.
+    """
+    def validators(request, *args, **kwargs):
+        # Both validators come from the same query
+        if not hasattr(request, 'registry_validators'):
+            request.registry_validators = caching.validators(
+                get_current_site(request).id,  # type: ignore
+                dependencies(request, *args, **kwargs),
+                # Pages show the user, and HTMX requests get partials
+                [request.user.pk, bool(request.htmx), request.htmx.boosted],
+            )
+        return request.registry_validators
+
+    def decorator(view):
+        return cache_control(private=True, no_cache=True)(condition(
+            etag_func=lambda *args, **kwargs: validators(*args, **kwargs)[0],
+            last_modified_func=lambda *args, **kwargs: validators(*args, **kwargs)[1],
+        )(view))
+
+    return decorator
+
+
+def _count(queryset):
+    # COUNT(*) of a queryset as a scalar subquery
+    return Subquery(queryset.order_by().values(count=Func(Value(1), function='COUNT')))
+
+
+def get_site_counters(site):
+    """
+    The numbers of resources, study designs, organisations and people of a site
+    shown on the index page.
+
+    Computed in one query and cached until one of them changes (see
+    signals.py), so the index page usually needs no aggregate query.
+    """
+    def compute():
+        return Site.objects.filter(pk=site.pk).values(
+            resources=_count(models.Resource.objects.filter(site=site, archived=False)),
+            study_designs=_count(models.StudyDesign.objects.filter(site=site, archived=False)),
+            organisations=_count(models.Organisation.sites.through.objects.filter(site=site)),  # type: ignore
+            people=_count(models.Person.sites.through.objects.filter(site=site)),  # type: ignore
+        ).get()
+
+    return caching.cached('counters', site.pk, None, compute)
+
+
+@conditional(lambda request: [
+    models.Resource.site_objects(request),
+    models.StudyDesign.site_objects(request),
+    models.Group.site_objects(request),
+])
 def index(request):
     return render(request, 'registry/index.html', {
-        'study_designs': models.StudyDesign.site_objects(request).filter(archived=False),
-        'resources': models.Resource.site_objects(request).filter(archived=False),
-        'people': models.Person.site_objects(request).all(),
-        'organisations': models.Organisation.site_objects(request).all(),
+        'counters': get_site_counters(get_current_site(request)),
         'groups': models.Group.site_objects(request).all(),
     })
 
 
+def get_listing_index(queryset):
+    """
+    The initial letters of a listing (see render_listing) with the number of
+    objects under each, in one aggregate query.
+    """
+    return list(
+        queryset.order_by().prefetch_related(None).annotate(letter=Upper(Left('sort_key', 1)))
+        .values('letter').annotate(count=Count('pk')).order_by('letter')
+    )
+
+
+def render_listing(request, template, queryset, sort_key, **context):
+    """
+    Renders an alphabetical listing of people, organisations or use cases, a
+    page at a time.
+
+    The listing is ordered by `sort_key`, the lower-cased name shown, and
+    paginated with keysets like the resources listing. The first page comes
+    with the jump index of the initial letters, and the `letter` parameter
+    starts the listing at a letter. The next pages are loaded on scroll and
+    only render the rows (`partials/resource_listing_rows.html`).
+    """
+    queryset = queryset.annotate(sort_key=sort_key).order_by('sort_key', 'id')
+    letter = request.GET.get('letter')
+    items, next_cursor = keyset_paginate(
+        queryset.filter(sort_key__gte=letter.lower()) if letter else queryset,
+        request.GET.get('after'), settings.REGISTRY_LISTING_PAGE_SIZE,
+    )
+
+    next_page_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['after'] = next_cursor
+        next_page_url = f'{request.path}?{params.urlencode()}'
+
+    context.update(items=items, next_page_url=next_page_url)
+    if request.htmx and not request.htmx.boosted and 'after' in request.GET:
+        # Infinite scroll: only the rows of the next page
+        return render(request, 'registry/partials/resource_listing_rows.html', context)
+
+    return render(request, template, {**context, 'index': get_listing_index(queryset), 'letter': letter})
+
+
+@vary_on_headers('HX-Request')
+@conditional(lambda request: [models.Person.site_objects(request)])
 def people(request):
-    return render(request, 'registry/people.html', {
-        'people': models.Person.site_objects(request).all().select_related('user')
-    })
+    people = models.Person.site_objects(request).select_related('user').prefetch_related(
+        Prefetch('organisations', queryset=models.Organisation.site_objects(request), to_attr='site_organisations'),
+        Prefetch('groups', queryset=models.Group.site_objects(request), to_attr='site_groups'),
+    )
+    # The name shown, see Person.full_name
+    name = Coalesce(NullIf(Trim(Concat('user__first_name', Value(' '), 'user__last_name')), Value('')), 'user__username')
+    return render_listing(
+        request, 'registry/people.html', people, Lower(name),
+        namespace='registry:person', kind='people', layout='twocol',
+    )
+
+
+def load_person(request, person_id):
+    """
+    The person of a person page, with its organisations and groups on the
+    current site, and the resources it contributes to.
+    """
+    person = get_object_or_404(
+        models.Person.site_objects(request).select_related('user').prefetch_related(
+            Prefetch('organisations', queryset=models.Organisation.site_objects(request), to_attr='site_organisations'),
+            Prefetch('groups', queryset=models.Group.site_objects(request), to_attr='site_groups'),
+        ),
+        pk=person_id,
+    )
+    # A semi-join, so that a resource the person contributes to in several
+    # roles is listed once
+    person.site_resources = models.Resource.site_objects(request).filter(
+        Exists(models.Contributor.objects.filter(
+            content_type=ContentType.objects.get_for_model(models.Resource),
+            object_id=OuterRef('pk'),
+            person=person,
+        )),
+        archived=False,
+    )
+    return person
 
 
+@conditional(lambda request, person_id: [
+    models.Person.objects.filter(pk=person_id),
+    models.Resource.site_objects(request).filter(contributors__person=person_id),
+])
 def person(request, person_id):
-    person = get_object_or_404(models.Person.site_objects(request), pk=person_id)
+    person = load_person(request, person_id)
     return render(request, 'registry/person.html', {
         'person': person,
-        'resources': models.Resource.site_objects(request).filter(archived=False, contributors__person=person),
+        'organisations': person.site_organisations,
+        'groups': person.site_groups,
+        'resources': person.site_resources,
     })
 
 
+@vary_on_headers('HX-Request')
+@conditional(lambda request: [models.Organisation.site_objects(request)])
 def organisations(request):
-    return render(request, 'registry/organisations.html', {
-        'organisations': models.Organisation.site_objects(request).all()
-    })
+    return render_listing(
+        request, 'registry/organisations.html', models.Organisation.site_objects(request), Lower('name'),
+        namespace='registry:organisation', kind='organisations',
+    )
+
+
+def load_organisation(request, organisation_id):
+    """The organisation of an organisation page, with its people on the current site."""
+    return get_object_or_404(
+        models.Organisation.site_objects(request).prefetch_related(
+            Prefetch('people', queryset=models.Person.site_objects(request).select_related('user'), to_attr='site_people'),
+        ),
+        pk=organisation_id,
+    )
 
 
+@conditional(lambda request, organisation_id: [models.Organisation.objects.filter(pk=organisation_id)])
 def organisation(request, organisation_id):
-    organisation = get_object_or_404(models.Organisation.site_objects(request), pk=organisation_id)
+    organisation = load_organisation(request, organisation_id)
     return render(request, 'registry/organisation.html', {
         'organisation': organisation,
-        'people': organisation.people.filter(sites=get_current_site(request)),
+        'people': organisation.site_people,
     })
 
 
+@vary_on_headers('HX-Request')
+@conditional(lambda request: [models.Group.site_objects(request)])
 def groups(request):
-    return render(request, 'registry/groups.html', {
-        'groups': models.Group.site_objects(request).all()
-    })
-
-
+    return render_listing(
+        request, 'registry/groups.html', models.Group.site_objects(request), Lower('name'),
+        namespace='registry:group', kind='groups',
+    )
+
+
+def load_group(request, group_id):
+    """
+    The group of a group page, with its people on the current site and its
+    resources and study designs that are not archived.
+    """
+    return get_object_or_404(
+        models.Group.site_objects(request).prefetch_related(
+            Prefetch('people', queryset=models.Person.site_objects(request).select_related('user'), to_attr='site_people'),
+            Prefetch('resources', queryset=models.Resource.site_objects(request).filter(archived=False), to_attr='current_resources'),
+            Prefetch('study_designs', queryset=models.StudyDesign.site_objects(request).filter(archived=False), to_attr='current_study_designs'),
+        ),
+        pk=group_id,
+    )
+
+
+@conditional(lambda request, group_id: [
+    models.Group.objects.filter(pk=group_id),
+    models.Resource.objects.filter(groups=group_id),
+    models.StudyDesign.objects.filter(groups=group_id),
+])
 def group(request, group_id):
-    group = get_object_or_404(models.Group.site_objects(request), pk=group_id)
+    group = load_group(request, group_id)
     return render(request, 'registry/group.html', {
         'group': group,
-        'people': group.people.filter(sites=get_current_site(request)),
-        'resources': models.Resource.site_objects(request).filter(archived=False, groups=group),
-        'study_designs': models.StudyDesign.site_objects(request).filter(archived=False, groups=group),
+        'people': group.site_people,
+        'resources': group.current_resources,
+        'study_designs': group.current_study_designs,
     })
 
 
+@conditional(lambda request: [models.License.site_objects(request)])
 def licenses(request):
     return render(request, 'registry/licenses.html', {
         'licenses': models.License.site_objects(request).all()
     })
 
 
+@conditional(lambda request, license_id: [
+    models.License.objects.filter(pk=license_id),
+    models.Resource.site_objects(request).filter(license=license_id),
+])
 def license(request, license_id):
     license = get_object_or_404(models.License.site_objects(request), pk=license_id)
     return render(request, 'registry/license.html', {
@@ -83,18 +269,21 @@ def license(request, license_id):
 
 
 def get_resources(request, filters=None):
-    queryset = models.Resource.site_objects(request).filter(archived=False).select_related('status').prefetch_related('groups')
+    # The organisations of the listing are those of the contributors, see set_contributor_organisations()
+    queryset = models.Resource.site_objects(request).filter(archived=False).select_related('status').prefetch_related(
+        'groups', 'contributors__person__organisations',
+    )
+    # Ends with the primary key so that the order is deterministic (see keyset_paginate)
+    queryset = queryset.order_by('name', 'kind', 'id')
     if not filters:
         return queryset
     else:
-        if filters.get('search'):
-            REMOVE_CHARS = "()|&:*!"
-            MIN_QUERY_LENGTH = 2
-            query_string = filters.get('search').strip().translate({ord(i): " " for i in REMOVE_CHARS}).strip()
-            tokens = [token.strip() for token in query_string.split() if len(token.strip()) >= MIN_QUERY_LENGTH]
-            if tokens:
-                query = functools.reduce(lambda a, b: a & b, [SearchQuery(f'{token}:*', search_type='raw') for token in tokens])
-                queryset = queryset.filter(Q(id__search=query) | Q(name__search=query) | Q(description__search=query))
+        query = search.parse_query(filters.get('search'))
+        if query is not None:
+            queryset = queryset.filter(search_vector=query).annotate(
+                # ts_rank() is a real, cast so that the value in the page cursor compares exactly
+                rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+            ).order_by('-rank', 'name', 'kind', 'id')
         if filters.get('kind'):
             queryset = queryset.filter(kind=filters.get('kind'))
         if filters.get('group'):
@@ -102,38 +291,203 @@ def get_resources(request, filters=None):
         if filters.get('status'):
             queryset = queryset.filter(status=filters.get('status'))
         if filters.get('organisation'):
-            queryset = queryset.filter(contributors__person__in=filters.get('organisation').people.all())
+            # A semi-join: a resource with several contributors of the
+            # organisation is still listed once
+            queryset = queryset.filter(Exists(models.Contributor.objects.filter(
+                content_type=ContentType.objects.get_for_model(models.Resource),
+                object_id=OuterRef('pk'),
+                person__in=models.Organisation.people.through.objects.filter(organisation=filters.get('organisation')).values('person'),  # type: ignore
+            )))
+        if filters.get('harmonised_json'):
+            queryset = queryset.filter(harmonised_json__contains=filters.get('harmonised_json'))
         return queryset
 
 
+# Filters of ResourceFiltersForm with counts, and the relation they filter by
+RESOURCE_FACETS = {
+    'kind': 'kind',
+    'status': 'status',
+    'group': 'groups',
+    'organisation': 'contributors__person__organisations',
+}
+
+
+def get_resource_facets(request, filters=None):
+    """
+    The number of resources per option of each filter in RESOURCE_FACETS, as
+    {filter: {option: count}}, computed in a single query.
+
+    The counts of a filter are over the resources matching all the other
+    filters, so they are what choosing the option would yield. The grouped
+    counts of all filters are combined with UNION ALL.
+    """
+    filters = filters or {}
+    facets = [
+        get_resources(request, {**filters, name: None}).order_by()
+        .annotate(facet=Value(name), value=F(relation))
+        .values('facet', 'value')
+        .annotate(count=Count('id', distinct=True))
+        for name, relation in RESOURCE_FACETS.items()
+    ]
+
+    counts = {name: {} for name in RESOURCE_FACETS}
+    for row in facets[0].union(*facets[1:], all=True):
+        if row['value'] is not None:
+            counts[row['facet']][row['value']] = row['count']
+    return counts
+
+
+def resource_filters_key(filters):
+    """The filters of ResourceFiltersForm in a canonical form, equal for filters selecting the same resources."""
+    filters = filters or {}
+    return {
+        'search': sorted(token.lower() for token in search.tokenize(filters.get('search'))),
+        'kind': filters.get('kind') or None,
+        **{name: filters[name].pk if filters.get(name) else None for name in ['group', 'status', 'organisation']},
+        'harmonised_json': filters.get('harmonised_json'),
+    }
+
+
+def set_contributor_organisations(resources):
+    """
+    Sets `contributor_organisations` of the resources from their prefetched
+    contributors (see get_resources()), in the order of Resource.organisations.
+    """
+    for resource in resources:
+        organisations = dict([
+            (organisation.id, organisation)
+            for contributor in resource.contributors.all()
+            for organisation in contributor.person.organisations.all()
+        ])
+        resource.contributor_organisations = sorted(organisations.values(), key=lambda organisation: organisation.name)
+
+
+def get_resources_page(request, filters, after):
+    """
+    A page of get_resources() after the `after` cursor, the cursor of the next
+    page and, for the first page, the facet counts.
+
+    The ids of the page, the cursor and the counts are cached per site and
+    filters until a resource, a contributor or a use case is changed (see
+    signals.py), so a repeated search only loads the resources of the page by
+    primary key.
+
+    Raises QueryTimeout if the search takes longer than
+    REGISTRY_SEARCH_STATEMENT_TIMEOUT.
+    """
+    page_size = settings.REGISTRY_RESOURCES_PAGE_SIZE
+    computed = {}
+
+    def compute():
+        with statement_timeout(settings.REGISTRY_SEARCH_STATEMENT_TIMEOUT):
+            computed['resources'], next_cursor = keyset_paginate(get_resources(request, filters), after, page_size)
+            return {
+                'ids': [resource.pk for resource in computed['resources']],
+                'next_cursor': next_cursor,
+                'facets': None if after else get_resource_facets(request, filters),
+            }
+
+    key = {'filters': resource_filters_key(filters), 'after': after, 'page_size': page_size}
+    page = caching.cached('resources', get_current_site(request).id, key, compute)  # type: ignore
+
+    resources = computed.get('resources')
+    if resources is None:
+        resources_by_id = get_resources(request).in_bulk(page['ids'])
+        resources = [resources_by_id[id] for id in page['ids'] if id in resources_by_id]
+    set_contributor_organisations(resources)
+    return resources, page['next_cursor'], page['facets']
+
+
 @vary_on_headers('HX-Request')
+@skip_superseded
+@conditional(lambda request: [models.Resource.site_objects(request)])
 def resources(request):
     filters_form = forms.ResourceFiltersForm(request, request.GET)
 
-    if filters_form.is_valid():
-        resources = get_resources(request, filters_form.cleaned_data)
-        if request.htmx and not request.htmx.boosted:
-            return render(request, 'registry/partials/resources.html', {
-                'resources': resources,
-                'filters_form': filters_form,
-            })
-    else:
-        resources = get_resources(request)
-
-    return render(request, 'registry/resources.html', {
+    filters = filters_form.cleaned_data if filters_form.is_valid() else None
+    try:
+        resources, next_cursor, facets = get_resources_page(request, filters, request.GET.get('after'))
+        timed_out = False
+    except QueryTimeout:
+        resources, next_cursor, facets = [], None, None
+        timed_out = True
+    next_page_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['after'] = next_cursor
+        next_page_url = f'{reverse("registry:resources")}?{params.urlencode()}'
+
+    context = {
         'resources': resources,
+        'next_page_url': next_page_url,
         'filters_form': filters_form,
-    })
+        'timed_out': timed_out,
+    }
 
+    if request.htmx and not request.htmx.boosted and 'after' in request.GET:
+        # Infinite scroll: only the rows of the next page
+        response = render(request, 'registry/partials/resource_rows.html', context)
+    else:
+        if facets is not None:
+            filters_form.set_facet_counts(facets)
 
+        if request.htmx and not request.htmx.boosted:
+            # The filters with their updated counts are swapped in out of band
+            response = render(request, 'registry/partials/resources.html', {**context, 'facets_oob': True})
+        else:
+            response = render(request, 'registry/resources.html', context)
+
+    if timed_out:
+        # Not to be revalidated, the next try may well succeed
+        add_never_cache_headers(response)
+    return response
+
+
+@vary_on_headers('HX-Request')
+@skip_superseded
+def search_page(request):
+    query = request.GET.get('q', '')
+    context = {
+        'query': query,
+        'timed_out': False,
+    }
+    try:
+        with statement_timeout(settings.REGISTRY_SEARCH_STATEMENT_TIMEOUT):
+            context['results'] = search.search(get_current_site(request), query, settings.REGISTRY_SEARCH_HITS_PER_KIND)
+    except QueryTimeout:
+        context.update(results={}, timed_out=True)
+
+    if request.htmx and not request.htmx.boosted:
+        return render(request, 'registry/partials/search_results.html', context)
+
+    return render(request, 'registry/search.html', context)
+
+
+def load_resource(request, resource_id):
+    """
+    The resource of a resource page, with its status, license, groups, files
+    and contributors (with their people and roles).
+    """
+    return get_object_or_404(
+        models.Resource.site_objects(request).select_related('status', 'license').prefetch_related(
+            'groups',
+            'files',
+            Prefetch('contributors', queryset=models.Contributor.objects.select_related('person__user', 'role')),
+        ),
+        pk=resource_id,
+    )
+
+
+@conditional(lambda request, resource_id: [models.Resource.objects.filter(pk=resource_id)])
 def resource(request, resource_id):
-    resource = get_object_or_404(models.Resource.site_objects(request), pk=resource_id)
+    resource = load_resource(request, resource_id)
 
     return render(request, 'registry/resource.html', {
         'resource': resource
     })
 
 
+@conditional(lambda request: [models.StudyDesign.site_objects(request)])
 def study_designs(request):
     # Study designs with collections
     collections_with_study_designs = models.StudyDesignCollection.site_objects(request).prefetch_related(
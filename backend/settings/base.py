@@ -55,6 +55,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Must come first, see its docstring
+    'backend.middleware.RequestSequenceMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -149,6 +151,22 @@ DEFAULT_FROM_EMAIL = 'Registry <support@sevenpastnine.com>'
 REGISTRY_SUPPORT_EMAIL = 'support@sevenpastnine.com'
 REGISTRY_SUPPORT_EMAIL_WITH_NAME = 'Registry <support@sevenpastnine.com>'
 REGISTRY_RESOURCE_FILE_DIR = 'resources/files/'
+# Resources per page of the resources listing (loaded on scroll)
+REGISTRY_RESOURCES_PAGE_SIZE = 50
+# Rows per page of the people, organisations and use cases listings (loaded on scroll)
+REGISTRY_LISTING_PAGE_SIZE = 50
+# Seconds cached results are kept at most. They are dropped earlier when what
+# they were computed from changes (see registry/caching.py).
+REGISTRY_CACHE_TIMEOUT = 10 * 60
+# Hits per kind (resources, people, ...) shown by the search page and API
+REGISTRY_SEARCH_HITS_PER_KIND = 10
+# Seconds after which Postgres cancels a statement of a search request (the
+# resources listing, the search page and API, suggestions)
+REGISTRY_SEARCH_STATEMENT_TIMEOUT = 3.0
+# Typeahead suggestions returned by /api/suggest/, and the trigram word
+# similarity (0 to 1) a name needs to be suggested. Lower tolerates more typos.
+REGISTRY_SUGGEST_LIMIT = 10
+REGISTRY_SUGGEST_SIMILARITY = 0.3
 REGISTRY_DEFAULT_NODE_TYPES = [
     {
         'name': 'System',
@@ -173,6 +191,42 @@ REGISTRY_DEFAULT_NODE_TYPES = [
 ]
 
 
+# Study design maps
+
+# Seconds a worker waits for another worker to send the state of a live room
+# before it initialises the room from the database.
+REGISTRY_ROOM_STATE_TIMEOUT = 1.0
+
+# Changed nodes and edges of a live map are saved after the map has been idle
+# for REGISTRY_ROOM_FLUSH_IDLE seconds, and at the latest
+# REGISTRY_ROOM_FLUSH_MAX_DELAY seconds after the first unsaved change.
+REGISTRY_ROOM_FLUSH_IDLE = 2.0
+REGISTRY_ROOM_FLUSH_MAX_DELAY = 30.0
+
+# The binary update log of a map is compacted into a single snapshot once it
+# has more than this many rows.
+REGISTRY_MAP_UPDATES_COMPACT_AFTER = 50
+
+# Every REGISTRY_ROOM_SWEEP_INTERVAL seconds each worker evicts (saves and
+# closes) rooms idle for longer than REGISTRY_ROOM_IDLE_TTL seconds, and the
+# least recently active rooms while the encoded size of all its rooms exceeds
+# REGISTRY_ROOM_MEMORY_LIMIT bytes.
+REGISTRY_ROOM_SWEEP_INTERVAL = 60
+REGISTRY_ROOM_IDLE_TTL = 15 * 60
+REGISTRY_ROOM_MEMORY_LIMIT = 256 * 1024 * 1024
+
+# On shutdown a worker saves and closes all its rooms, at most this many at
+# the same time.
+REGISTRY_ROOM_SHUTDOWN_CONCURRENCY = 4
+
+# Awareness messages (cursors) of a room are coalesced per client for
+# REGISTRY_ROOM_AWARENESS_WINDOW seconds and forwarded at a rate of at most
+# REGISTRY_ROOM_AWARENESS_RATE messages per second per room, counted across
+# all workers in the cache.
+REGISTRY_ROOM_AWARENESS_WINDOW = 0.05
+REGISTRY_ROOM_AWARENESS_RATE = 100
+
+
 # Logging
 
 LOGGING = {
@@ -197,6 +251,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'backend.registry.rooms': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
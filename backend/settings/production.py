@@ -53,8 +53,15 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Shared by all workers, so that a write invalidates the cached results of all
+# of them (see registry/caching.py)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/1",
+    }
+}
+
 DJANGO_EASY_AUDIT_WATCH_REQUEST_EVENTS = False
 
 STATICFILES_STORAGE = "django.contrib.staticfiles.storage.ManifestStaticFilesStorage"
-
-USE_ETAGS = True
@@ -1,6 +1,8 @@
 from django import template
 from django.conf import settings
 
+from backend.registry import caching
+
 register = template.Library()
 
 
@@ -24,3 +26,12 @@ def site_objects(queryset, request):
         return queryset.filter(site=request.site)
     else:
         return queryset
+
+
+@register.simple_tag(takes_context=True)
+def fragments_generation(context):
+    """
+    The current generation of the cached template fragments of the site, to
+    be part of their cache keys (see registry/caching.py and registry/signals.py).
+    """
+    return caching.generation('fragments', context['request'].site.id)
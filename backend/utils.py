@@ -1,6 +1,11 @@
-from typing import Union, Dict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Union
 
 from django.conf import settings
+from django.core import signing
+from django.core.exceptions import SuspiciousOperation
+from django.db import OperationalError, connection, transaction
+from django.db.models import Q, QuerySet
 from django.http import HttpRequest
 from django.contrib.sites.models import Site
 from django.contrib.sites.requests import RequestSite
@@ -39,3 +44,98 @@ def get_current_site(request_or_scope: Union[HttpRequest, Dict]) -> Union[Site,
             return Site.objects.get(domain=dict(scope['headers'])[b'host'].decode('utf-8'))
     else:
         return get_current_site_django(request_or_scope)
+
+
+_KEYSET_SALT = 'keyset-pagination'
+
+
+def keyset_paginate(queryset: QuerySet, cursor: str | None, page_size: int) -> tuple[list, str | None]:
+    """
+    Returns one page of an ordered queryset and the cursor of the next page.
+
+    Args:
+        queryset (QuerySet): The queryset, ordered by model fields or annotations. The ordering must be unique (end with the primary key).
+        cursor (str | None): The cursor returned with the previous page, or None for the first page.
+        page_size (int): The maximum number of objects in the page.
+
+    Returns:
+        tuple: The objects of the page and the cursor of the next page (None on the last page).
+
+    Raises:
+        SuspiciousOperation: If the cursor was tampered with or does not match the ordering.
+
+    Notes:
+        - Unlike offset pagination, the page is found through the ordering columns, so the cost of a page does not grow with its position and rows inserted meanwhile do not shift the pages.
+        - The cursor holds the ordering values of the last object of the page, signed.
+    """
+    ordering: list[str] = list(queryset.query.order_by)
+    if cursor:
+        try:
+            values = signing.loads(cursor, salt=_KEYSET_SALT)
+        except signing.BadSignature:
+            raise SuspiciousOperation('Invalid page cursor')
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise SuspiciousOperation('Invalid page cursor')
+        queryset = queryset.filter(_keyset_after(ordering, values))
+
+    page = list(queryset[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, signing.dumps([getattr(page[-1], field.lstrip('-')) for field in ordering], salt=_KEYSET_SALT)
+
+
+def _keyset_after(ordering: list[str], values: list) -> Q:
+    # (a, b, c) after (x, y, z): a > x OR (a = x AND (b > y OR (b = y AND c > z))),
+    # with < for descending fields
+    condition = None
+    for field, value in reversed(list(zip(ordering, values))):
+        name = field.lstrip('-')
+        after = Q(**{f'{name}__{"lt" if field.startswith("-") else "gt"}': value})
+        condition = after if condition is None else after | (Q(**{name: value}) & condition)
+    return condition  # type: ignore
+
+
+class QueryTimeout(Exception):
+    """A statement was cancelled by statement_timeout()."""
+
+
+@contextmanager
+def statement_timeout(seconds: float):
+    """
+    Runs the block in a transaction in which Postgres cancels any statement that runs longer than `seconds`.
+
+    Raises:
+        QueryTimeout: If a statement was cancelled.
+
+    Notes:
+        - The timeout is set with SET LOCAL semantics, so it ends with the (outermost) transaction and does not leak to later requests on the same connection.
+    """
+    with transaction.atomic():  # type: ignore
+        with connection.cursor() as cursor:
+            # 0 would disable the timeout
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)", [f'{max(1, round(seconds * 1000))}ms'])
+        try:
+            yield
+        except OperationalError as e:
+            # 57014: query_canceled
+            if getattr(e.__cause__, 'sqlstate', None) == '57014':
+                raise QueryTimeout() from e
+            raise
+
+
+def percentile(values: Iterable[float], p: float) -> float:
+    """
+    Returns the nearest-rank `p`th percentile (0 to 100) of the values, 0.0 if there are none.
+
+    Used by the benchmark and load test commands to summarise timings.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def format_ms(seconds: float) -> str:
+    """Formats a duration in seconds as milliseconds, e.g. `12.3ms`."""
+    return f'{seconds * 1000:.1f}ms'
@@ -27,3 +27,23 @@ import './styles/main.sass'
         });
     }
 })();
+
+// Search as you type: a new request replaces the one in flight (hx-sync), but
+// the server cannot tell that the browser gave up on it. Forms with
+// data-request-sequence number their requests, so that the server can skip
+// the ones a later keystroke superseded (see backend/middleware.py).
+
+(() => {
+    const streams = new WeakMap();
+
+    document.body.addEventListener('htmx:configRequest', (event) => {
+        const form = event.detail.elt.closest('[data-request-sequence]');
+        if (!form) {
+            return;
+        }
+        const stream = streams.get(form) || { id: crypto.randomUUID(), sequence: 0 };
+        stream.sequence += 1;
+        streams.set(form, stream);
+        event.detail.headers['X-Request-Sequence'] = `${stream.id}:${stream.sequence}`;
+    });
+})();